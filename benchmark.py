@@ -0,0 +1,928 @@
+"""
+Offline benchmarks for epub2tts-kokoro.
+
+Unless noted otherwise, the real Kokoro model is swapped for a deterministic
+stub pipeline so the numbers only reflect the work done around the model.
+
+Usage:
+    python benchmark.py assembly [--chapters N] [--paragraphs N]
+    python benchmark.py batch [--batch-size N]  (needs the real model)
+    python benchmark.py backends [--backends eager,onnx]  (needs the real model)
+    python benchmark.py export [--chapters N]
+    python benchmark.py ingest [--images N] [--image-kb N] [--compare]
+    python benchmark.py serve [--rtf N] [--url URL]
+    python benchmark.py startup [--synthesis]  (--synthesis needs the real model)
+    python benchmark.py suite [--chapters N] [--paragraphs N] [--rtf N] [--output results.json]
+    python benchmark.py memory [--hours 0.5,1,3]
+    python benchmark.py distributed [--workers N] [--no-kill]
+    python benchmark.py packing [BOOK] [--chars N] [--stub]  (needs the real model unless --stub)
+"""
+import argparse
+import contextlib
+import datetime
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+
+import numpy as np
+import soundfile
+
+from epub2tts_kokoro import epub2tts_kokoro as e2t
+from epub2tts_kokoro.daemon import SOCKET_ENV
+from epub2tts_kokoro.manifest import JobManifest, job_settings
+from epub2tts_kokoro.metrics import peak_rss_mb
+
+
+class StubModel:
+    """
+    Stand-in for kokoro.KModel that returns audio proportional to the phoneme count.
+    """
+    # roughly what Kokoro produces at speed 1.0
+    seconds_per_char = 0.06
+    # when set, synthesis takes as long as the model would at this real-time factor
+    real_time_factor = None
+    device = "cpu"
+
+    def to(self, device):
+        return self
+
+    def __call__(self, phonemes, ref_s, speed=1):
+        samples = int(len(phonemes) * self.seconds_per_char * e2t.SAMPLE_RATE / speed)
+        t = np.arange(samples, dtype=np.float32) / e2t.SAMPLE_RATE
+        if self.real_time_factor:
+            time.sleep(samples / e2t.SAMPLE_RATE / self.real_time_factor)
+        return 0.1 * np.sin(2 * np.pi * 220 * t).astype(np.float32)
+
+
+class StubVoice:
+    def to(self, device):
+        return self
+
+    def __getitem__(self, index):
+        return None
+
+
+class StubPipeline:
+    """
+    Stand-in for kokoro.KPipeline whose G2P returns the text unchanged.
+    """
+    def __init__(self, lang_code="a", model=True, **kwargs):
+        self.lang_code = lang_code
+        self.model = StubModel() if model else None
+
+    def g2p(self, text):
+        return text, [text]
+
+    def en_tokenize(self, tokens):
+        for token in tokens:
+            yield token, token, None
+
+    def load_voice(self, voice):
+        return StubVoice()
+
+    def __call__(self, text, voice=None, speed=1, split_pattern=None):
+        yield text, text, self.model(text, None, speed)
+
+
+def use_stub(real_time_factor=None):
+    # Swap the model for the stub, and keep a running synthesis daemon out of the measurements
+    e2t.KPipeline = StubPipeline
+    StubModel.real_time_factor = real_time_factor
+    os.environ[SOCKET_ENV] = os.path.join(tempfile.gettempdir(), "epub2tts-kokoro-benchmark-no-daemon")
+
+
+def make_book(chapters, paragraphs):
+    sentence = "The quick brown fox jumped over the lazy dog while the swan dive fell short."
+    book_contents = []
+    for c in range(chapters):
+        book_contents.append({
+            "title": f"Chapter {c + 1}",
+            "paragraphs": [" ".join([sentence] * 4) for _ in range(paragraphs)],
+        })
+    return book_contents
+
+
+def time_read_book(book_contents, assembly):
+    workdir = tempfile.mkdtemp(prefix="e2t-bench-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        start = time.perf_counter()
+        # G2P worker processes would load the real KPipeline, not the stub
+        e2t.read_book(book_contents, "af_heart", 600, 1.3, False, assembly, g2p_workers=0)
+        return time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+def bench_assembly(args):
+    use_stub()
+    book_contents = make_book(args.chapters, args.paragraphs)
+    results = {}
+    for assembly in ["files", "memory"]:
+        results[assembly] = time_read_book(book_contents, assembly)
+    print(f"\n{args.chapters} chapters x {args.paragraphs} paragraphs")
+    for assembly, elapsed in results.items():
+        print(f"  {assembly:>8}: {elapsed:8.2f}s")
+    print(f"  speedup: {results['files'] / results['memory']:.1f}x")
+
+
+def bench_batch(args):
+    # Uses the real model: batched inference only makes sense against it
+    from epub2tts_kokoro import batching
+
+    pipeline = e2t.load_pipeline(args.speaker[0])
+    pack = pipeline.load_voice(args.speaker).to(pipeline.model.device)
+    paragraphs = [p["paragraphs"][0] for p in make_book(args.sentences // 4, 1)]
+    phonemes = []
+    for paragraph in paragraphs:
+        for sent in e2t.process_large_text(paragraph):
+            phonemes.extend(e2t.phonemize(pipeline, sent))
+
+    start = time.perf_counter()
+    sequential = [pipeline.model(ps, pack[len(ps) - 1], args.speed) for ps in phonemes]
+    sequential_time = time.perf_counter() - start
+    start = time.perf_counter()
+    batched = batching.synthesize(pipeline.model, pack, phonemes, args.speed, args.batch_size)
+    batched_time = time.perf_counter() - start
+
+    audio_seconds = sum(len(a) for a in sequential) / e2t.SAMPLE_RATE
+    print(f"\n{len(phonemes)} segments, {audio_seconds:.1f}s of audio")
+    print(f"  sequential: {sequential_time:8.2f}s ({audio_seconds / sequential_time:.1f}x real time)")
+    print(f"  batch={args.batch_size:<3}: {batched_time:8.2f}s ({audio_seconds / batched_time:.1f}x real time)")
+
+    report = batching.compare_with_sequential(pipeline.model, pack, phonemes, args.speed, args.batch_size)
+    length_mismatches = sum(1 for r in report if r["samples"] != r["reference_samples"])
+    worst = max(r["envelope_error"] for r in report)
+    print(f"  length mismatches: {length_mismatches}, worst envelope error: {worst:.3f}")
+
+
+def bench_backends(args):
+    # Uses the real model: the point is how fast each backend runs it
+    from epub2tts_kokoro import backends
+
+    pipeline = e2t.load_pipeline(args.speaker[0])
+    model = pipeline.model
+    pack = pipeline.load_voice(args.speaker).to(model.device)
+    paragraphs = [p["paragraphs"][0] for p in make_book(args.sentences // 4, 1)]
+    phonemes = []
+    for paragraph in paragraphs:
+        for sent in e2t.process_large_text(paragraph):
+            phonemes.extend(e2t.phonemize(pipeline, sent))
+
+    eager = model.forward_with_tokens
+    print(f"\n{len(phonemes)} segments")
+    for backend in args.backends.split(","):
+        start = time.perf_counter()
+        forward = backends.backend_forward(model, pipeline.repo_id, backend)
+        backends.compare_backend(model, eager, forward, pack, speed=args.speed)
+        warmup = time.perf_counter() - start
+        report = backends.compare_backend(model, eager, forward, pack, phonemes, args.speed)
+        audio_seconds = sum(r["samples"] for r in report) / e2t.SAMPLE_RATE
+        backend_time = sum(r["backend_s"] for r in report)
+        eager_time = sum(r["eager_s"] for r in report)
+        length_mismatches = sum(1 for r in report if r["samples"] != r["reference_samples"])
+        worst = max(r["envelope_error"] for r in report)
+        print(f"  {backend:>9}: {backend_time:8.2f}s (RTF {backend_time / audio_seconds:.3f}, "
+              f"{eager_time / backend_time:.2f}x eager), warm-up {warmup:.1f}s, "
+              f"length mismatches: {length_mismatches}, worst envelope error: {worst:.3f}")
+
+
+def make_epub(path, chapters, paragraphs=20, images=0, image_kb=1024):
+    """
+    Write a generated EPUB. With images, every chapter shows one of images
+    incompressible pictures of image_kb each, and the book gets a cover.
+    """
+    from ebooklib import epub
+
+    book = epub.EpubBook()
+    book.set_identifier("benchmark")
+    book.set_title("Benchmark Book")
+    book.add_author("Stub Author")
+    rng = np.random.default_rng(0)
+    if images:
+        book.set_cover("cover.jpg", b"\xff\xd8\xff\xe0" + rng.bytes(image_kb * 1024))
+    for i in range(images):
+        book.add_item(epub.EpubImage(uid=f"image{i}", file_name=f"images/image{i}.jpg", media_type="image/jpeg",
+                                     content=b"\xff\xd8\xff\xe0" + rng.bytes(image_kb * 1024)))
+    sentence = "The quick brown fox jumped over the <em>lazy</em> dog&#8217;s “bent” hook."
+    spine = []
+    for c in range(chapters):
+        body = [f"<h1>Chapter {c + 1}</h1>"]
+        if images:
+            body.append(f"<p><img src='images/image{c % images}.jpg' alt=''/></p>")
+        for p in range(paragraphs):
+            body.append(f"<p>{sentence} {sentence}<a href='#n{p}'><sup>{p}</sup></a> -- {sentence}</p>")
+        item = epub.EpubHtml(title=f"Chapter {c + 1}", file_name=f"chap_{c + 1}.xhtml", lang="en")
+        item.content = "".join(body)
+        book.add_item(item)
+        spine.append(item)
+    book.toc = spine
+    book.spine = spine
+    book.add_item(epub.EpubNcx())
+    book.add_item(epub.EpubNav())
+    epub.write_epub(path, book)
+
+
+def time_export(sourcefile, **kwargs):
+    workdir = tempfile.mkdtemp(prefix="e2t-bench-")
+    target = os.path.join(workdir, os.path.basename(sourcefile))
+    shutil.copyfile(sourcefile, target)
+    try:
+        start = time.perf_counter()
+        e2t.export(target, **kwargs)
+        elapsed = time.perf_counter() - start
+        with open(target.replace(".epub", ".txt"), "rb") as f:
+            return elapsed, f.read()
+    finally:
+        shutil.rmtree(workdir)
+
+
+def bench_export(args):
+    workdir = tempfile.mkdtemp(prefix="e2t-bench-")
+    try:
+        sourcefile = os.path.join(workdir, "book.epub")
+        make_epub(sourcefile, args.chapters)
+        before, before_txt = time_export(sourcefile, workers=1, fast=False)
+        after, after_txt = time_export(sourcefile)
+    finally:
+        shutil.rmtree(workdir)
+    print(f"\n{args.chapters} chapter EPUB export")
+    print(f"  BeautifulSoup, serial: {before:8.2f}s")
+    print(f"  lxml, process pool:    {after:8.2f}s")
+    print(f"  speedup: {before / after:.1f}x, output identical: {before_txt == after_txt}")
+
+
+def measure_stream(url, audio_seconds=10, sample_rate=e2t.SAMPLE_RATE):
+    """
+    Listen to a --serve stream until audio_seconds of audio arrived.
+
+    Returns:
+        dict: seconds to the response, to the first audio and to audio_seconds of audio.
+    """
+    start = time.perf_counter()
+    timings = {}
+    with urllib.request.urlopen(url) as response:
+        timings["response"] = time.perf_counter() - start
+        header = response.read(44)
+        received = 0
+        while received < audio_seconds * sample_rate * 2:
+            data = response.read1(65536)
+            if not data:
+                break
+            if not received:
+                timings["first_audio"] = time.perf_counter() - start
+            received += len(data)
+        timings[f"{received / sample_rate / 2:.0f}s_of_audio"] = time.perf_counter() - start
+    return timings
+
+
+def bench_serve(args):
+    if args.url:
+        timings = measure_stream(args.url, args.seconds)
+    else:
+        from epub2tts_kokoro import serve
+
+        use_stub(args.rtf)
+        book_contents = make_book(args.chapters, args.paragraphs)
+        stream = serve.BookStream([(c["title"], e2t.chapter_texts(c, False)[0]) for c in book_contents],
+                                  e2t.SAMPLE_RATE)
+        server = serve.start_server(stream, port=0)
+        workdir = tempfile.mkdtemp(prefix="e2t-bench-")
+
+        def render():
+            try:
+                e2t.read_book(book_contents, "af_heart", 600, 1.3, False, workdir=workdir, g2p_workers=0,
+                              on_chapter=stream.on_chapter, on_paragraph=stream.on_paragraph)
+            finally:
+                stream.finish()
+
+        start = time.perf_counter()
+        renderer = threading.Thread(target=render)
+        renderer.start()
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}/stream?chapter=1"
+            timings = measure_stream(url, args.seconds)
+            renderer.join()
+            timings["whole_book_rendered"] = time.perf_counter() - start
+        finally:
+            server.shutdown()
+            shutil.rmtree(workdir)
+    print()
+    for name, seconds in timings.items():
+        print(f"  {name:>20}: {seconds:8.2f}s")
+
+
+# What the CLI should only import on the code paths that need it
+HEAVY_MODULES = ["torch", "kokoro", "nltk", "bs4", "ebooklib", "PIL", "pydub", "mutagen"]
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def time_import():
+    # In a fresh interpreter, so nothing is imported yet
+    code = ("import sys, time; start = time.perf_counter(); import epub2tts_kokoro.epub2tts_kokoro; "
+            "print(time.perf_counter() - start); "
+            f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    output = subprocess.run([sys.executable, "-c", code], cwd=REPO_DIR, capture_output=True, text=True,
+                            check=True).stdout.splitlines()
+    return float(output[0]), output[1]
+
+
+def time_cli(cli_args, cwd, first_audio=None):
+    """
+    Run the CLI in a fresh interpreter, as a script like the Docker images do.
+
+    With first_audio (a glob for the chapter spools) the run is stopped as
+    soon as synthesized audio reaches the disk.
+
+    Returns:
+        dict: seconds to the first line of output, to the first audio and to exit.
+    """
+    script = os.path.join(REPO_DIR, "epub2tts_kokoro", "epub2tts_kokoro.py")
+    timings = {}
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-u", script, *cli_args], cwd=cwd, stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+
+    def read_output():
+        for line in process.stdout:
+            timings.setdefault("first_output", time.perf_counter() - start)
+
+    reader = threading.Thread(target=read_output)
+    reader.start()
+    while process.poll() is None:
+        if first_audio and any(os.path.getsize(p) for p in glob.glob(os.path.join(cwd, first_audio))):
+            timings["first_audio"] = time.perf_counter() - start
+            process.terminate()
+            break
+        time.sleep(0.01)
+    process.wait()
+    reader.join()
+    timings["exit"] = time.perf_counter() - start
+    return timings
+
+
+def bench_startup(args):
+    results = {}
+    imports = [time_import() for _ in range(args.repeat)]
+    results["import"] = {"exit": statistics.median(seconds for seconds, _ in imports)}
+    heavy = imports[0][1]
+    workdir = tempfile.mkdtemp(prefix="e2t-bench-")
+    try:
+        runs = [time_cli(["--help"], workdir) for _ in range(args.repeat)]
+        results["--help"] = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        make_epub(os.path.join(workdir, "book.epub"), args.chapters)
+        runs = []
+        for _ in range(args.repeat):
+            if os.path.exists(os.path.join(workdir, "book.txt")):
+                os.remove(os.path.join(workdir, "book.txt"))
+            runs.append(time_cli(["book.epub"], workdir))
+        results["epub export"] = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        if args.synthesis:
+            results["synthesis"] = time_cli(["book.txt", "--g2p-workers", "0"], workdir, "book.*.work/chapter*.pcm")
+            # The same from the EPUB in one run: chapter 1 is read before the rest is extracted
+            for path in glob.glob(os.path.join(workdir, "book.*.work")):
+                shutil.rmtree(path)
+            results["--direct"] = time_cli(["book.epub", "--direct", "--g2p-workers", "0"], workdir,
+                                           "book.*.work/chapter*.pcm")
+    finally:
+        shutil.rmtree(workdir)
+    print(f"\nStartup, median of {args.repeat} runs (synthesis: 1 run)")
+    print(f"  modules loaded by importing epub2tts_kokoro: {heavy or 'none of ' + ', '.join(HEAVY_MODULES)}")
+    for name, timings in results.items():
+        print(f"  {name:>12}: " + ", ".join(f"{key} {seconds:.2f}s" for key, seconds in timings.items()))
+
+
+def make_text(path, chapters, paragraphs):
+    # Laid out like an exported EPUB: Title/Author lines, then a heading per chapter
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("Title: Benchmark Book\nAuthor: Stub Author\n\n")
+        for chapter in make_book(chapters, paragraphs):
+            f.write(f"# {chapter['title']}\n\n")
+            for paragraph in chapter["paragraphs"]:
+                f.write(f"{paragraph}\n\n")
+
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        yield
+
+
+def measure(run, setup=None):
+    """
+    Time run(), then run it again under tracemalloc for its peak memory.
+
+    setup(), if given, resets the state before each run and is not measured.
+    run() returns the amount of work it did, e.g. {"paragraphs": 200}.
+
+    Returns:
+        dict: seconds, peak_mb (tracemalloc peak: Python and numpy allocations
+        of this process, not of worker processes) and throughput per second.
+    """
+    if setup:
+        setup()
+    with quiet():
+        start = time.perf_counter()
+        work = run()
+        seconds = time.perf_counter() - start
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        with quiet():
+            run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "seconds": round(seconds, 4),
+        "peak_mb": round(peak / 1024 / 1024, 2),
+        "work": work,
+        "throughput": {f"{name}_per_s": round(amount / seconds, 2) for name, amount in work.items()},
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(args):
+    """
+    Measure each stage of turning a book into an m4b on its own, with the stub model.
+    """
+    use_stub(args.rtf)
+    with quiet():
+        # importing torch and picking a device is startup cost (see startup), not read_book's
+        e2t.set_default_device()
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="e2t-bench-")
+    stages = {}
+    try:
+        # generate_metadata and make_m4b work in the current directory
+        os.chdir(workdir)
+        epub_path = os.path.join(workdir, "book.epub")
+        text_path = os.path.join(workdir, "book.txt")
+        make_epub(epub_path, args.chapters, args.paragraphs)
+        epub_mb = round(os.path.getsize(epub_path) / 1024 / 1024, 3)
+
+        def export():
+            e2t.export(epub_path)
+            return {"chapters": args.chapters, "epub_mb": epub_mb}
+
+        def remove_text():
+            # export asks before overwriting its output
+            if os.path.exists(text_path):
+                os.remove(text_path)
+
+        stages["export"] = measure(export, setup=remove_text)
+
+        make_text(text_path, args.chapters, args.paragraphs)
+        characters = os.path.getsize(text_path)
+        book = {}
+
+        def get_book():
+            book["contents"], _, _, book["titles"] = e2t.get_book(text_path)
+            return {"paragraphs": args.chapters * args.paragraphs, "characters": characters}
+
+        stages["get_book"] = measure(get_book)
+
+        paragraphs = [p for chapter in make_book(args.chapters, args.paragraphs) for p in chapter["paragraphs"]]
+
+        def process_large_text():
+            for paragraph in paragraphs:
+                e2t.process_large_text(paragraph)
+            return {"paragraphs": len(paragraphs), "characters": sum(len(p) for p in paragraphs)}
+
+        stages["process_large_text"] = measure(process_large_text)
+
+        renders = []
+
+        def read_book():
+            render = tempfile.mkdtemp(prefix="render-", dir=workdir)
+            parts = e2t.read_book(book["contents"], "af_heart", 600, 1.3, False, workdir=render, g2p_workers=0)
+            renders.append(parts)
+            audio_seconds = sum(soundfile.info(p).frames for p in parts) / e2t.SAMPLE_RATE
+            return {"paragraphs": args.chapters * args.paragraphs, "audio_seconds": round(audio_seconds, 2)}
+
+        stages["read_book"] = measure(read_book)
+
+        parts = renders[0]
+        samples = [soundfile.info(p).frames for p in parts]
+        audio_seconds = sum(samples) / e2t.SAMPLE_RATE
+
+        from epub2tts_kokoro import postprocess
+        rendered = np.concatenate([soundfile.read(p, dtype="float32")[0] for p in parts])
+        # cut into sentence-sized pieces, four to a paragraph
+        pieces = np.array_split(rendered, max(1, len(rendered) // (5 * e2t.SAMPLE_RATE)))
+
+        def postprocess_audio():
+            for k in range(0, len(pieces), 4):
+                postprocess.join_segments(pieces[k:k + 4], e2t.SAMPLE_RATE)
+            blocks = (rendered[k:k + e2t.SPOOL_BLOCK] for k in range(0, len(rendered), e2t.SPOOL_BLOCK))
+            postprocess.loudness_gain(blocks, e2t.SAMPLE_RATE)
+            return {"audio_seconds": round(len(rendered) / e2t.SAMPLE_RATE, 2)}
+
+        stages["postprocess"] = measure(postprocess_audio)
+
+        def generate_metadata():
+            e2t.generate_metadata(parts, "Stub Author", "Benchmark Book", book["titles"], samples)
+            return {"chapters": len(parts)}
+
+        stages["generate_metadata"] = measure(generate_metadata)
+
+        if shutil.which("ffmpeg"):
+            m4a_files = [e2t.encode_chapter(p) for p in parts]
+            m4b_path = os.path.join(workdir, "book (af_heart).m4b")
+
+            def reset_m4b():
+                if os.path.exists(m4b_path):
+                    os.remove(m4b_path)
+                e2t.generate_metadata(parts, "Stub Author", "Benchmark Book", book["titles"], samples)
+
+            def make_m4b():
+                e2t.make_m4b(m4a_files, text_path, "af_heart")
+                return {"chapters": len(parts), "audio_seconds": round(audio_seconds, 2)}
+
+            stages["make_m4b"] = measure(make_m4b, setup=reset_m4b)
+        else:
+            stages["make_m4b"] = {"skipped": "ffmpeg not found"}
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    results = {
+        "benchmark": "suite",
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {"chapters": args.chapters, "paragraphs": args.paragraphs, "rtf": args.rtf},
+        # ru_maxrss is in kB on Linux and in bytes on macOS
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                            / (1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+        "stages": stages,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+        print(f"\nResults written to {args.output}")
+        for name, stage in stages.items():
+            if "skipped" in stage:
+                print(f"  {name:>18}: skipped, {stage['skipped']}")
+                continue
+            throughput = ", ".join(f"{value} {key}" for key, value in stage["throughput"].items())
+            print(f"  {name:>18}: {stage['seconds']:8.2f}s, peak {stage['peak_mb']:7.1f}MB, {throughput}")
+    else:
+        print(json.dumps(results, indent=1))
+
+
+def encode_long_chapter(hours, in_memory, results):
+    # Runs in a fresh process, so its peak RSS only reflects this one chapter
+    workdir = tempfile.mkdtemp(prefix="e2t-bench-")
+    try:
+        manifest = JobManifest(workdir, job_settings("af_heart", 1.3, 600, False, "benchmark"))
+        paragraph = 0.1 * np.sin(np.arange(30 * e2t.SAMPLE_RATE, dtype=np.float32) / 10)
+        texts = [f"Paragraph {k}" for k in range(int(hours * 3600 / 30))]
+        manifest.resume_chapter(1, texts)
+        for k, text in enumerate(texts):
+            manifest.append_paragraph(1, k, text, paragraph)
+        baseline = peak_rss_mb()
+        start = time.perf_counter()
+        if in_memory:
+            # what finish_chapter did before: the whole chapter as one array
+            audio = np.concatenate([np.fromfile(manifest.spool_path(1), dtype=np.float32), e2t.silence(2000)])
+            manifest.finish_chapter(1, texts, [audio], e2t.SAMPLE_RATE)
+        else:
+            e2t.finish_chapter(manifest, 1, texts)
+        results.put((time.perf_counter() - start, peak_rss_mb() - baseline))
+        manifest.close()
+    finally:
+        shutil.rmtree(workdir)
+
+
+def bench_memory(args):
+    context = multiprocessing.get_context("spawn")
+    print(f"\nPeak RSS growth while encoding one chapter to FLAC")
+    for hours in [float(h) for h in args.hours.split(",")]:
+        row = []
+        for in_memory in [False, True] if args.compare else [False]:
+            results = context.Queue()
+            process = context.Process(target=encode_long_chapter, args=(hours, in_memory, results))
+            process.start()
+            process.join()
+            if process.exitcode:
+                raise RuntimeError(f"encoding a {hours}h chapter failed")
+            seconds, growth = results.get()
+            row.append(f"{'whole chapter in memory' if in_memory else 'streamed from the spool'} "
+                       f"{growth:7.1f}MB in {seconds:6.1f}s")
+        print(f"  {hours:5.2f}h: " + ", ".join(row))
+
+
+def ingest_epub(sourcefile, streamed, results):
+    # Runs in a fresh process, so its peak RSS only reflects this one export
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    with quiet():
+        if streamed:
+            e2t.export(sourcefile, workers=1)
+        else:
+            # what export did before: ebooklib reads every item of the book into memory
+            import ebooklib
+            from ebooklib import epub
+            book = epub.read_epub(sourcefile)
+            for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
+                e2t.chap2text_epub(item.get_content())
+    results.put((time.perf_counter() - start, peak_rss_mb() - baseline))
+
+
+def bench_ingest(args):
+    context = multiprocessing.get_context("spawn")
+    workdir = tempfile.mkdtemp(prefix="e2t-bench-")
+    try:
+        sourcefile = os.path.join(workdir, "book.epub")
+        # Written by a process of its own: a child's peak RSS starts at its parent's
+        writer = context.Process(target=make_epub,
+                                 args=(sourcefile, args.chapters, args.paragraphs, args.images, args.image_kb))
+        writer.start()
+        writer.join()
+        epub_mb = os.path.getsize(sourcefile) / 1024 / 1024
+        print(f"\nPeak RSS growth while exporting a {epub_mb:.0f}MB EPUB "
+              f"({args.chapters} chapters, {args.images} images of {args.image_kb}KB)")
+        for streamed in [True, False] if args.compare else [True]:
+            for output in glob.glob(os.path.join(workdir, "book.*")):
+                if output != sourcefile:
+                    os.remove(output)
+            results = context.Queue()
+            process = context.Process(target=ingest_epub, args=(sourcefile, streamed, results))
+            process.start()
+            process.join()
+            if process.exitcode:
+                raise RuntimeError("exporting the EPUB failed")
+            seconds, growth = results.get()
+            print(f"  {'streamed from the zip' if streamed else 'ebooklib read_epub':22s} "
+                  f"{growth:7.1f}MB in {seconds:6.2f}s")
+    finally:
+        shutil.rmtree(workdir)
+
+
+def queue_worker(directory, rtf, lease, workdir):
+    # One epub2tts-kokoro-worker, in a process of its own
+    from epub2tts_kokoro import workqueue
+
+    use_stub(rtf)
+    args = argparse.Namespace(workdir=workdir, lease=lease, threads=None, batch_size=None, cache_dir=None,
+                              g2p_workers=0, no_calibration=True)
+    with quiet():
+        workqueue.run_worker(directory, args)
+
+
+def bench_distributed(args):
+    """
+    Render a book through the work queue with local worker processes, kill
+    one of them in the middle of a chapter, and check the parts against a
+    local render.
+    """
+    from epub2tts_kokoro import workqueue
+
+    use_stub(args.rtf)
+    workdir = tempfile.mkdtemp(prefix="e2t-bench-")
+    queue_dir = os.path.join(workdir, "queue")
+    context = multiprocessing.get_context("spawn")
+    try:
+        book_contents = make_book(args.chapters, args.paragraphs)
+        with quiet():
+            local = e2t.read_book(book_contents, "af_heart", 600, 1.3, False, workdir=os.path.join(workdir, "local"),
+                                  g2p_workers=0)
+        workers = [context.Process(target=queue_worker,
+                                   args=(queue_dir, args.rtf, args.lease, os.path.join(workdir, f"worker{k}")))
+                   for k in range(args.workers)]
+        book = dict(job_settings("af_heart", 1.3, 600, False, "benchmark", e2t.POSTPROCESS), backend="eager",
+                    chapters=book_contents)
+        result = {}
+        coordinator = threading.Thread(
+            target=lambda: result.update(parts=workqueue.coordinate(queue_dir, book, lease_seconds=args.lease)))
+        start = time.perf_counter()
+        with quiet():
+            coordinator.start()
+            for worker in workers:
+                worker.start()
+            # the first worker dies as soon as it holds a chapter
+            victim = workers[0]
+            queue = workqueue.WorkQueue(queue_dir, args.lease)
+            chapters = range(1, args.chapters + 1)
+            while args.kill and not any(queue.holds(c, f"{socket.gethostname()}-{victim.pid}") for c in chapters):
+                time.sleep(0.05)
+            if args.kill:
+                time.sleep(0.5)
+                victim.kill()
+            coordinator.join()
+            for worker in workers:
+                worker.join()
+        elapsed = time.perf_counter() - start
+        audio = [soundfile.read(p, dtype="int16")[0] for p in result["parts"]]
+        identical = sum(np.array_equal(a, soundfile.read(p, dtype="int16")[0]) for a, p in zip(audio, local))
+        seconds = sum(len(a) for a in audio) / e2t.SAMPLE_RATE
+        print(f"\n{args.workers} workers{', one killed mid-chapter' if args.kill else ''}: {args.chapters} chapters, "
+              f"{seconds:.0f}s of audio in {elapsed:.1f}s")
+        print(f"  parts identical to a local render: {identical} of {len(local)}")
+    finally:
+        shutil.rmtree(workdir)
+
+
+class PhonemeMemo:
+    """
+    G2P once per segment, in place of the G2P stage, so both ways of
+    calling the model read the same phonemes.
+    """
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.phonemes = {}
+
+    def get(self, text):
+        if text not in self.phonemes:
+            self.phonemes[text] = e2t.phonemize(self.pipeline, text)
+        return self.phonemes[text]
+
+
+class CountingModel:
+    """
+    Wraps the model to count its calls and the audio they return.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.device = model.device
+        self.calls = 0
+        self.samples = 0
+
+    def __call__(self, phonemes, ref_s, speed=1):
+        audio = self.model(phonemes, ref_s, speed)
+        self.calls += 1
+        self.samples += len(audio)
+        return audio
+
+
+def bench_packing(args):
+    """
+    Model calls per book with every segment read on its own and with the
+    segments of each paragraph packed into calls of up to PHONEME_BUDGET
+    phonemes, then the audio per call and throughput of both on a slice.
+    """
+    if args.stub:
+        use_stub()
+        pipeline = StubPipeline(args.speaker[0])
+    else:
+        pipeline = e2t.load_pipeline(args.speaker[0])
+    if args.book:
+        book_contents = e2t.get_book(args.book)[0]
+    else:
+        book_contents = make_book(args.chapters, args.paragraphs)
+    paragraphs = [segments for chapter in book_contents for segments in e2t.chapter_texts(chapter, False)[1]]
+    memo = PhonemeMemo(pipeline)
+    ways = {"per segment": False, "packed": True}
+    print(f"\n{args.book or 'Generated book'}: {len(paragraphs)} paragraphs, "
+          f"{sum(len(segments) for segments in paragraphs)} segments")
+    try:
+        for name, packing in ways.items():
+            e2t.PACKING = packing
+            lengths = []
+            for segments in paragraphs:
+                for text, phonemes in e2t.paragraph_calls(segments, pipeline, memo):
+                    lengths.extend(len(ps) for ps in (memo.get(text) if phonemes is None else phonemes))
+            mean = statistics.mean(lengths) if lengths else 0
+            print(f"  {name:>11}: {len(lengths)} model calls, {mean:.0f} phonemes per call "
+                  f"({100 * mean / e2t.PHONEME_BUDGET:.0f}% of {e2t.PHONEME_BUDGET})")
+
+        sample = []
+        for segments in paragraphs:
+            if sum(len(sent) for p in sample for sent in p) >= args.chars:
+                break
+            sample.append(segments)
+        model = pipeline.model = CountingModel(pipeline.model)
+        print(f"Synthesizing {len(sample)} paragraphs, {sum(len(s) for p in sample for s in p)} characters")
+        for name, packing in ways.items():
+            e2t.PACKING = packing
+            # warm-up, not counted
+            e2t.synth_segments(sample[0][:1], args.speaker, pipeline, args.speed, g2p=memo)
+            model.calls = model.samples = 0
+            start = time.perf_counter()
+            for segments in sample:
+                e2t.synth_segments(segments, args.speaker, pipeline, args.speed, g2p=memo)
+            elapsed = time.perf_counter() - start
+            audio = model.samples / e2t.SAMPLE_RATE
+            print(f"  {name:>11}: {model.calls} model calls, {audio / max(model.calls, 1):.2f}s of audio per call, "
+                  f"{audio / elapsed:.1f}s of audio per second")
+    finally:
+        e2t.PACKING = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for epub2tts-kokoro")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    assembly = subparsers.add_parser("assembly", help="Compare per-paragraph file assembly with in-memory assembly")
+    assembly.add_argument("--chapters", type=int, default=5)
+    assembly.add_argument("--paragraphs", type=int, default=40)
+    assembly.set_defaults(func=bench_assembly)
+
+    batch = subparsers.add_parser("batch", help="Compare sequential and batched inference on the real model")
+    batch.add_argument("--speaker", type=str, default="af_heart")
+    batch.add_argument("--speed", type=float, default=1.3)
+    batch.add_argument("--sentences", type=int, default=64)
+    batch.add_argument("--batch-size", type=int, default=16)
+    batch.set_defaults(func=bench_batch)
+
+    backend = subparsers.add_parser("backends", help="Compare inference backends against eager on the real model")
+    backend.add_argument("--speaker", type=str, default="af_heart")
+    backend.add_argument("--speed", type=float, default=1.3)
+    backend.add_argument("--sentences", type=int, default=64)
+    backend.add_argument("--backends", type=str, default=",".join(e2t.BACKENDS),
+                         help="Comma-separated backends (default: all)")
+    backend.set_defaults(func=bench_backends)
+
+    export = subparsers.add_parser("export", help="Compare BeautifulSoup and lxml EPUB export on a generated EPUB")
+    export.add_argument("--chapters", type=int, default=5000)
+    export.set_defaults(func=bench_export)
+
+    ingest = subparsers.add_parser("ingest", help="Peak memory of exporting a large image-heavy EPUB")
+    ingest.add_argument("--chapters", type=int, default=200)
+    ingest.add_argument("--paragraphs", type=int, default=20)
+    ingest.add_argument("--images", type=int, default=200)
+    ingest.add_argument("--image-kb", type=int, default=2048, help="Size of every image")
+    ingest.add_argument("--compare", action="store_true",
+                        help="Also load the EPUB with ebooklib's read_epub, as export did before")
+    ingest.set_defaults(func=bench_ingest)
+
+    serve = subparsers.add_parser("serve", help="Measure time to first audio of a --serve stream")
+    serve.add_argument("--url", type=str, help="Stream of a running --serve instance (default: serve a stub book)")
+    serve.add_argument("--rtf", type=float, default=20, help="Real-time factor of the stub model")
+    serve.add_argument("--chapters", type=int, default=5)
+    serve.add_argument("--paragraphs", type=int, default=40)
+    serve.add_argument("--seconds", type=float, default=10, help="Audio to receive before stopping")
+    serve.set_defaults(func=bench_serve)
+
+    startup = subparsers.add_parser("startup", help="Measure import time and time to first output of the CLI")
+    startup.add_argument("--chapters", type=int, default=20, help="Chapters of the generated EPUB")
+    startup.add_argument("--repeat", type=int, default=3)
+    startup.add_argument("--synthesis", action="store_true",
+                         help="Also time synthesis of the exported text, and of the EPUB with --direct, up to "
+                              "their first audio (needs the real model)")
+    startup.set_defaults(func=bench_startup)
+
+    suite = subparsers.add_parser("suite", help="Time and memory of every stage on a generated book, as JSON")
+    suite.add_argument("--chapters", type=int, default=20)
+    suite.add_argument("--paragraphs", type=int, default=40, help="Paragraphs per chapter")
+    suite.add_argument("--rtf", type=float, help="Real-time factor of the stub model (default: as fast as it goes)")
+    suite.add_argument("--output", type=str, help="Write the JSON results to this file (default: print them)")
+    suite.set_defaults(func=bench_suite)
+
+    distributed = subparsers.add_parser("distributed", help="Render through the work queue with local workers")
+    distributed.add_argument("--chapters", type=int, default=6)
+    distributed.add_argument("--paragraphs", type=int, default=20)
+    distributed.add_argument("--workers", type=int, default=3)
+    distributed.add_argument("--rtf", type=float, default=20, help="Stub model speed, times real time")
+    distributed.add_argument("--lease", type=int, default=3, help="Lease seconds, short so the kill shows")
+    distributed.add_argument("--no-kill", dest="kill", action="store_false", help="Keep every worker alive")
+    distributed.set_defaults(func=bench_distributed)
+
+    memory = subparsers.add_parser("memory", help="Peak memory of encoding a multi-hour chapter from its spool")
+    memory.add_argument("--hours", type=str, default="0.5,1,3", help="Comma-separated chapter lengths")
+    memory.add_argument("--compare", action="store_true",
+                        help="Also encode with the whole chapter in memory, as before the spool was streamed")
+    memory.set_defaults(func=bench_memory)
+
+    packing = subparsers.add_parser("packing", help="Model calls and audio per call with and without segment packing")
+    packing.add_argument("book", type=str, nargs="?", help="A text file as exported (default: a generated book)")
+    packing.add_argument("--speaker", type=str, default="af_heart")
+    packing.add_argument("--speed", type=float, default=1.3)
+    packing.add_argument("--chars", type=int, default=5000, help="Characters of the book to synthesize")
+    packing.add_argument("--chapters", type=int, default=5)
+    packing.add_argument("--paragraphs", type=int, default=40)
+    packing.add_argument("--stub", action="store_true",
+                         help="Use the stub model and G2P: phonemes are characters, audio is proportional to them")
+    packing.set_defaults(func=bench_packing)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,4 @@
-from .epub2tts_kokoro import main
\ No newline at end of file
+def main():
+    # Imported on demand so the daemon client (daemon.py) does not pull in torch and Kokoro
+    from .epub2tts_kokoro import main
+    return main()
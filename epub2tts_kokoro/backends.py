@@ -0,0 +1,228 @@
+"""
+Inference backends for the Kokoro model (--backend).
+
+    eager      KModel as it is
+    compile    torch.compile with dynamic shapes; inductor keeps its compiled
+               kernels on disk, so only the first run pays for compilation
+    onnx       the model exported once to ONNX and run by ONNX Runtime on the CPU
+    onnx-int8  the same with weights quantized to int8 (dynamic quantization)
+
+A backend replaces the model's forward_with_tokens, which KModel.forward and
+so KPipeline, synth_sentence and the daemon all go through. Batched inference
+(batching.py) runs the model's layers itself and needs eager.
+
+Kokoro's source module injects random noise, so backends are checked against
+eager on length and RMS envelope rather than samples (see batching.py).
+"""
+import contextlib
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: concurrent exports are not serialized there
+    fcntl = None
+
+# Backends selectable with --backend
+BACKENDS = ["eager", "compile", "onnx", "onnx-int8"]
+
+# Phonemes of the warm-up utterances, short to long: they compile or load the
+# backend before the book starts and are compared against eager output
+WARMUP_PHONEMES = [
+    "hˈɛloʊ.",
+    "ðə kwˈɪk bɹˈaʊn fˈɑks dʒˈʌmps ˌoʊvɚ ðə lˈeɪzi dˈɑɡ.",
+    "ɪt wʌz ðə bˈɛst ʌv tˈaɪmz, ɪt wʌz ðə wˈɜɹst ʌv tˈaɪmz, ɪt wʌz ðɪ ˈeɪdʒ ʌv wˈɪzdəm, "
+    "ɪt wʌz ðɪ ˈeɪdʒ ʌv fˈulɪʃnəs.",
+]
+
+# Envelope error against eager above which a backend is reported as diverging
+MAX_ENVELOPE_ERROR = 0.2
+
+# Voice whose style vectors drive the warm-up, any installed voice would do
+WARMUP_VOICE = "af_heart"
+
+
+def cache_dir():
+    # Compiled kernels and exported models, shared by every book
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "epub2tts-kokoro")
+
+
+def backend_version(version, backend):
+    # Other backends only approximate eager output, so caches and work directories keep them apart
+    return version if backend == "eager" else f"{version}+{backend}"
+
+
+def compiled_forward(model, directory):
+    import torch
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(directory, "inductor"))
+    try:
+        torch._inductor.config.fx_graph_cache = True
+    except AttributeError:
+        # older torch: kernels are still cached, graphs are traced again
+        pass
+    return torch.compile(model.forward_with_tokens, dynamic=True)
+
+
+def onnx_path(directory, repo_id, quantize):
+    if __package__:
+        from .cache import kokoro_version
+    else:
+        from cache import kokoro_version
+    import torch
+    name = f"{repo_id.replace('/', '_')}-{kokoro_version()}-torch{torch.__version__.split('+')[0]}"
+    return os.path.join(directory, "onnx", name + ("-int8" if quantize else "") + ".onnx")
+
+
+@contextlib.contextmanager
+def export_lock(path):
+    # One process exports or quantizes the model, the others (--workers, calibration) wait and load it
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "w") as lockfile:
+        if fcntl is not None:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+        yield
+
+
+def export_onnx(model, repo_id, path):
+    import torch
+    from kokoro import KModel
+    if __package__:
+        from .batching import tokenize
+    else:
+        from batching import tokenize
+
+    class TokensToAudio(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, ref_s, speed):
+            return self.model.forward_with_tokens(input_ids, ref_s, speed)
+
+    try:
+        # torch.stft/istft on complex tensors do not export, Kokoro has a real-valued variant for this
+        export_model = KModel(repo_id=repo_id, disable_complex=True).eval()
+    except TypeError:
+        print("This Kokoro version has no disable_complex option, exporting the loaded model as it is")
+        export_model = model.to("cpu")
+    input_ids = torch.LongTensor([tokenize(export_model, WARMUP_PHONEMES[1])])
+    ref_s = torch.zeros(1, 256)
+    speed = torch.tensor(1.0)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    print(f"Exporting the model to {path}")
+    with torch.no_grad():
+        torch.onnx.export(
+            TokensToAudio(export_model), (input_ids, ref_s, speed), tmp,
+            input_names=["input_ids", "ref_s", "speed"],
+            output_names=["waveform", "duration"],
+            dynamic_axes={"input_ids": {1: "tokens"}, "waveform": {0: "samples"}, "duration": {0: "tokens"}},
+            opset_version=17,
+        )
+    os.replace(tmp, path)
+
+
+def onnx_forward(model, repo_id, directory, quantize=False):
+    import numpy as np
+    import torch
+    try:
+        import onnxruntime
+    except ImportError:
+        raise RuntimeError("--backend onnx needs onnx and onnxruntime: pip install onnx onnxruntime")
+    path = onnx_path(directory, repo_id, False)
+    with export_lock(path):
+        if not os.path.exists(path):
+            export_onnx(model, repo_id, path)
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        fp32_path, path = path, onnx_path(directory, repo_id, True)
+        with export_lock(path):
+            if not os.path.exists(path):
+                print(f"Quantizing the model to {path}")
+                tmp = f"{path}.{os.getpid()}.tmp"
+                quantize_dynamic(fp32_path, tmp, weight_type=QuantType.QInt8)
+                os.replace(tmp, path)
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def forward(input_ids, ref_s, speed):
+        waveform, duration = session.run(None, {
+            "input_ids": input_ids.cpu().numpy().astype(np.int64),
+            "ref_s": ref_s.cpu().numpy().astype(np.float32),
+            "speed": np.array(speed, dtype=np.float32),
+        })
+        return torch.from_numpy(waveform), torch.from_numpy(duration)
+    return forward
+
+
+def backend_forward(model, repo_id, backend, directory=None):
+    # A replacement for model.forward_with_tokens
+    directory = directory or cache_dir()
+    if backend == "eager":
+        return model.forward_with_tokens
+    if backend == "compile":
+        return compiled_forward(model, directory)
+    if backend in ("onnx", "onnx-int8"):
+        return onnx_forward(model, repo_id, directory, quantize=backend == "onnx-int8")
+    raise ValueError(f"unknown backend {backend}, expected one of {', '.join(BACKENDS)}")
+
+
+def compare_backend(model, eager, forward, pack, phonemes=WARMUP_PHONEMES, speed=1):
+    """
+    Run every phoneme string through eager and through the backend's forward.
+
+    Returns:
+        list of dicts with sample counts, seconds taken and relative envelope error per string.
+    """
+    import torch
+    if __package__:
+        from .batching import envelope_error, tokenize
+    else:
+        from batching import envelope_error, tokenize
+    report = []
+    with torch.no_grad():
+        for ps in phonemes:
+            input_ids = torch.LongTensor([tokenize(model, ps)]).to(model.device)
+            ref_s = pack[len(ps) - 1].to(model.device)
+            start = time.perf_counter()
+            reference, _ = eager(input_ids, ref_s, speed)
+            eager_s = time.perf_counter() - start
+            start = time.perf_counter()
+            audio, _ = forward(input_ids, ref_s, speed)
+            backend_s = time.perf_counter() - start
+            reference = reference.squeeze().cpu().numpy()
+            audio = audio.squeeze().cpu().numpy()
+            report.append({
+                "phonemes": len(ps),
+                "samples": len(audio),
+                "reference_samples": len(reference),
+                "eager_s": eager_s,
+                "backend_s": backend_s,
+                "envelope_error": envelope_error(reference, audio),
+            })
+    return report
+
+
+def apply_backend(pipeline, backend, directory=None, voice=WARMUP_VOICE):
+    """
+    Switch the pipeline's model to backend, then warm it up and check it against eager.
+    """
+    pipeline.backend = backend
+    if backend == "eager" or pipeline.model is None:
+        return pipeline
+    model = pipeline.model
+    eager = model.forward_with_tokens
+    forward = backend_forward(model, pipeline.repo_id, backend, directory)
+    report = compare_backend(model, eager, forward, pipeline.load_voice(voice))
+    # The first calls compile or load, the last one shows the speed
+    speedup = report[-1]["eager_s"] / max(report[-1]["backend_s"], 1e-9)
+    worst = max(r["envelope_error"] for r in report)
+    mismatched = sum(r["samples"] != r["reference_samples"] for r in report)
+    print(f"{backend} backend ready: {speedup:.1f}x eager speed, envelope error up to {worst:.3f}"
+          + (f", {mismatched} utterances of a different length" if mismatched else ""))
+    if worst > MAX_ENVELOPE_ERROR:
+        print(f"Warning: the {backend} backend diverges from eager output (envelope error {worst:.3f})")
+    model.forward_with_tokens = forward
+    return pipeline
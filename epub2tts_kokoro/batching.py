@@ -0,0 +1,168 @@
+"""
+Batched inference for the Kokoro model.
+
+KModel.forward_with_tokens only handles a single utterance, so this module
+re-runs the same layers on a padded batch: recurrent layers get packed
+sequences, the duration alignment is built per utterance and the decoded
+audio is cut back to each utterance's own length.
+"""
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+
+def tokenize(model, phonemes):
+    input_ids = [i for i in (model.vocab.get(p) for p in phonemes) if i is not None]
+    assert len(input_ids) + 2 <= model.context_length, (len(input_ids) + 2, model.context_length)
+    return [0, *input_ids, 0]
+
+
+def _packed_lstm(lstm, x, lengths, total_length):
+    packed = pack_padded_sequence(x, lengths.cpu(), batch_first=True, enforce_sorted=False)
+    lstm.flatten_parameters()
+    x, _ = lstm(packed)
+    x, _ = pad_packed_sequence(x, batch_first=True, total_length=total_length)
+    return x
+
+
+@torch.no_grad()
+def forward_batch(model, phonemes, ref_s, speed=1):
+    """
+    Run a batch of phoneme strings through the model.
+
+    Args:
+        model: kokoro.KModel
+        phonemes: list of phoneme strings.
+        ref_s: voice style vectors, one (1, 256) row per phoneme string.
+        speed: reading speed shared by the whole batch.
+
+    Returns:
+        list of float32 numpy arrays, one per phoneme string.
+    """
+    device = model.device
+    tokens = [tokenize(model, ps) for ps in phonemes]
+    batch = len(tokens)
+    input_lengths = torch.tensor([len(t) for t in tokens], dtype=torch.long, device=device)
+    max_tokens = int(input_lengths.max())
+    input_ids = torch.zeros((batch, max_tokens), dtype=torch.long, device=device)
+    for i, t in enumerate(tokens):
+        input_ids[i, :len(t)] = torch.tensor(t, dtype=torch.long, device=device)
+    ref_s = torch.cat([r.reshape(1, -1) for r in ref_s]).to(device)
+
+    text_mask = torch.arange(max_tokens, device=device).unsqueeze(0).expand(batch, -1)
+    text_mask = torch.gt(text_mask + 1, input_lengths.unsqueeze(1))
+    bert_dur = model.bert(input_ids, attention_mask=(~text_mask).int())
+    d_en = model.bert_encoder(bert_dur).transpose(-1, -2)
+    s = ref_s[:, 128:]
+    d = model.predictor.text_encoder(d_en, s, input_lengths, text_mask)
+    x = _packed_lstm(model.predictor.lstm, d, input_lengths, max_tokens)
+    duration = model.predictor.duration_proj(x)
+    duration = torch.sigmoid(duration).sum(axis=-1) / speed
+    pred_dur = torch.round(duration).clamp(min=1).long()
+    pred_dur = pred_dur.masked_fill(text_mask, 0)
+
+    # Per-utterance alignment, zero-padded to the longest utterance
+    frame_lengths = pred_dur.sum(axis=-1)
+    max_frames = int(frame_lengths.max())
+    pred_aln_trg = torch.zeros((batch, max_tokens, max_frames), device=device)
+    for i in range(batch):
+        indices = torch.repeat_interleave(torch.arange(max_tokens, device=device), pred_dur[i])
+        pred_aln_trg[i, indices, torch.arange(indices.shape[0], device=device)] = 1
+    en = d.transpose(-1, -2) @ pred_aln_trg
+
+    # Same as ProsodyPredictor.F0Ntrain, with the shared LSTM packed
+    shared = _packed_lstm(model.predictor.shared, en.transpose(-1, -2), frame_lengths, max_frames)
+    F0 = shared.transpose(-1, -2)
+    for block in model.predictor.F0:
+        F0 = block(F0, s)
+    F0_pred = model.predictor.F0_proj(F0).squeeze(1)
+    N = shared.transpose(-1, -2)
+    for block in model.predictor.N:
+        N = block(N, s)
+    N_pred = model.predictor.N_proj(N).squeeze(1)
+
+    t_en = model.text_encoder(input_ids, input_lengths, text_mask)
+    asr = t_en @ pred_aln_trg
+    audio = model.decoder(asr, F0_pred, N_pred, ref_s[:, :128]).reshape(batch, -1)
+
+    samples_per_frame = audio.shape[-1] // max_frames
+    audio = audio.cpu().numpy().astype(np.float32)
+    return [audio[i, :int(frame_lengths[i]) * samples_per_frame] for i in range(batch)]
+
+
+def length_buckets(phonemes, batch_size, max_padding=0.15):
+    """
+    Group phoneme strings of similar length into batches.
+
+    Padding changes the per-utterance normalization statistics in the
+    decoder, so a batch only takes strings within max_padding of its
+    shortest member.
+
+    Returns:
+        list of lists of indices into phonemes.
+    """
+    order = sorted(range(len(phonemes)), key=lambda i: len(phonemes[i]))
+    buckets = []
+    current = []
+    for i in order:
+        if current and (len(current) >= batch_size
+                        or len(phonemes[i]) > len(phonemes[current[0]]) * (1 + max_padding)):
+            buckets.append(current)
+            current = []
+        current.append(i)
+    if current:
+        buckets.append(current)
+    return buckets
+
+
+def synthesize(model, pack, phonemes, speed, batch_size):
+    """
+    Synthesize every phoneme string, batching strings of similar length.
+
+    Returns:
+        list of float32 numpy arrays in the same order as phonemes.
+    """
+    results = [None] * len(phonemes)
+    for bucket in length_buckets(phonemes, batch_size):
+        batch = [phonemes[i] for i in bucket]
+        ref_s = [pack[len(ps) - 1] for ps in batch]
+        for i, audio in zip(bucket, forward_batch(model, batch, ref_s, speed)):
+            results[i] = audio
+    return results
+
+
+def _envelope(audio, frame=600):
+    frames = len(audio) // frame
+    return np.sqrt(np.mean(audio[:frames * frame].reshape(frames, frame) ** 2, axis=1))
+
+
+def envelope_error(reference, audio):
+    # Relative distance between RMS envelopes, over the frames both have
+    ref_env = _envelope(reference)
+    env = _envelope(audio)
+    frames = min(len(ref_env), len(env))
+    return float(np.linalg.norm(env[:frames] - ref_env[:frames]) / max(np.linalg.norm(ref_env[:frames]), 1e-9))
+
+
+def compare_with_sequential(model, pack, phonemes, speed, batch_size):
+    """
+    Check batched output against one-at-a-time synthesis.
+
+    Kokoro's source module injects random noise, so two sequential runs are
+    not sample-identical either; segments are compared on length and on
+    their RMS envelope.
+
+    Returns:
+        list of dicts with the sample counts and relative envelope error per segment.
+    """
+    batched = synthesize(model, pack, phonemes, speed, batch_size)
+    report = []
+    for ps, audio in zip(phonemes, batched):
+        reference = model(ps, pack[len(ps) - 1], speed).numpy()
+        report.append({
+            "phonemes": len(ps),
+            "samples": len(audio),
+            "reference_samples": len(reference),
+            "envelope_error": envelope_error(reference, audio),
+        })
+    return report
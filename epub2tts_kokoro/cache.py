@@ -0,0 +1,142 @@
+"""
+Content-addressed cache of synthesized sentence audio.
+
+Entries are keyed by a hash of the normalized text and everything else that
+changes the audio (voice, speed, lang_code, model version) and stored as one
+.npy file each, so a cache directory can be shared between render hosts.
+Writes go to a temp file and are renamed into place; least recently used
+entries are evicted once the directory grows past its size cap.
+"""
+import functools
+import hashlib
+import importlib.metadata
+import os
+import tempfile
+
+import numpy as np
+
+
+def normalize_text(text):
+    return " ".join(text.split())
+
+
+@functools.lru_cache(maxsize=None)
+def kokoro_version():
+    try:
+        return importlib.metadata.version("kokoro")
+    except importlib.metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def model_version(pipeline):
+    # A DaemonClient reports the version the daemon runs
+    if hasattr(pipeline, "model_version"):
+        return pipeline.model_version
+    version = f"{getattr(pipeline, 'repo_id', 'kokoro')}@{kokoro_version()}"
+    # Backends other than eager only approximate its audio (see backends.py)
+    backend = getattr(pipeline, "backend", "eager")
+    return version if backend == "eager" else f"{version}+{backend}"
+
+
+class SynthesisCache:
+    def __init__(self, cache_dir, max_bytes=4096 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.hit_samples = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = self._disk_usage()
+
+    def key(self, text, voice, speed, pipeline):
+        fields = [normalize_text(text), voice, repr(float(speed)), pipeline.lang_code, model_version(pipeline)]
+        return hashlib.sha256("\x1f".join(fields).encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".npy")
+
+    def _entries(self):
+        for sub in os.scandir(self.cache_dir):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith(".npy"):
+                    yield entry
+
+    def _disk_usage(self):
+        size = 0
+        for entry in self._entries():
+            try:
+                size += entry.stat().st_size
+            except FileNotFoundError:
+                # evicted by another process sharing the cache
+                pass
+        return size
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            audio = np.load(path, allow_pickle=False)
+            # mtime doubles as the LRU timestamp
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.hit_samples += len(audio)
+        return audio
+
+    def put(self, key, audio):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, np.asarray(audio, dtype=np.float32), allow_pickle=False)
+        os.replace(tmp, path)
+        self.size += os.path.getsize(path)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        # Drop least recently used entries until we are 10% under the cap
+        entries = []
+        for entry in self._entries():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        self.size = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+    def take_stats(self):
+        # Hand counters over to another process's cache (see merge_stats) and reset them
+        stats = {"hits": self.hits, "misses": self.misses, "hit_samples": self.hit_samples}
+        self.hits = self.misses = self.hit_samples = 0
+        return stats
+
+    def merge_stats(self, stats):
+        self.hits += stats["hits"]
+        self.misses += stats["misses"]
+        self.hit_samples += stats["hit_samples"]
+
+    def report(self, sample_rate):
+        # other processes may have written to the cache too
+        self.size = self._disk_usage()
+        lookups = self.hits + self.misses
+        rate = 100 * self.hits / lookups if lookups else 0
+        return (f"Synthesis cache: {self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate), "
+                f"{self.hit_samples / sample_rate:.0f}s of audio reused, "
+                f"{self.size / (1024 * 1024):.0f}MB in {self.cache_dir}")
@@ -0,0 +1,146 @@
+"""
+Throughput calibration (--calibrate).
+
+How fast a book renders depends on torch threads, the number of synthesis
+processes, the batch size and, without segment packing, how sentences are
+chunked into segments, and the best values differ from host to host. Calibration renders a slice of
+the book under a grid of settings, one axis at a time starting from the
+best values found so far, and saves the fastest as this host's profile in
+~/.cache/epub2tts-kokoro/calibration.json. Later runs load it for every
+setting not given on the command line.
+"""
+import datetime
+import json
+import os
+import platform
+
+if __package__:
+    from .backends import cache_dir
+    from .manifest import atomic_write
+else:
+    from backends import cache_dir
+    from manifest import atomic_write
+
+# Chunking presets tried, as CHUNKING in epub2tts_kokoro.py: sentences under
+# min_words words are merged with the next one, longer than max_chars ones
+# are broken up at commas into parts of up to split_chars
+CHUNKINGS = [
+    {"min_words": 8, "max_chars": 500, "split_chars": 350},
+    {"min_words": 5, "max_chars": 300, "split_chars": 200},
+    {"min_words": 12, "max_chars": 700, "split_chars": 500},
+]
+
+BATCH_SIZES = [1, 4, 16]
+
+
+def calibration_path():
+    return os.path.join(cache_dir(), "calibration.json")
+
+
+def host_key(backend, packing=True):
+    # Profiles are per host and per backend, a faster backend moves the best settings. Without segment
+    # packing the chunking decides the model calls, so those runs get profiles of their own
+    return f"{platform.node()}/{backend}" + ("" if packing else "/no-packing")
+
+
+def _profiles():
+    try:
+        with open(calibration_path(), encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def load_calibration(backend, packing=True):
+    """
+    Saved profile for this host, backend and packing mode, or None. A
+    profile saved with a different CPU count (a resized VM, a copied home
+    directory) is ignored.
+    """
+    profile = _profiles().get(host_key(backend, packing))
+    if profile is None or profile.get("cpus") != os.cpu_count():
+        return None
+    return profile
+
+
+def save_calibration(backend, profile, packing=True):
+    profiles = _profiles()
+    profiles[host_key(backend, packing)] = dict(
+        profile,
+        cpus=os.cpu_count(),
+        created=datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+    )
+    os.makedirs(cache_dir(), exist_ok=True)
+    atomic_write(calibration_path(), json.dumps(profiles, indent=1, sort_keys=True).encode("utf-8"))
+
+
+def calibration_slice(texts, chars):
+    # Paragraphs spread evenly over the book up to chars characters, so it is not all front matter
+    total = sum(len(text) for text in texts)
+    stride = max(1, round(total / max(chars, 1)))
+    picked = []
+    size = 0
+    for text in texts[::stride]:
+        if size >= chars:
+            break
+        picked.append(text)
+        size += len(text)
+    return picked
+
+
+def process_grid(cpus, device):
+    # (workers, torch threads per worker); several processes only pay off on CPU
+    grid = []
+    for workers in [1, 2, 4] if device == "cpu" else [1]:
+        if workers > cpus:
+            continue
+        for threads in (cpus // workers, cpus // (2 * workers)):
+            if threads >= 1 and (workers, threads) not in grid:
+                grid.append((workers, threads))
+    return grid
+
+
+def axes(cpus, device, backend, packing=True):
+    """
+    The settings tried, as (name, values) pairs; each value is a dict of the
+    settings it changes. With segment packing, segments are packed back into
+    the same model calls whatever the chunking, so it is not searched.
+    """
+    result = [("processes", [{"workers": w, "threads": t} for w, t in process_grid(cpus, device)])]
+    # batched inference bypasses other backends (see backends.py)
+    if backend == "eager":
+        result.append(("batch size", [{"batch_size": b} for b in BATCH_SIZES]))
+    if not packing:
+        result.append(("chunking", [{"chunking": c} for c in CHUNKINGS]))
+    return result
+
+
+def search(measure, start, grid):
+    """
+    Tune one axis at a time, keeping the best value of each axis for the next.
+
+    measure(config) returns the audio seconds produced per wall second.
+
+    Returns:
+        tuple: (best config, its rate, list of (config, rate) for every run).
+    """
+    best = dict(start)
+    best_rate = None
+    runs = []
+    for name, values in grid:
+        for value in values:
+            config = dict(best, **value)
+            if any(config == c for c, _ in runs):
+                continue
+            rate = measure(config)
+            runs.append((config, rate))
+            print(f"  {name}: {describe(config)} -> {rate:.2f}s of audio per second")
+            if best_rate is None or rate > best_rate:
+                best, best_rate = config, rate
+    return best, best_rate, runs
+
+
+def describe(config):
+    chunking = config["chunking"]
+    return (f"{config['workers']} x {config['threads']} threads, batch {config['batch_size']}, "
+            f"chunks {chunking['min_words']} words/{chunking['max_chars']}/{chunking['split_chars']} chars")
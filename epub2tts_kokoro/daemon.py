@@ -0,0 +1,272 @@
+"""
+Warm synthesis daemon.
+
+Loading torch, the Kokoro model and voice packs dominates short jobs, so a
+long-running daemon keeps one pipeline per lang_code and every voice pack
+it has used resident, and serves synthesis requests on a Unix socket.
+epub2tts-kokoro, read.py and gen_samples.py use it when it is running and
+synthesize in-process when it is not.
+
+    python -m epub2tts_kokoro.daemon [--socket PATH] [--preload a,b] [--backend NAME]
+
+Messages are a 4-byte length, a JSON header and, for audio, float32
+samples whose sizes are listed in the header. With segment packing on,
+clients first ask how the segments of their paragraphs pack into model
+calls ("pack"), then send the calls they have no cached audio for as
+lists of segments ("segments").
+"""
+import argparse
+import json
+import os
+import socket
+import socketserver
+import struct
+import sys
+import tempfile
+import threading
+
+import numpy as np
+
+# Environment variable overriding the default socket path
+SOCKET_ENV = "EPUB2TTS_KOKORO_SOCKET"
+# Segments whose phonemes the daemon keeps between a "pack" and the "segments" request after it
+PHONEME_MEMO = 65536
+
+
+def socket_path():
+    if os.environ.get(SOCKET_ENV):
+        return os.environ[SOCKET_ENV]
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(runtime_dir, f"epub2tts-kokoro-{os.getuid()}.sock")
+
+
+def _read_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            raise ConnectionError("connection closed by the other side")
+        data += chunk
+    return bytes(data)
+
+
+def send_message(sock, header, audio=()):
+    audio = [np.asarray(a, dtype=np.float32) for a in audio]
+    header = dict(header, lengths=[len(a) for a in audio])
+    data = json.dumps(header).encode("utf-8")
+    sock.sendall(struct.pack("<I", len(data)) + data + b"".join(a.tobytes() for a in audio))
+
+
+def receive_message(sock):
+    size, = struct.unpack("<I", _read_exactly(sock, 4))
+    header = json.loads(_read_exactly(sock, size))
+    audio = []
+    for length in header.get("lengths", []):
+        audio.append(np.frombuffer(_read_exactly(sock, length * 4), dtype=np.float32))
+    return header, audio
+
+
+class DaemonError(RuntimeError):
+    pass
+
+
+class DaemonClient:
+    """
+    Connection to a running daemon, standing in for the KPipeline of one lang_code.
+    """
+    def __init__(self, sock, path, lang_code, info):
+        self.sock = sock
+        self.path = path
+        self.lang_code = lang_code
+        self.repo_id = info.get("repo_id", "kokoro")
+        self.backend = info.get("backend", "eager")
+        # for SynthesisCache keys, the daemon's kokoro may differ from the one installed here
+        self.model_version = f"{self.repo_id}@{info.get('kokoro', 'unknown')}"
+        if self.backend != "eager":
+            self.model_version += f"+{self.backend}"
+        self.lock = threading.Lock()
+
+    @classmethod
+    def connect(cls, lang_code, path=None):
+        """
+        Return a client if a daemon is listening, otherwise None.
+        """
+        path = path or socket_path()
+        if not hasattr(socket, "AF_UNIX") or not os.path.exists(path):
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            send_message(sock, {"op": "ping"})
+            info, _ = receive_message(sock)
+        except OSError:
+            sock.close()
+            return None
+        return cls(sock, path, lang_code, info)
+
+    def exchange(self, header):
+        with self.lock:
+            send_message(self.sock, dict(header, lang_code=self.lang_code))
+            reply, audio = receive_message(self.sock)
+        if not reply.get("ok"):
+            raise DaemonError(reply.get("error", "daemon request failed"))
+        return reply, audio
+
+    def request(self, header):
+        return self.exchange(header)[1]
+
+    def synthesize_text(self, text, voice, speed=1, split_pattern=r'\n+'):
+        # Same as joining the audio of KPipeline.__call__
+        audio = self.request({"op": "text", "text": text, "voice": voice, "speed": speed,
+                              "split_pattern": split_pattern})
+        return audio[0]
+
+    def pack(self, paragraphs, voice):
+        # How the segments of each paragraph share model calls, as (start, end) ranges (see pack_groups)
+        reply, _ = self.exchange({"op": "pack", "paragraphs": paragraphs, "voice": voice})
+        return [[tuple(group) for group in groups] for groups in reply["calls"]]
+
+    def synthesize_segments(self, segments, voice, speed=1, batch_size=1):
+        # Raw audio, one array per segment, as synth_sentence gives it: not trimmed whatever the batch size.
+        # A segment given as a list of segments is one packed call.
+        return self.request({"op": "segments", "segments": segments, "voice": voice, "speed": speed,
+                             "batch_size": batch_size})
+
+    def close(self):
+        self.sock.close()
+
+
+def _synthesis_module():
+    # Only the daemon side needs torch and Kokoro, clients get by with this file
+    if __package__:
+        from . import epub2tts_kokoro
+    else:
+        import epub2tts_kokoro
+    return epub2tts_kokoro
+
+
+class SynthesisDaemon:
+    def __init__(self, backend="eager"):
+        self.backend = backend
+        self.pipelines = {}
+        self.phoneme_memo = {}
+        self.lock = threading.Lock()
+
+    def pipeline(self, lang_code):
+        if lang_code not in self.pipelines:
+            self.pipelines[lang_code] = e2t.load_pipeline(lang_code, backend=self.backend)
+        return self.pipelines[lang_code]
+
+    def info(self):
+        repo_ids = [getattr(p, "repo_id", "kokoro") for p in self.pipelines.values()]
+        return {"ok": True, "pid": os.getpid(), "repo_id": repo_ids[0] if repo_ids else "kokoro",
+                "kokoro": e2t.kokoro_version(), "backend": self.backend, "lang_codes": sorted(self.pipelines)}
+
+    def voice(self, pipeline, voice):
+        # Keep the pack on the model's device so KPipeline does not copy it for every call
+        pack = pipeline.load_voice(voice)
+        if pipeline.model is not None:
+            pipeline.voices[voice] = pack.to(pipeline.model.device)
+
+    def phonemes(self, pipeline, text):
+        key = (pipeline.lang_code, text)
+        if key not in self.phoneme_memo:
+            if len(self.phoneme_memo) >= PHONEME_MEMO:
+                self.phoneme_memo.clear()
+            self.phoneme_memo[key] = e2t.phonemize(pipeline, text)
+        return self.phoneme_memo[key]
+
+    def call_phonemes(self, pipeline, segment):
+        # What the model reads for a segment, or for a packed call given as its list of segments
+        if isinstance(segment, str):
+            return self.phonemes(pipeline, segment)
+        calls = e2t.pack_segments(segment, [self.phonemes(pipeline, s) for s in segment])
+        return [ps for _, phonemes in calls for ps in phonemes]
+
+    def handle(self, request):
+        op = request["op"]
+        if op == "ping":
+            return self.info(), []
+        # One synthesis at a time, the model is shared by all connections
+        with self.lock:
+            pipeline = self.pipeline(request["lang_code"])
+            self.voice(pipeline, request["voice"])
+            if op == "text":
+                audio = [np.asarray(audio, dtype=np.float32) for _, _, audio in pipeline(
+                    request["text"], voice=request["voice"], speed=request["speed"],
+                    split_pattern=request["split_pattern"]) if audio is not None]
+                return {"ok": True}, [e2t.join_audio(audio)]
+            if op == "pack":
+                calls = [e2t.pack_groups([self.phonemes(pipeline, s) for s in paragraph])
+                         for paragraph in request["paragraphs"]]
+                return {"ok": True, "calls": calls}, []
+            if op == "segments":
+                # Raw audio per segment whatever the batch size: the client trims and joins it
+                phonemes = [self.call_phonemes(pipeline, s) for s in request["segments"]]
+                # batched inference runs the model's layers itself, bypassing other backends
+                batch_size = request.get("batch_size", 1) if self.backend == "eager" else 1
+                audio = e2t.synth_phoneme_calls(phonemes, request["voice"], pipeline, request["speed"], batch_size)
+                return {"ok": True}, audio
+        return {"ok": False, "error": f"unknown op {op}"}, []
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                request, _ = receive_message(self.request)
+            except (ConnectionError, OSError):
+                return
+            try:
+                reply, audio = self.server.daemon.handle(request)
+            except Exception as e:
+                reply, audio = {"ok": False, "error": f"{type(e).__name__}: {e}"}, []
+            send_message(self.request, reply, audio)
+
+
+def main():
+    global e2t
+    e2t = _synthesis_module()
+    parser = argparse.ArgumentParser(
+        prog="epub2tts-kokoro-daemon",
+        description="Keep Kokoro loaded and serve synthesis requests on a Unix socket",
+    )
+    parser.add_argument("--socket", type=str, default=socket_path(),
+                        help=f"Socket path (default: ${SOCKET_ENV} or {socket_path()})")
+    parser.add_argument("--preload", type=str, default="a",
+                        help="Comma-separated lang_codes to load at startup (default: a)")
+    parser.add_argument("--backend", type=str, default="eager", choices=e2t.BACKENDS,
+                        help="Inference backend (default: eager)")
+    args = parser.parse_args()
+
+    if DaemonClient.connect("a", args.socket):
+        print(f"A daemon is already listening on {args.socket}")
+        sys.exit(1)
+    if os.path.exists(args.socket):
+        # left behind by a daemon that did not shut down cleanly
+        os.remove(args.socket)
+
+    e2t.set_default_device()
+    daemon = SynthesisDaemon(args.backend)
+    for lang_code in filter(None, args.preload.split(",")):
+        daemon.pipeline(lang_code)
+
+    server = socketserver.ThreadingUnixStreamServer(args.socket, _Handler)
+    server.daemon_threads = True
+    server.daemon = daemon
+    os.chmod(args.socket, 0o600)
+    print(f"Listening on {args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+
+# epub2tts_kokoro module, imported by main()
+e2t = None
+
+if __name__ == "__main__":
+    main()
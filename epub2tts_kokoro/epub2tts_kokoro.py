@@ -4,50 +4,297 @@ import sys
 if sys.platform == 'darwin':
     os.environ['PYTORCH_ENABLE_MPS_FALLBACK'] = '1'
 import argparse
+import collections
+import contextlib
+import functools
+import importlib.metadata
+import io
+import itertools
+import multiprocessing
 import numpy as np
 import re
+import shutil
 import soundfile
 import subprocess
-import torch
-import warnings
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from tqdm import tqdm
-from kokoro import KPipeline
 
-from bs4 import BeautifulSoup
-import ebooklib
-from ebooklib import epub
+# torch, Kokoro, NLTK, BeautifulSoup, PIL, pydub and mutagen are imported
+# where they are used, so --help and EPUB export do not pay for loading the model stack
+if __package__:
+    from .backends import BACKENDS, apply_backend, backend_version
+    from .calibrate import (axes, calibration_path, calibration_slice, describe, load_calibration,
+                            save_calibration, search)
+    from .cache import SynthesisCache, kokoro_version
+    from .daemon import DaemonClient
+    from .epubreader import EpubReader, image_extension
+    from .g2p import PhonemeStage, phonemize
+    from .library import library_books, render_library
+    from .manifest import SPOOL_BLOCK, JobManifest, WorkdirLocked, job_settings, job_workdir
+    from .metrics import CharacterETA, Metrics
+    from .plan import load_plan, plan_path, plan_summary, save_plan
+    from .postprocess import join_segments, loudness_gain
+    from .serve import BookStream, start_server
+    from .stages import StagePipeline
+    from .workqueue import coordinate
+else:
+    # Run as a script (as the Docker images do), not as part of the package
+    from backends import BACKENDS, apply_backend, backend_version
+    from calibrate import (axes, calibration_path, calibration_slice, describe, load_calibration,
+                           save_calibration, search)
+    from cache import SynthesisCache, kokoro_version
+    from daemon import DaemonClient
+    from epubreader import EpubReader, image_extension
+    from g2p import PhonemeStage, phonemize
+    from library import library_books, render_library
+    from manifest import SPOOL_BLOCK, JobManifest, WorkdirLocked, job_settings, job_workdir
+    from metrics import CharacterETA, Metrics
+    from plan import load_plan, plan_path, plan_summary, save_plan
+    from postprocess import join_segments, loudness_gain
+    from serve import BookStream, start_server
+    from stages import StagePipeline
+    from workqueue import coordinate
+
 import soundfile as sf
 from lxml import etree
-from mutagen import mp4
-import nltk
-from nltk.tokenize import sent_tokenize
-from PIL import Image
-from pydub import AudioSegment
-import zipfile
-
 
-namespaces = {
-   "calibre":"http://calibre.kovidgoyal.net/2009/metadata",
-   "dc":"http://purl.org/dc/elements/1.1/",
-   "dcterms":"http://purl.org/dc/terms/",
-   "opf":"http://www.idpf.org/2007/opf",
-   "u":"urn:oasis:names:tc:opendocument:xmlns:container",
-   "xsi":"http://www.w3.org/2001/XMLSchema-instance",
-}
+# Kokoro always produces 24kHz mono float32 audio
+SAMPLE_RATE = 24000
+# Characters of text batched together per step of synthesize_texts
+BATCH_WINDOW_CHARS = 4000
+# Smaller books are exported in-process, a pool is not worth starting for them
+EXPORT_POOL_MIN_CHAPTERS = 32
+# Chapters AAC-encoded at the same time (each ffmpeg encode is single threaded)
+ENCODE_JOBS = max(1, min(4, (os.cpu_count() or 1) // 2))
+# Sentence chunking: sentences under min_words words are merged with the next one,
+# segments over max_chars are broken up at commas into parts of up to split_chars.
+# A calibrated profile may change it (see calibrate.py).
+DEFAULT_CHUNKING = {"min_words": 8, "max_chars": 500, "split_chars": 350}
+CHUNKING = dict(DEFAULT_CHUNKING)
+# Trim segments, join them with even pauses and normalize chapter loudness (see postprocess.py)
+POSTPROCESS = True
+# Phonemes Kokoro reads per call: its context is 512 tokens, with a start and an end token
+PHONEME_BUDGET = 510
+# Pack the segments of a paragraph into model calls of up to PHONEME_BUDGET phonemes (see pack_segments)
+PACKING = True
 
-warnings.filterwarnings("ignore", module="ebooklib.epub")
+# Set by load_pipeline, tests and benchmarks may swap in a stand-in first
+KPipeline = None
 
 def ensure_punkt():
+    # Offline check only: downloading is left to the install step (see README)
+    import nltk
+    missing = []
+    for resource in ["punkt", "punkt_tab"]:
+        try:
+            nltk.data.find(f"tokenizers/{resource}")
+        except LookupError:
+            missing.append(resource)
+    if missing:
+        print(f"NLTK tokenizer data not found: {', '.join(missing)}. Install it with:")
+        print(f"    python -m nltk.downloader {' '.join(missing)}")
+        sys.exit(1)
+
+def segmenter_version():
+    # Read from the package metadata, which is much cheaper than importing NLTK
     try:
-        nltk.data.find("tokenizers/punkt")
-    except LookupError:
-        nltk.download("punkt")
+        version = f"nltk-{importlib.metadata.version('nltk')}"
+    except importlib.metadata.PackageNotFoundError:
+        import nltk
+        version = f"nltk-{nltk.__version__}"
+    # Plans chunked another way are rebuilt
+    if CHUNKING != DEFAULT_CHUNKING:
+        version += "/{min_words}w-{max_chars}-{split_chars}".format(**CHUNKING)
+    return version
+
+def toc_titles(toc):
+    # href (without fragment) -> title, first entry wins like a scan of the TOC would
+    index = {}
+    for toc_item in toc or []:
+        if hasattr(toc_item, "href"):
+            index.setdefault(toc_item.href.split('#')[0], toc_item.title)
+    return index
+
+@functools.lru_cache(maxsize=None)
+def soup_tags():
+    """
+    Tags whose strings BeautifulSoup leaves out of .text (script, style, rt, ...)
+    and tags inside which it keeps whitespace as is.
+    """
+    from bs4.builder import HTMLParserTreeBuilder
+    return (frozenset(HTMLParserTreeBuilder.DEFAULT_STRING_CONTAINERS),
+            frozenset(HTMLParserTreeBuilder.DEFAULT_PRESERVE_WHITESPACE_TAGS))
+
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+# html.parser decodes these numeric character references differently from an XML parser
+HTML_CHARREF = re.compile(rb'&#([xX][0-9a-fA-F]+|[0-9]+);')
+XML_UTF8_DECLARATION = re.compile(rb'\s*<\?xml[^>]*encoding=["\']utf-?8["\']', re.IGNORECASE)
+
+def _xhtml_tree(chap):
+    """
+    Parse chapter XHTML with lxml when that yields exactly the tree html.parser
+    would build, otherwise return None so the caller uses BeautifulSoup.
+    """
+    if not isinstance(chap, bytes) or b"\r" in chap or b"<![CDATA[" in chap:
+        return None
+    if not (chap.isascii() or XML_UTF8_DECLARATION.match(chap)):
+        return None
+    for ref in HTML_CHARREF.findall(chap):
+        codepoint = int(ref[1:], 16) if ref[:1] in b"xX" else int(ref)
+        if 0x7f <= codepoint <= 0x9f or 0xfdd0 <= codepoint <= 0xfdef or codepoint & 0xfffe == 0xfffe:
+            return None
     try:
-        nltk.data.find("tokenizers/punkt_tab")
-    except LookupError:
-        nltk.download("punkt_tab")
+        root = etree.fromstring(chap, etree.XMLParser(resolve_entities=False, huge_tree=True))
+    except etree.XMLSyntaxError:
+        return None
+    for el in root.iter("{*}script", "{*}style", "script", "style"):
+        # html.parser keeps their content as raw text, XML parses it
+        if len(el):
+            return None
+    return root
+
+def _tag_name(el):
+    # Qualified name as html.parser reports it, or None for comments and PIs
+    tag = el.tag
+    if not isinstance(tag, str):
+        return None
+    if tag[0] == "{":
+        tag = tag[tag.index("}") + 1:]
+        if el.prefix:
+            tag = f"{el.prefix}:{tag}"
+    return tag.lower()
+
+def _attribute(el, name):
+    for key, value in el.attrib.items():
+        if key.lower() == name:
+            return value
+    return None
+
+def _soup_string(text, preserve):
+    # BeautifulSoup turns whitespace-only strings into one space or newline
+    if preserve or text.strip(ASCII_SPACES):
+        return text
+    return "\n" if "\n" in text else " "
+
+def _element_text(el, removed=(), context=(False, False)):
+    # Same strings as BeautifulSoup's .text / .strings, skipping removed subtrees
+    string_containers, preserve_whitespace = soup_tags()
+    parts = []
+    def walk(node, hidden, preserve):
+        name = _tag_name(node)
+        hidden = hidden or name in string_containers
+        preserve = preserve or name in preserve_whitespace
+        if node.text and not hidden:
+            parts.append(_soup_string(node.text, preserve))
+        for child in node:
+            if isinstance(child.tag, str) and child not in removed:
+                walk(child, hidden, preserve)
+            if child.tail and not hidden:
+                parts.append(_soup_string(child.tail, preserve))
+    walk(el, *context)
+    return "".join(parts)
 
-def chap2text_epub(chap, item_id=None, toc=None):
+def _chap2text_lxml(root, item_id, toc_index):
+    """
+    Single-pass lxml version of chap2text_epub for well-formed XHTML.
+
+    Returns None where the result could differ from the BeautifulSoup path.
+    """
+    string_containers, preserve_whitespace = soup_tags()
+    headings = {}
+    classed = {}
+    anchors = []
+    sups = []
+    paragraphs = []
+    divs = []
+    common_classes = ['chapter', 'chapter-title', 'title', 'heading']
+    for el in root.iter():
+        name = _tag_name(el)
+        if name is None:
+            continue
+        if name in ('h1', 'h2', 'h3'):
+            headings.setdefault(name, el)
+        classes = _attribute(el, "class")
+        if classes is not None:
+            for class_name in common_classes:
+                if class_name not in classed and (class_name in classes.split() or classes == class_name):
+                    classed[class_name] = el
+        if name == 'a' and _attribute(el, "href") is not None:
+            anchors.append(el)
+        elif name == 'sup':
+            sups.append(el)
+        elif name == 'p':
+            paragraphs.append(el)
+        elif name == 'div':
+            divs.append(el)
+
+    def context(el):
+        # (inside a string container, inside a whitespace preserving tag) from the ancestors
+        hidden = preserve = False
+        for ancestor in el.iterancestors():
+            name = _tag_name(ancestor)
+            hidden = hidden or name in string_containers
+            preserve = preserve or name in preserve_whitespace
+        return hidden, preserve
+
+    def is_removed(el, removed):
+        return el in removed or any(ancestor in removed for ancestor in el.iterancestors())
+
+    chapter_title_text = None
+    for tag in ['h1', 'h2', 'h3']:
+        heading = headings.get(tag)
+        if heading is not None:
+            text = _element_text(heading, context=context(heading)).strip()
+            if text:
+                chapter_title_text = text
+                print(f"Found title in <{tag}>: '{chapter_title_text}'")
+                break
+
+    if not chapter_title_text:
+        for class_name in common_classes:
+            element = classed.get(class_name)
+            if element is not None:
+                if _tag_name(element) in string_containers:
+                    return None
+                text = _element_text(element, context=context(element)).strip()
+                if text:
+                    chapter_title_text = text
+                    print(f"Found title in class '{class_name}': '{chapter_title_text}'")
+                    break
+
+    if not chapter_title_text and toc_index and item_id and item_id in toc_index:
+        chapter_title_text = toc_index[item_id]
+        print(f"Found title in TOC for item '{item_id}': '{chapter_title_text}'")
+
+    if not chapter_title_text:
+        chapter_title_text = item_id.replace('.xhtml', '').replace('_', ' ').title() if item_id else None
+        print(f"No title found, using fallback: '{chapter_title_text}'")
+
+    # Footnote links and superscript numbers are skipped rather than extracted
+    removed = set()
+    for a in anchors:
+        if is_removed(a, removed):
+            continue
+        if not any(char.isalpha() for char in _element_text(a, removed, context(a))):
+            removed.add(a)
+    for sup in sups:
+        if not is_removed(sup, removed) and _element_text(sup, removed, context(sup)).isdigit():
+            removed.add(sup)
+
+    chapter_paragraphs = [p for p in paragraphs if not is_removed(p, removed)]
+    if not chapter_paragraphs:
+        print(f"No <p> tags found in '{chapter_title_text or item_id}'. Trying <div>.")
+        chapter_paragraphs = [div for div in divs if not is_removed(div, removed)]
+
+    results = []
+    for p in chapter_paragraphs:
+        paragraph_text = _element_text(p, removed, context(p)).strip()
+        if paragraph_text:
+            results.append(paragraph_text)
+    return chapter_title_text, results
+
+def chap2text_epub(chap, item_id=None, toc=None, toc_index=None, fast=True):
     """
     Extract chapter title and paragraphs from an EPUB chapter.
     
@@ -55,10 +302,22 @@ def chap2text_epub(chap, item_id=None, toc=None):
         chap: The chapter content (HTML).
         item_id: The ID of the item in the EPUB spine (for fallback naming).
         toc: The EPUB's table of contents (for fallback title extraction).
+        toc_index: toc_titles(toc), precomputed once per book.
+        fast: Use the lxml walk for well-formed XHTML. Output is the same
+            as the BeautifulSoup path, which is used for everything else.
     
     Returns:
         tuple: (chapter_title_text, paragraphs)
     """
+    if toc_index is None:
+        toc_index = toc_titles(toc)
+    if fast:
+        root = _xhtml_tree(chap)
+        if root is not None:
+            result = _chap2text_lxml(root, item_id, toc_index)
+            if result is not None:
+                return result
+
     blacklist = [
         "[document]",
         "noscript",
@@ -70,6 +329,7 @@ def chap2text_epub(chap, item_id=None, toc=None):
         "script",
     ]
     paragraphs = []
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(chap, "html.parser")
 
     # Step 1: Try to find chapter title in heading tags (<h1>, <h2>, <h3>)
@@ -93,12 +353,9 @@ def chap2text_epub(chap, item_id=None, toc=None):
                 break
 
     # Step 3: Fallback to TOC if provided
-    if not chapter_title_text and toc and item_id:
-        for toc_item in toc:
-            if toc_item.href.split('#')[0] == item_id:
-                chapter_title_text = toc_item.title
-                print(f"Found title in TOC for item '{item_id}': '{chapter_title_text}'")
-                break
+    if not chapter_title_text and toc_index and item_id and item_id in toc_index:
+        chapter_title_text = toc_index[item_id]
+        print(f"Found title in TOC for item '{item_id}': '{chapter_title_text}'")
 
     # Step 4: Fallback to item ID or generic name
     if not chapter_title_text:
@@ -128,136 +385,219 @@ def chap2text_epub(chap, item_id=None, toc=None):
 
     return chapter_title_text, paragraphs
 
-def get_epub_cover(epub_path):
+def _export_chapter(job):
+    # Runs in the export pool; log lines are handed back so they print in order
+    content, item_id, toc_index, fast = job
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        chapter_title, chapter_paragraphs = chap2text_epub(content, item_id=item_id, toc_index=toc_index, fast=fast)
+    return chapter_title, chapter_paragraphs, log.getvalue()
+
+def _export_results(executor, jobs, window):
+    # executor.map would submit, and so hold, every chapter at once
+    pending = collections.deque()
+    for job in jobs:
+        pending.append(executor.submit(_export_chapter, job))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def export_lines(book, workers=None, fast=True, log=None):
+    """
+    Lines of the text export of an open EpubReader, yielded as its chapters
+    are extracted. Chapter logs go to log(text), printed by default.
+    """
+    # The ebooklib book this used to get had no get_toc, so titles never came
+    # from the TOC; that stays so exported text does not change
+    toc_index = toc_titles([])
+
+    # Chapters are decompressed one at a time as the parser gets to them
+    jobs = ((content, id, toc_index, fast) for id, content in book.documents())
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(book.document_ids()) >= EXPORT_POOL_MIN_CHAPTERS:
+        # Default start method: unlike synthesis, nothing here touches torch
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = _export_results(executor, jobs, 4 * workers)
+    else:
+        executor = None
+        results = map(_export_chapter, jobs)
+
+    author = book.metadata["creator"] or "Unknown"
+    booktitle = book.metadata["title"] or os.path.basename(book.zip.filename).replace(".epub", "")
+    yield f"Title: {booktitle}\n"
+    yield f"Author: {author}\n\n"
+    yield f"# Title\n"
+    yield f"{booktitle}, by {author}\n\n"
     try:
-        with zipfile.ZipFile(epub_path) as z:
-            t = etree.fromstring(z.read("META-INF/container.xml"))
-            rootfile_path =  t.xpath("/u:container/u:rootfiles/u:rootfile",
-                                        namespaces=namespaces)[0].get("full-path")
-
-            t = etree.fromstring(z.read(rootfile_path))
-            cover_meta = t.xpath("//opf:metadata/opf:meta[@name='cover']",
-                                        namespaces=namespaces)
-            if not cover_meta:
-                print("No cover image found.")
-                return None
-            cover_id = cover_meta[0].get("content")
-
-            cover_item = t.xpath("//opf:manifest/opf:item[@id='" + cover_id + "']",
-                                            namespaces=namespaces)
-            if not cover_item:
-                print("No cover image found.")
-                return None
-            cover_href = cover_item[0].get("href")
-            cover_path = os.path.join(os.path.dirname(rootfile_path), cover_href)
-            if os.name == 'nt' and '\\' in cover_path:
-                cover_path = cover_path.replace("\\", "/")
-            return z.open(cover_path)
-    except FileNotFoundError:
-        print(f"Could not get cover image of {epub_path}")
-
-def export(book, sourcefile):
-    book_contents = []
-    cover_image = get_epub_cover(sourcefile)
-    image_path = None
-
-    if cover_image is not None:
-        image = Image.open(cover_image)
-        image_filename = sourcefile.replace(".epub", ".png")
-        image_path = os.path.join(image_filename)
-        image.save(image_path)
-        print(f"Cover image saved to {image_path}")
-
-    # Get the table of contents
-    toc = book.get_toc() if hasattr(book, 'get_toc') else []
-
-    spine_ids = [spine_tuple[0] for spine_tuple in book.spine if spine_tuple[1] == 'yes']
-    items = {item.get_id(): item for item in book.get_items() if item.get_type() == ebooklib.ITEM_DOCUMENT}
-
-    for id in spine_ids:
-        item = items.get(id)
-        if item is None:
-            continue
-        # Pass item_id and toc to chap2text_epub
-        chapter_title, chapter_paragraphs = chap2text_epub(item.get_content(), item_id=id, toc=toc)
-        book_contents.append({"title": chapter_title, "paragraphs": chapter_paragraphs})
+        for i, (chapter_title, chapter_paragraphs, chapter_log) in enumerate(results, start=1):
+            if chapter_log:
+                (log or functools.partial(print, end=""))(chapter_log)
+            if not chapter_paragraphs or chapter_paragraphs == ['']:
+                continue
+            # Use chapter title if available, otherwise fallback to "Part {i}"
+            title = chapter_title if chapter_title else f"Part {i}"
+            yield f"# {title}\n\n"
+            for paragraph in chapter_paragraphs:
+                yield f"{clean_paragraph(paragraph)}\n\n"
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
 
+def export(sourcefile, workers=None, fast=True):
     outfile = sourcefile.replace(".epub", ".txt")
     check_for_file(outfile)
-    print(f"Exporting {sourcefile} to {outfile}")
-    author = book.get_metadata("DC", "creator")[0][0]
-    booktitle = book.get_metadata("DC", "title")[0][0]
-
-    with open(outfile, "w", encoding='utf-8') as file:
-        file.write(f"Title: {booktitle}\n")
-        file.write(f"Author: {author}\n\n")
-        file.write(f"# Title\n")
-        file.write(f"{booktitle}, by {author}\n\n")
-        for i, chapter in enumerate(book_contents, start=1):
-            if not chapter["paragraphs"] or chapter["paragraphs"] == ['']:
-                continue
+    with EpubReader(sourcefile) as book:
+        image_path = book.save_cover(sourcefile.replace(".epub", ""))
+        if image_path:
+            print(f"Cover image saved to {image_path}")
+        else:
+            print("No cover image found.")
+        print(f"Exporting {sourcefile} to {outfile}")
+        # Written as chapters come in, renamed into place once complete
+        with open(outfile + ".tmp", "w", encoding='utf-8') as file:
+            for line in export_lines(book, workers, fast):
+                file.write(line)
+    os.replace(outfile + ".tmp", outfile)
+
+WHITESPACE_RUN = re.compile(r'[\s\n]+')
+CURLY_DOUBLE_QUOTES = re.compile(r'[“”]')
+CURLY_SINGLE_QUOTES = re.compile(r'[‘’]')
+DOUBLE_DASH = re.compile(r'--')
+
+def clean_paragraph(paragraph):
+    clean = WHITESPACE_RUN.sub(' ', paragraph)
+    clean = CURLY_DOUBLE_QUOTES.sub('"', clean)  # Curly double quotes to standard double quotes
+    clean = CURLY_SINGLE_QUOTES.sub("'", clean)  # Curly single quotes to standard single quotes
+    clean = DOUBLE_DASH.sub(', ', clean)
+    return clean
+
+def parse_book(lines, book):
+    """
+    Chapters of a book in the text export format, each yielded as soon as
+    the next one starts. The title, author and chapter_titles found along
+    the way are stored in the book dict.
+    """
+    from nltk.tokenize import sent_tokenize
+    chapter_titles = book.setdefault("chapter_titles", [])
+    current_chapter = {"title": "blank", "paragraphs": []}
+    initialized_first_chapter = False
+    lines_skipped = 0
+    for line in lines:
+
+        if lines_skipped < 2 and (line.startswith("Title") or line.startswith("Author")):
+            lines_skipped += 1
+            if line.startswith('Title: '):
+                book["title"] = line.replace('Title: ', '').strip()
+            elif line.startswith('Author: '):
+                book["author"] = line.replace('Author: ', '').strip()
+            continue
+
+        line = line.strip()
+        if line.startswith("#"):
+            if current_chapter["paragraphs"] or not initialized_first_chapter:
+                if initialized_first_chapter:
+                    yield current_chapter
+                current_chapter = {"title": None, "paragraphs": []}
+                initialized_first_chapter = True
+            chapter_title = line[1:].strip()
+            if any(c.isalnum() for c in chapter_title):
+                current_chapter["title"] = chapter_title
+                chapter_titles.append(current_chapter["title"])
             else:
-                # Use chapter title if available, otherwise fallback to "Part {i}"
-                title = chapter["title"] if chapter["title"] else f"Part {i}"
-                file.write(f"# {title}\n\n")
-                for paragraph in chapter["paragraphs"]:
-                    clean = re.sub(r'[\s\n]+', ' ', paragraph)
-                    clean = re.sub(r'[“”]', '"', clean)  # Curly double quotes to standard double quotes
-                    clean = re.sub(r'[‘’]', "'", clean)  # Curly single quotes to standard single quotes
-                    clean = re.sub(r'--', ', ', clean)
-                    file.write(f"{clean}\n\n")
-
-    return book_contents
+                current_chapter["title"] = "blank"
+                chapter_titles.append("blank")
+            current_chapter["title_segments"] = segment_text(current_chapter["title"] + ".")
+        elif line:
+            if not initialized_first_chapter:
+                chapter_titles.append("blank")
+                initialized_first_chapter = True
+            if any(char.isalnum() for char in line):
+                # Tokenized once, the same sentences are segmented for synthesis
+                sentences = sent_tokenize(line)
+                cleaned_sentences = [s for s in sentences if any(char.isalnum() for char in s)]
+                current_chapter["paragraphs"].append({
+                    "text": ' '.join(cleaned_sentences),
+                    "segments": segment_sentences(cleaned_sentences),
+                })
 
-def get_book(sourcefile):
-    book_contents = []
-    book_title = sourcefile
-    book_author = "Unknown"
-    chapter_titles = []
+    # Append the last chapter if it contains any paragraphs.
+    if current_chapter["paragraphs"]:
+        yield current_chapter
 
+def get_book(sourcefile):
+    book = {"title": sourcefile, "author": "Unknown", "chapter_titles": []}
     with open(sourcefile, "r", encoding="utf-8") as file:
-        current_chapter = {"title": "blank", "paragraphs": []}
-        initialized_first_chapter = False
-        lines_skipped = 0
-        for line in file:
-
-            if lines_skipped < 2 and (line.startswith("Title") or line.startswith("Author")):
-                lines_skipped += 1
-                if line.startswith('Title: '):
-                    book_title = line.replace('Title: ', '').strip()
-                elif line.startswith('Author: '):
-                    book_author = line.replace('Author: ', '').strip()
-                continue
+        book_contents = list(parse_book(file, book))
+    return book_contents, book["title"], book["author"], book["chapter_titles"]
 
-            line = line.strip()
-            if line.startswith("#"):
-                if current_chapter["paragraphs"] or not initialized_first_chapter:
-                    if initialized_first_chapter:
-                        book_contents.append(current_chapter)
-                    current_chapter = {"title": None, "paragraphs": []}
-                    initialized_first_chapter = True
-                chapter_title = line[1:].strip()
-                if any(c.isalnum() for c in chapter_title):
-                    current_chapter["title"] = chapter_title
-                    chapter_titles.append(current_chapter["title"])
-                else:
-                    current_chapter["title"] = "blank"
-                    chapter_titles.append("blank")
-            elif line:
-                if not initialized_first_chapter:
-                    chapter_titles.append("blank")
-                    initialized_first_chapter = True
-                if any(char.isalnum() for char in line):
-                    sentences = sent_tokenize(line)
-                    cleaned_sentences = [s for s in sentences if any(char.isalnum() for char in s)]
-                    line = ' '.join(cleaned_sentences)
-                    current_chapter["paragraphs"].append(line)
-
-        # Append the last chapter if it contains any paragraphs.
-        if current_chapter["paragraphs"]:
-            book_contents.append(current_chapter)
-
-    return book_contents, book_title, book_author, chapter_titles
+def book_plan(sourcefile):
+    """
+    Segmentation plan for a text file (see plan.py), loaded from next to the
+    file or built with get_book if the text changed since it was saved.
+    """
+    segmenter = segmenter_version()
+    plan = load_plan(sourcefile, segmenter)
+    if plan is not None:
+        print(f"Using segmentation plan {plan_path(sourcefile)}")
+        return plan
+    # Only a new plan needs the sentence tokenizer
+    ensure_punkt()
+    book_contents, book_title, book_author, chapter_titles = get_book(sourcefile)
+    plan = save_plan(sourcefile, segmenter, {
+        "title": book_title,
+        "author": book_author,
+        "chapter_titles": chapter_titles,
+        "chapters": book_contents,
+    })
+    print(f"Saved segmentation plan to {plan_path(sourcefile)}")
+    return plan
+
+def direct_plan(sourcefile, textfile=None):
+    """
+    Segmentation plan for --direct: the chapters of an EPUB exactly as
+    export would write them and book_plan would read them back, without the
+    text file in between.
+
+    Unless a saved plan is still valid, plan["chapters"] is a generator that
+    extracts each chapter only when rendering asks for it, so synthesis
+    starts on the first while the rest of the book is still in the zip. The
+    title, author and chapter_titles are filled in as it runs; once it is
+    exhausted the plan is saved next to the EPUB and, with textfile, the text
+    export written there.
+    """
+    segmenter = segmenter_version()
+    plan = load_plan(sourcefile, segmenter)
+    if plan is not None and not textfile:
+        print(f"Using segmentation plan {plan_path(sourcefile)}")
+        return plan
+    ensure_punkt()
+    plan = {"title": sourcefile, "author": "Unknown", "chapter_titles": []}
+
+    def lines(chunks, text):
+        # The lines reading the export back from a file would give
+        for chunk in chunks:
+            if text:
+                text.write(chunk)
+            yield from io.StringIO(chunk, newline=None)
+
+    def chapters():
+        book_contents = []
+        with EpubReader(sourcefile) as book, contextlib.ExitStack() as stack:
+            text = stack.enter_context(open(textfile + ".tmp", "w", encoding="utf-8")) if textfile else None
+            # Extraction shares the process with the model: no export pool, logs above the progress bar
+            chunks = export_lines(book, workers=1, log=lambda log: tqdm.write(log, end=""))
+            for chapter in parse_book(lines(chunks, text), plan):
+                book_contents.append(chapter)
+                yield chapter
+        if textfile:
+            os.replace(textfile + ".tmp", textfile)
+            tqdm.write(f"Exported {sourcefile} to {textfile}")
+        save_plan(sourcefile, segmenter, dict(plan, chapters=book_contents))
+        tqdm.write(f"Saved segmentation plan to {plan_path(sourcefile)}")
+
+    plan["chapters"] = chapters()
+    return plan
 
 def sort_key(s):
     # extract number from the string
@@ -273,15 +613,6 @@ def check_for_file(filename):
         else:
             os.remove(filename)
 
-def append_silence(tempfile, duration=1200):
-    audio = AudioSegment.from_file(tempfile)
-    # Create a silence segment
-    silence = AudioSegment.silent(duration)
-    # Append the silence segment to the audio
-    combined = audio + silence
-    # Save the combined audio back to file
-    combined.export(tempfile, format="flac")
-
 def break_long_sentence(sentence, max_length=200):
     # Split sentence based on commas
     comma_segments = sentence.split(',')
@@ -305,8 +636,13 @@ def break_long_sentence(sentence, max_length=200):
     return segments
 
 def process_large_text(line):
+    from nltk.tokenize import sent_tokenize
     # Tokenize the text into sentences
-    sentences = sent_tokenize(line)
+    return combine_sentences(sent_tokenize(line))
+
+def combine_sentences(sentences, chunking=None):
+    chunking = chunking or CHUNKING
+    min_words = chunking["min_words"]
     # Initialize a list to store processed sentences
     results = []
     
@@ -315,22 +651,22 @@ def process_large_text(line):
         sentence = sentences[i]
         word_count = len(sentence.split())
         
-        # Combine with the next sentence if this one has fewer than 8 words
-        if word_count < 8 and i + 1 < len(sentences):
+        # Combine with the next sentence if this one has fewer than min_words words
+        if word_count < min_words and i + 1 < len(sentences):
             # Combine the current and next sentence
             sentence = sentence + ' ' + sentences[i + 1]
             i += 1  # Skip the next sentence since it's already combined
 
-        if len(sentence) > 500:
+        if len(sentence) > chunking["max_chars"]:
             # Break the long sentences into smaller parts using commas
-            results.extend(break_long_sentence(sentence, max_length=350))
+            results.extend(break_long_sentence(sentence, max_length=chunking["split_chars"]))
         else:
             results.append(sentence)
         
         i += 1  # Move to the next sentence
     
     # Before returning, combine last elements if they are too short
-    if results and len(results[-1].split()) < 8:
+    if results and len(results[-1].split()) < min_words:
         if len(results) > 1:
             # Combine the last two sentences if they are both short
             results[-2] += ' ' + results[-1]
@@ -350,23 +686,426 @@ def conditional_sentence_case(sent):
             break  # No need to continue checking once a match is found
     return sent
 
-def kokoro_read(paragraph, speaker, filename, pipeline, speed):
+def segment_sentences(sentences, chunking=None):
+    # Synthesis-ready segments for a paragraph that is already split into sentences
+    return [conditional_sentence_case(sent.strip()) for sent in combine_sentences(sentences, chunking)]
+
+def segment_text(text):
+    from nltk.tokenize import sent_tokenize
+    return segment_sentences(sent_tokenize(text))
+
+def silence(duration):
+    # Zero-sample run of `duration` milliseconds at the Kokoro sample rate
+    return np.zeros(int(SAMPLE_RATE * duration / 1000), dtype=np.float32)
+
+def join_audio(pieces):
+    return np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.float32)
+
+def join_paragraph(pieces):
+    # The segments of a paragraph, trimmed and evenly paced unless post-processing is off
+    return join_segments(pieces, SAMPLE_RATE) if POSTPROCESS else join_audio(pieces)
+
+def synth_sentence(sent, speaker, pipeline, speed, g2p=None):
     audio_segments = []
-    sentences = process_large_text(paragraph)
-    for sent in sentences:
-        sent = conditional_sentence_case(sent.strip())
+    if g2p is None:
         for gs, ps, audio in pipeline(sent, voice=speaker, speed=speed, split_pattern=r'\n\n\n'):
-            audio_segments.append(audio)
+            audio_segments.append(np.asarray(audio, dtype=np.float32))
+        return join_audio(audio_segments)
+    return synth_phonemes(g2p.get(sent), speaker, pipeline, speed)
+
+def synth_phonemes(phonemes, speaker, pipeline, speed):
+    # Phonemes come from the G2P stage, only inference runs here (as KPipeline.infer does)
+    pack = pipeline.load_voice(speaker).to(pipeline.model.device)
+    return join_audio([np.asarray(pipeline.model(ps, pack[len(ps) - 1], speed), dtype=np.float32) for ps in phonemes])
+
+def pack_groups(phonemes, budget=PHONEME_BUDGET):
+    """
+    Split the segments of a paragraph, given as the phoneme chunks of each
+    (see phonemize), into runs that share a model call: as many whole
+    segments as fit in budget phonemes joined by spaces. A segment that is
+    longer than budget on its own keeps its chunks, one call each, as
+    KPipeline would split it.
+
+    Returns:
+        list of (start, end) segment index ranges, one per call.
+    """
+    groups = []
+    # phonemes in the last group, None when it cannot take more segments
+    length = None
+    for i, chunks in enumerate(phonemes):
+        if len(chunks) > 1:
+            groups.append([i, i + 1])
+            length = None
+            continue
+        size = len(chunks[0]) if chunks else 0
+        if length is not None and (not chunks or not length or length + 1 + size <= budget):
+            groups[-1][1] = i + 1
+            length += size + (1 if length and chunks else 0)
+        else:
+            groups.append([i, i + 1])
+            length = size
+    return [tuple(group) for group in groups]
+
+def pack_segments(segments, phonemes, budget=PHONEME_BUDGET):
+    """
+    Pack the segments of a paragraph into model calls (see pack_groups), so
+    the model reads as many whole sentences per call as fit in its context
+    instead of one (often short) sentence at a time.
+
+    Returns:
+        list of (text, phonemes): the text of the segments of a call joined,
+        and the chunks the model reads for them.
+    """
+    calls = []
+    for start, end in pack_groups(phonemes, budget):
+        chunks = [ps for segment in phonemes[start:end] for ps in segment]
+        if end - start > 1 and chunks:
+            chunks = [" ".join(chunks)]
+        calls.append((" ".join(segments[start:end]), chunks))
+    return calls
+
+def paragraph_calls(segments, pipeline, g2p=None):
+    # (text, phonemes) per model call for a paragraph; without packing phonemes is None, and G2P is
+    # left until the synthesis cache has been checked
+    if not PACKING:
+        return [(sent, None) for sent in segments]
+    return pack_segments(segments, [g2p.get(sent) if g2p else phonemize(pipeline, sent) for sent in segments])
+
+def kokoro_synth(paragraph, speaker, pipeline, speed, cache=None):
+    return synth_segments(segment_text(paragraph), speaker, pipeline, speed, cache)
+
+def synth_segments(segments, speaker, pipeline, speed, cache=None, g2p=None):
+    audio_segments = []
+    for text, phonemes in paragraph_calls(segments, pipeline, g2p):
+        key = cache.key(text, speaker, speed, pipeline) if cache is not None else None
+        audio = cache.get(key) if key else None
+        if audio is None:
+            if phonemes is None:
+                audio = synth_sentence(text, speaker, pipeline, speed, g2p)
+            else:
+                audio = synth_phonemes(phonemes, speaker, pipeline, speed)
+            if key:
+                cache.put(key, audio)
+        audio_segments.append(audio)
+
+    return join_paragraph(audio_segments)
+
+def kokoro_synth_batch(paragraphs, speaker, pipeline, speed, batch_size, cache=None, g2p=None):
+    """
+    Synthesize several paragraphs at once with batched inference.
+
+    Each paragraph is given as its list of segments (see segment_text).
+    All sentences of all paragraphs are phonemized and packed into model
+    calls first (see pack_segments), then run through the model in
+    length-bucketed batches and stitched back per paragraph. Calls found in
+    the cache skip inference.
+
+    Returns:
+        list of float32 numpy arrays, one per paragraph.
+    """
+    # sentence_audio[paragraph][call] collects the audio of that call's chunks
+    sentence_audio = []
+    owners = []
+    phonemes = []
+    keys = {}
+    for pindex, paragraph in enumerate(paragraphs):
+        slots = []
+        for sent, sent_phonemes in paragraph_calls(paragraph, pipeline, g2p):
+            if cache is not None:
+                key = cache.key(sent, speaker, speed, pipeline)
+                audio = cache.get(key)
+                if audio is not None:
+                    slots.append([audio])
+                    continue
+                keys[(pindex, len(slots))] = key
+            if sent_phonemes is None:
+                sent_phonemes = g2p.get(sent) if g2p else phonemize(pipeline, sent)
+            for ps in sent_phonemes:
+                owners.append((pindex, len(slots)))
+                phonemes.append(ps)
+            slots.append([])
+        sentence_audio.append(slots)
+
+    if phonemes:
+        if __package__:
+            from . import batching
+        else:
+            import batching
+        pack = pipeline.load_voice(speaker).to(pipeline.model.device)
+        audio = batching.synthesize(pipeline.model, pack, phonemes, speed, batch_size)
+        for (pindex, sindex), segment in zip(owners, audio):
+            sentence_audio[pindex][sindex].append(segment)
+    for (pindex, sindex), key in keys.items():
+        cache.put(key, join_audio(sentence_audio[pindex][sindex]))
+    return [join_paragraph([join_audio(slot) for slot in slots]) for slots in sentence_audio]
+
+def synth_phoneme_calls(calls, speaker, pipeline, speed, batch_size=1):
+    """
+    Raw audio of every call, each given as the phoneme chunks the model
+    reads for it, batched with batch_size > 1. Nothing is trimmed or joined
+    with pauses: that is left to whoever joins the calls into paragraphs.
+    """
+    if batch_size <= 1:
+        return [synth_phonemes(phonemes, speaker, pipeline, speed) for phonemes in calls]
+    if __package__:
+        from . import batching
+    else:
+        import batching
+    owners = [i for i, phonemes in enumerate(calls) for ps in phonemes]
+    audio = [[] for _ in calls]
+    if owners:
+        pack = pipeline.load_voice(speaker).to(pipeline.model.device)
+        chunks = [ps for phonemes in calls for ps in phonemes]
+        for i, segment in zip(owners, batching.synthesize(pipeline.model, pack, chunks, speed, batch_size)):
+            audio[i].append(segment)
+    return [join_audio(pieces) for pieces in audio]
+
+def kokoro_read(segments, speaker, filename, pipeline, speed, cache=None, pause=0):
+    # pause is milliseconds of silence after the audio
+    final_audio = synth_segments(segments, speaker, pipeline, speed, cache)
+    soundfile.write(filename, np.concatenate([final_audio, silence(pause)]), SAMPLE_RATE)
+
+def chapter_texts(chapter, notitles):
+    """
+    Everything that gets read aloud for a chapter, in order.
+
+    Returns:
+        tuple: (texts, segments), the text of each paragraph and the segments it is synthesized as.
+    """
+    texts = []
+    segments = []
+    if chapter["title"] != "Title" and notitles != True:
+        texts.append(chapter['title'] + ".")
+        segments.append(chapter.get("title_segments") or segment_text(texts[-1]))
+    for paragraph in chapter["paragraphs"]:
+        # Plain strings (not from a segmentation plan) are segmented here
+        if isinstance(paragraph, str):
+            paragraph = {"text": paragraph, "segments": segment_text(paragraph)}
+        texts.append(paragraph["text"])
+        segments.append(paragraph["segments"])
+    return texts, segments
+
+def daemon_synth(paragraphs, speaker, client, speed, batch_size=1, cache=None):
+    # Calls not in the cache go to the daemon in one request, audio is joined back per paragraph here.
+    # With packing the daemon says which segments share a call, as it has the G2P.
+    if PACKING:
+        groups = client.pack(paragraphs, speaker)
+    else:
+        groups = [[(k, k + 1) for k in range(len(paragraph))] for paragraph in paragraphs]
+    calls = [[paragraph[start:end] for start, end in ranges] for paragraph, ranges in zip(paragraphs, groups)]
+    audio = {}
+    keys = {}
+    segments = {}
+    for paragraph in calls:
+        for call in paragraph:
+            text = " ".join(call)
+            if text in audio or text in keys:
+                continue
+            if cache is not None:
+                keys[text] = cache.key(text, speaker, speed, client)
+                cached = cache.get(keys[text])
+                if cached is not None:
+                    audio[text] = cached
+                    del keys[text]
+                    continue
+            audio[text] = None
+            segments[text] = call[0] if len(call) == 1 else call
+    missing = [text for text, a in audio.items() if a is None]
+    if missing:
+        for text, a in zip(missing, client.synthesize_segments([segments[text] for text in missing], speaker, speed,
+                                                               batch_size)):
+            audio[text] = a
+            if text in keys:
+                cache.put(keys[text], a)
+    return [join_paragraph([audio[" ".join(call)] for call in paragraph]) for paragraph in calls]
+
+def synthesize_texts(segments, speaker, pipeline, speed, batch_size=1, cache=None, g2p=None):
+    """
+    Synthesize paragraphs (given as lists of segments) in memory, yielding
+    float32 audio for each in order.
+
+    With batch_size > 1 paragraphs are batched a window at a time, so a
+    killed job only loses the window in flight. pipeline may also be a
+    DaemonClient, which gets a window (or a paragraph) per request.
+    """
+    if isinstance(pipeline, DaemonClient):
+        for window in shard_texts(segments, BATCH_WINDOW_CHARS if batch_size > 1 else 0):
+            yield from daemon_synth(window, speaker, pipeline, speed, batch_size, cache)
+    elif batch_size > 1:
+        for window in shard_texts(segments, BATCH_WINDOW_CHARS):
+            yield from kokoro_synth_batch(window, speaker, pipeline, speed, batch_size, cache, g2p)
+    else:
+        for paragraph in segments:
+            yield synth_segments(paragraph, speaker, pipeline, speed, cache, g2p)
+
+def report_paragraphs(manifest, chapter_index, records, on_paragraph):
+    # The audio of a paragraph is in the chapter spool until the chapter is finished, then in its part file
+    if on_paragraph:
+        spool = None if chapter_index in manifest.chapters else manifest.spool_path(chapter_index)
+        for record in records:
+            on_paragraph(chapter_index, record["index"], spool, record["offset"], record["samples"])
+
+def render_book(book_contents, manifest, speaker, pipeline, speed, paragraphpause, notitles, batch_size=1,
+                cache=None, g2p=None, on_chapter=None, queue_size=8, on_paragraph=None, metrics=None):
+    """
+    Render the book into the job manifest as a pipeline of threads (see stages.py):
+
+        prep -> inference -> post -> write
+
+    prep works out what each chapter still needs, inference only runs the
+    model, post adds pauses and reads audio reused from the previous render,
+    and write appends to the spools and encodes finished chapters to FLAC.
+    The model never waits on disk unless the queues after it are full.
+    With metrics (see metrics.py), every stage records its spans.
+
+    Returns:
+        tuple: (paths of the part files in chapter order, the StagePipeline with its stage stats)
+    """
+    def book_chapters():
+        for i, chapter in enumerate(book_contents, start=1):
+            if chapter["title"] == "":
+                chapter["title"] = "blank"
+            texts, sentences = chapter_texts(chapter, notitles)
+            yield i, chapter["title"], texts, sentences
+
+    # A book still being extracted (--direct) is counted as its chapters come in
+    counted = isinstance(book_contents, list)
+    chapters = list(book_chapters()) if counted else book_chapters()
+    chapter_text = {}
+    segments = {}
+    progress = tqdm(total=sum(len(c[2]) for c in chapters) if counted else 0, desc=f"Generating audio files: ",
+                    unit='pg')
+    eta = CharacterETA(sum(len(text) for c in chapters for text in c[2]) if counted else 0)
+
+    def update_progress(texts, synthesized):
+        for text in texts:
+            eta.update(len(text), synthesized)
+        progress.set_postfix_str(str(eta), refresh=False)
+        progress.update(len(texts))
+
+    def prep():
+        for i, title, texts, sentences in chapters:
+            chapter_text[i] = texts
+            if not counted:
+                progress.total += len(texts)
+                eta.total += sum(len(text) for text in texts)
+            completed = manifest.completed_chapter(i, texts)
+            if completed:
+                progress.write(f"{completed} is complete, skipping to next chapter")
+                yield "complete", i, completed, None
+                continue
+            done = manifest.resume_chapter(i, texts)
+            if done:
+                progress.write(f"Resuming \"{title}\" after {done} verified paragraphs")
+                update_progress(texts[:done], False)
+            missing = [k for k in range(done, len(texts)) if not manifest.can_reuse(texts[k])]
+            yield "chapter", i, (title, texts, done, missing), [sentences[k] for k in missing]
+
+    def inference(item):
+        kind, i, chapter, missing_segments = item
+        if kind == "complete":
+            yield item
+            return
+        title, texts, done, missing = chapter
+        yield "start", i, chapter, None
+        synthesized = synthesize_texts(missing_segments, speaker, pipeline, speed, batch_size, cache, g2p)
+        missing = set(missing)
+        for k in range(done, len(texts)):
+            if k not in missing:
+                yield "paragraph", i, (k, texts[k]), None
+                continue
+            start = time.perf_counter()
+            g2p_blocked = g2p.blocked_seconds() if g2p else 0
+            audio = next(synthesized)
+            if metrics:
+                if g2p and g2p.blocked_seconds() > g2p_blocked:
+                    # G2P the model waited for, shown inside the inference span
+                    metrics.record("g2p", start, i, len(texts[k]), end=start + g2p.blocked_seconds() - g2p_blocked)
+                metrics.record("inference", start, i, len(texts[k]), len(audio))
+            yield "paragraph", i, (k, texts[k]), audio
+        yield "end", i, chapter, None
 
-    final_audio = np.concatenate(audio_segments)
-    soundfile.write(filename, final_audio, 24000)
+    def post(item):
+        kind, i, paragraph, audio = item
+        if kind == "paragraph":
+            pindex, text = paragraph
+            start = time.perf_counter()
+            if audio is None:
+                item = "reused", i, paragraph, manifest.reuse_paragraph(text)
+            else:
+                item = kind, i, paragraph, np.concatenate([audio, silence(paragraphpause)])
+            if metrics:
+                metrics.record("reuse" if audio is None else "silence", start, i, len(text), len(item[3]))
+        yield item
+
+    def write(item):
+        kind, i, data, audio = item
+        if kind in ("paragraph", "reused"):
+            pindex, text = data
+            start = time.perf_counter()
+            manifest.append_paragraph(i, pindex, text, audio, kind == "reused")
+            if metrics:
+                metrics.record("spool", start, i, len(text), len(audio))
+            report_paragraphs(manifest, i, manifest.paragraphs[i][-1:], on_paragraph)
+            update_progress([text], kind == "paragraph")
+            return
+        if kind == "start":
+            # paragraphs verified by resume_chapter
+            report_paragraphs(manifest, i, manifest.paragraphs.get(i, []), on_paragraph)
+            return
+        if kind == "complete":
+            segments[i] = data
+            report_paragraphs(manifest, i, manifest.paragraphs.get(i, []), on_paragraph)
+            update_progress(chapter_text[i], False)
+        else:
+            title, texts, done, missing = data
+            segments[i] = finish_chapter(manifest, i, texts, metrics)
+            progress.write(f"Chapter done: {title} -> {segments[i]}")
+        if on_chapter:
+            on_chapter(i, segments[i], manifest.chapters[i]["samples"])
+
+    stages = StagePipeline(("prep", prep()), [("inference", inference), ("post", post), ("write", write)], queue_size)
+    try:
+        stages.run()
+    finally:
+        progress.close()
+    return [segments[i] for i in sorted(segments)], stages
 
-def read_book(book_contents, speaker, paragraphpause, speed, notitles):
-    current_device_name = torch.get_default_device() if torch.get_default_device() else 'cpu'
+def finish_chapter(manifest, chapter_index, texts, metrics=None):
+    # The spool streams into the encoder a block at a time, so memory use does not grow with the chapter.
+    # Paragraphs already carry their pause in the spool, only the end of chapter pause is missing
+    start = time.perf_counter()
+    # Loudness takes a pass over the spool of its own, before encoding
+    gain = loudness_gain(manifest.spool_blocks(chapter_index), SAMPLE_RATE) if POSTPROCESS else 1.0
+    blocks = itertools.chain(manifest.spool_blocks(chapter_index), [silence(2000)])
+    partname = manifest.finish_chapter(chapter_index, texts, blocks, SAMPLE_RATE, gain)
+    if metrics:
+        metrics.record("flac_encode", start, chapter_index, samples=manifest.chapters[chapter_index]["samples"])
+    return partname
+
+def concat_audio(files, outfile, pause=0):
+    """
+    Join audio files into one FLAC a block at a time, so memory use does not
+    grow with the length of the result, followed by pause milliseconds of
+    silence. The 16-bit samples are copied as is.
+    """
+    with soundfile.SoundFile(outfile, "w", SAMPLE_RATE, 1, format="FLAC") as out:
+        for file in files:
+            with soundfile.SoundFile(file) as f:
+                for block in f.blocks(blocksize=SPOOL_BLOCK, dtype="int16"):
+                    out.write(block)
+        out.write(np.zeros(len(silence(pause)), dtype=np.int16))
+
+def load_pipeline(lang_code, device=None, backend="eager"):
+    global KPipeline
+    import torch
+    if KPipeline is None:
+        from kokoro import KPipeline
+    current_device_name = device or (torch.get_default_device() if torch.get_default_device() else 'cpu')
     current_device = torch.device(current_device_name)
     print(f"Attempting to use device: {current_device}")
 
-    pipeline = KPipeline(lang_code=speaker[0])
+    pipeline = KPipeline(lang_code=lang_code)
 
     # Explicitly move the model to the current default device (e.g., 'xpu')
     if hasattr(pipeline, 'model') and pipeline.model is not None:
@@ -377,6 +1116,258 @@ def read_book(book_contents, speaker, paragraphpause, speed, notitles):
             print(f"Error moving Kokoro model to {current_device}: {e}")
     else:
         print("Warning: KPipeline does not have a 'model' attribute or model is None.")
+    return apply_backend(pipeline, backend)
+
+def shard_texts(paragraphs, max_chars):
+    # Split a chapter's segmented paragraphs into runs of consecutive paragraphs of
+    # at most max_chars (a single longer paragraph still gets a shard of its own)
+    shards = []
+    current = []
+    current_chars = 0
+    for paragraph in paragraphs:
+        chars = sum(len(sent) for sent in paragraph)
+        if current and current_chars + chars > max_chars:
+            shards.append(current)
+            current = []
+            current_chars = 0
+        current.append(paragraph)
+        current_chars += chars
+    if current:
+        shards.append(current)
+    return shards
+
+# Per-process pipeline, caches and G2P stage for the --workers pool, set up by _init_worker
+_worker_pipeline = None
+_worker_cache = None
+_worker_g2p = None
+
+def _init_worker(lang_code, threads, device, cache_dir=None, cache_size=None, phoneme_cache=None, backend="eager",
+                 postprocess=True, packing=True):
+    global _worker_pipeline, _worker_cache, _worker_g2p, POSTPROCESS, PACKING
+    POSTPROCESS = postprocess
+    PACKING = packing
+    import torch
+    torch.set_num_threads(threads)
+    torch.set_default_device(device)
+    _worker_pipeline = load_pipeline(lang_code, device, backend)
+    if cache_dir:
+        _worker_cache = SynthesisCache(cache_dir, cache_size)
+    # Each worker already overlaps G2P with the other workers' inference, so it runs inline here
+    _worker_g2p = PhonemeStage(_worker_pipeline, phoneme_cache, workers=0)
+
+def _synth_shard(paragraphs, speaker, speed, batch_size=1):
+    if batch_size > 1:
+        audio = kokoro_synth_batch(paragraphs, speaker, _worker_pipeline, speed, batch_size, _worker_cache,
+                                   _worker_g2p)
+    else:
+        audio = [synth_segments(segments, speaker, _worker_pipeline, speed, _worker_cache, _worker_g2p)
+                 for segments in paragraphs]
+    return audio, _worker_cache.take_stats() if _worker_cache else None, _worker_g2p.take_stats()
+
+def read_book_parallel(book_contents, speaker, paragraphpause, speed, notitles, workers, manifest, threads=None,
+                       batch_size=1, cache=None, on_chapter=None, shard_chars=4000, g2p=None, phoneme_cache=None,
+                       on_paragraph=None, metrics=None, backend="eager"):
+    """
+    Synthesize the book with a pool of worker processes, each holding its own KPipeline.
+
+    Every chapter is cut into shards of consecutive paragraphs and all shards
+    are queued up front, so workers move on to the next chapter instead of
+    waiting on a long one. Results are appended in order to the job manifest
+    and encoded into the same part{i}.flac files read_book produces.
+    """
+    import torch
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    device = str(torch.get_default_device() if torch.get_default_device() else 'cpu')
+    print(f"Starting {workers} workers with {threads} torch threads each")
+
+    segments = []
+    pending = []
+    total = 0
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(speaker[0], threads, device,
+                  cache.cache_dir if cache else None, cache.max_bytes if cache else None, phoneme_cache, backend,
+                  POSTPROCESS, PACKING),
+    ) as executor:
+        for i, chapter in enumerate(book_contents, start=1):
+            if chapter["title"] == "":
+                chapter["title"] = "blank"
+            texts, sentences = chapter_texts(chapter, notitles)
+            partname = manifest.completed_chapter(i, texts)
+            if partname:
+                print(f"{partname} is complete, skipping to next chapter")
+                segments.append(partname)
+                report_paragraphs(manifest, i, manifest.paragraphs.get(i, []), on_paragraph)
+                if on_chapter:
+                    on_chapter(i, partname, manifest.chapters[i]["samples"])
+                continue
+            segments.append(None)
+            done = manifest.resume_chapter(i, texts)
+            if done:
+                print(f"Resuming \"{chapter['title']}\" after {done} verified paragraphs")
+            missing = [k for k in range(done, len(texts)) if not manifest.can_reuse(texts[k])]
+            shards = shard_texts([sentences[k] for k in missing], shard_chars)
+            futures = [executor.submit(_synth_shard, shard, speaker, speed, batch_size) for shard in shards]
+            pending.append((i, chapter["title"], texts, done, set(missing), futures))
+            total += len(texts) - done
+
+        def shard_results(futures):
+            for future in futures:
+                audio, stats, g2p_stats = future.result()
+                if stats:
+                    cache.merge_stats(stats)
+                if g2p:
+                    g2p.merge_stats(g2p_stats)
+                yield from audio
+
+        with tqdm(total=total, desc=f"Generating audio files: ", unit='pg') as progress:
+            for i, title, texts, done, missing, futures in pending:
+                results = shard_results(futures)
+                report_paragraphs(manifest, i, manifest.paragraphs.get(i, []), on_paragraph)
+                for pindex in range(done, len(texts)):
+                    if pindex in missing:
+                        start = time.perf_counter()
+                        audio = next(results)
+                        if metrics:
+                            # the workers' time as seen from here: waiting for their results
+                            metrics.record("inference", start, i, len(texts[pindex]), len(audio))
+                        audio = np.concatenate([audio, silence(paragraphpause)])
+                        start = time.perf_counter()
+                        manifest.append_paragraph(i, pindex, texts[pindex], audio)
+                        if metrics:
+                            metrics.record("spool", start, i, len(texts[pindex]), len(audio))
+                    else:
+                        manifest.append_paragraph(i, pindex, texts[pindex], manifest.reuse_paragraph(texts[pindex]),
+                                                  reused=True)
+                    report_paragraphs(manifest, i, manifest.paragraphs[i][-1:], on_paragraph)
+                    progress.update(1)
+                segments[i - 1] = finish_chapter(manifest, i, texts, metrics)
+                progress.write(f"Chapter done: {title} -> {segments[i - 1]}")
+                if on_chapter:
+                    on_chapter(i, segments[i - 1], manifest.chapters[i]["samples"])
+    return segments
+
+def read_book(book_contents, speaker, paragraphpause, speed, notitles, assembly="memory", workers=1, threads=None,
+              batch_size=1, cache_dir=None, cache_size=4096, workdir=None, on_chapter=None, g2p_workers=1,
+              phoneme_cache=None, on_paragraph=None, metrics=None, backend="eager", pipeline=None, g2p=None):
+    """
+    Render every chapter of the book to a FLAC part file.
+
+    Progress is journaled in a per-job work directory (see manifest.py), so an
+    interrupted run picks up at the first paragraph that is not verified on disk.
+    The legacy 'files' assembly keeps its own part/pgraphs files in the cwd.
+
+    on_chapter(index, partname, samples) is called as soon as each part file
+    is final; samples is None where it is not known without decoding.
+    With the memory assembly, on_paragraph(index, pindex, spool, offset, samples)
+    is called for every paragraph whose audio is on disk: at offset in the raw
+    float32 spool file, or in the chapter's part file if spool is None (see
+    serve.py).
+
+    G2P runs ahead of inference in g2p_workers processes (see g2p.py), with
+    phonemes kept in the phoneme_cache SQLite file if one is given.
+    With the memory assembly, stage timings go to metrics (see metrics.py).
+    backend picks how the model runs (see backends.py).
+    A pipeline and G2P stage that are already loaded (--batch) can be passed
+    in to render in-process with them; they are left open.
+
+    Returns:
+        list: paths of the part files, in chapter order.
+    """
+    cache = SynthesisCache(cache_dir, cache_size * 1024 * 1024) if cache_dir else None
+    if assembly == "memory":
+        settings = job_settings(speaker, speed, paragraphpause, notitles, backend_version(kokoro_version(), backend),
+                                POSTPROCESS, PACKING)
+        workdir = workdir or job_workdir("audiobook", settings)
+        manifest = JobManifest(workdir, settings)
+        manifest.index_previous_render()
+        print(f"Work directory: {workdir}")
+    if workers > 1 and assembly == "memory":
+        set_default_device()
+        # G2P runs in the workers, this stage only adds up their timings
+        g2p = PhonemeStage(None, workers=0)
+        segments = read_book_parallel(book_contents, speaker, paragraphpause, speed, notitles, workers, manifest,
+                                      threads, batch_size, cache, on_chapter, g2p=g2p, phoneme_cache=phoneme_cache,
+                                      on_paragraph=on_paragraph, metrics=metrics, backend=backend)
+        print(manifest.reuse_report(SAMPLE_RATE))
+        manifest.close()
+        print(g2p.report())
+        if cache:
+            print(cache.report(SAMPLE_RATE))
+        return segments
+
+    shared_g2p = g2p is not None
+    # A running synthesis daemon already has the model loaded (see daemon.py)
+    if pipeline is None and assembly == "memory":
+        pipeline = DaemonClient.connect(speaker[0])
+    elif pipeline is not None:
+        print(f"Using the loaded pipeline for lang_code {pipeline.lang_code}")
+    if isinstance(pipeline, DaemonClient) and pipeline.backend != backend:
+        print(f"The synthesis daemon runs the {pipeline.backend} backend, not {backend}: synthesizing in-process")
+        pipeline.close()
+        pipeline = None
+    if isinstance(pipeline, DaemonClient):
+        print(f"Using the synthesis daemon at {pipeline.path}")
+    elif pipeline is None:
+        set_default_device()
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        pipeline = load_pipeline(speaker[0], backend=backend)
+    if assembly == "memory" and isinstance(pipeline, DaemonClient):
+        # G2P and inference both run in the daemon
+        try:
+            segments, stages = render_book(book_contents, manifest, speaker, pipeline, speed, paragraphpause,
+                                           notitles, batch_size, cache, None, on_chapter, on_paragraph=on_paragraph,
+                                           metrics=metrics)
+        finally:
+            manifest.close()
+            pipeline.close()
+        print(stages.report())
+        print(manifest.reuse_report(SAMPLE_RATE))
+        if cache:
+            print(cache.report(SAMPLE_RATE))
+        return segments
+    if assembly == "memory":
+        g2p = g2p or PhonemeStage(pipeline, phoneme_cache, g2p_workers)
+
+        def upcoming(chapter):
+            # What will be synthesized for the chapter, in reading order
+            if chapter["title"] == "":
+                chapter["title"] = "blank"
+            texts, sentences = chapter_texts(chapter, notitles)
+            # Packing needs the phonemes of every segment, cached audio or not
+            return [sent for text, paragraph in zip(texts, sentences) if not manifest.can_reuse(text)
+                    for sent in paragraph
+                    if cache is None or PACKING or cache.key(sent, speaker, speed, pipeline) not in cache]
+
+        def prefetched(chapters):
+            for chapter in chapters:
+                g2p.prefetch(upcoming(chapter))
+                yield chapter
+
+        # Queue G2P for the whole book, or for each chapter as it is extracted (--direct)
+        if isinstance(book_contents, list):
+            g2p.prefetch([sent for chapter in book_contents for sent in upcoming(chapter)])
+        else:
+            book_contents = prefetched(book_contents)
+        try:
+            segments, stages = render_book(book_contents, manifest, speaker, pipeline, speed, paragraphpause,
+                                           notitles, batch_size, cache, g2p, on_chapter, on_paragraph=on_paragraph,
+                                           metrics=metrics)
+        finally:
+            manifest.close()
+            if not shared_g2p:
+                g2p.close()
+        print(stages.report())
+        print(manifest.reuse_report(SAMPLE_RATE))
+        print(g2p.report())
+        if cache:
+            print(cache.report(SAMPLE_RATE))
+        return segments
 
     segments = []
     for i, chapter in enumerate(book_contents, start=1):
@@ -392,19 +1383,17 @@ def read_book(book_contents, speaker, paragraphpause, speed, notitles):
             print(f"Section name: \"{chapter['title']}\"")
             if chapter["title"] == "":
                 chapter["title"] = "blank"
+            texts, sentences = chapter_texts(chapter, notitles)
+            # the title, when it is read, comes first
+            paragraphs = sentences[len(sentences) - len(chapter["paragraphs"]):]
             if chapter["title"] != "Title" and notitles != True:
                 title_temp = "title.flac"
                 if not os.path.isfile(title_temp):
-                    kokoro_read(chapter['title'] + ".", speaker, "title_temp.wav", pipeline, speed)
-                    append_silence("title_temp.wav", paragraphpause)
-                    # Convert to flac
-                    audio = AudioSegment.from_file("title_temp.wav")
-                    audio.export(title_temp, format="flac")
-                    os.remove("title_temp.wav")
+                    kokoro_read(sentences[0], speaker, title_temp, pipeline, speed, cache, paragraphpause)
                 files.append(title_temp)
 
             for pindex, paragraph in enumerate(
-                tqdm(chapter["paragraphs"], desc=f"Generating audio files: ",unit='pg')
+                tqdm(paragraphs, desc=f"Generating audio files: ",unit='pg')
             ):
                 ptemp = f"pgraphs{pindex}.flac"
                 if os.path.isfile(ptemp):
@@ -412,31 +1401,91 @@ def read_book(book_contents, speaker, paragraphpause, speed, notitles):
                 else:
                     #sentences = sent_tokenize(paragraph)
                     filenames = ["sntnc1.wav"]
-                    kokoro_read(paragraph, speaker, "sntnc1.wav", pipeline, speed)                    
-                    append_silence("sntnc1.wav", paragraphpause)
+                    kokoro_read(paragraph, speaker, "sntnc1.wav", pipeline, speed, cache, paragraphpause)
                     # combine sentences in paragraph
                     sorted_files = sorted(filenames, key=sort_key)
                     if os.path.exists("sntnc0.wav"):
                         sorted_files.insert(0, "sntnc0.wav")
-                    combined = AudioSegment.empty()
-                    for file in sorted_files:
-                        combined += AudioSegment.from_file(file)
-                    combined.export(ptemp, format="flac")
+                    concat_audio(sorted_files, ptemp)
                     for file in sorted_files:
                         os.remove(file)
                 files.append(ptemp)
             # combine paragraphs into chapter
-            append_silence(files[-1], 2000)
-            combined = AudioSegment.empty()
-            for file in files:
-                combined += AudioSegment.from_file(file)
-            combined.export(partname, format="flac")
+            concat_audio(files, partname, 2000)
             for file in files:
                 os.remove(file)
             segments.append(partname)
+        if on_chapter:
+            on_chapter(i, partname, None)
+    if cache:
+        print(cache.report(SAMPLE_RATE))
     return segments
 
-def generate_metadata(files, author, title, chapter_titles):
+def calibration_rate(paragraphs, speaker, speed, config, pipeline, backend="eager"):
+    """
+    Seconds of audio per wall second for synthesizing paragraphs under config
+    (see calibrate.py), model loading and warm-up not counted.
+    """
+    from nltk.tokenize import sent_tokenize
+    import torch
+    segments = [segment_sentences(sent_tokenize(paragraph), config["chunking"]) for paragraph in paragraphs]
+    workers, threads, batch_size = config["workers"], config["threads"], config["batch_size"]
+    if workers == 1:
+        torch.set_num_threads(threads)
+        synth_segments([segments[0][0]], speaker, pipeline, speed)
+        start = time.perf_counter()
+        if batch_size > 1:
+            audio = kokoro_synth_batch(segments, speaker, pipeline, speed, batch_size)
+        else:
+            audio = [synth_segments(paragraph, speaker, pipeline, speed) for paragraph in segments]
+        return sum(len(a) for a in audio) / SAMPLE_RATE / (time.perf_counter() - start)
+    device = str(torch.get_default_device() if torch.get_default_device() else 'cpu')
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(speaker[0], threads, device, None, None, None, backend, POSTPROCESS, PACKING),
+    ) as executor:
+        # every worker loads the model before the clock starts
+        for future in [executor.submit(_synth_shard, [segments[0][:1]], speaker, speed) for _ in range(workers)]:
+            future.result()
+        # a book has many shards per worker, the slice is cut up so it has a few too
+        shard_chars = sum(len(sent) for paragraph in segments for sent in paragraph) // (4 * workers)
+        start = time.perf_counter()
+        futures = [executor.submit(_synth_shard, shard, speaker, speed, batch_size)
+                   for shard in shard_texts(segments, shard_chars)]
+        samples = sum(len(a) for future in futures for a in future.result()[0])
+        return samples / SAMPLE_RATE / (time.perf_counter() - start)
+
+def calibrate_book(book_contents, speaker, speed, chars, backend="eager"):
+    """
+    Render a slice of the book under a grid of settings and save the fastest
+    as this host's profile (see calibrate.py).
+    """
+    import torch
+    set_default_device()
+    device = str(torch.get_default_device() if torch.get_default_device() else 'cpu')
+    texts = [p["text"] if isinstance(p, dict) else p for chapter in book_contents for p in chapter["paragraphs"]]
+    paragraphs = calibration_slice([text for text in texts if text.strip()], chars)
+    print(f"Calibrating on {len(paragraphs)} paragraphs, {sum(len(p) for p in paragraphs)} characters")
+    pipeline = load_pipeline(speaker[0], backend=backend)
+    cpus = os.cpu_count() or 1
+    start = {"workers": 1, "threads": torch.get_num_threads(), "batch_size": 1, "chunking": dict(DEFAULT_CHUNKING)}
+    best, rate, runs = search(lambda config: calibration_rate(paragraphs, speaker, speed, config, pipeline, backend),
+                              start, axes(cpus, device, backend, PACKING))
+    save_calibration(backend, dict(best, backend=backend, device=device, audio_s_per_wall_s=round(rate, 3)),
+                     PACKING)
+    print(f"Fastest of {len(runs)} runs: {describe(best)}, {rate:.2f}s of audio per second")
+    print(f"Saved to {calibration_path()}, later runs use it unless told otherwise")
+    return best
+
+def generate_metadata(files, author, title, chapter_titles, samples=None):
+    """
+    Write the ffmpeg metadata file with one chapter per part file.
+
+    samples holds each part's length in samples where synthesis already
+    knows it; only parts without a count are decoded to measure them.
+    """
     chap = 0
     start_time = 0
     with open("FFMETADATAFILE", "w") as file:
@@ -446,28 +1495,63 @@ def generate_metadata(files, author, title, chapter_titles):
         file.write(f"TITLE={title}\n")
         file.write("DESCRIPTION=Made with https://github.com/aedocw/epub2tts-kokoro\n")
         for file_name in files:
-            duration = get_duration(file_name)
+            if samples and samples[chap] is not None:
+                duration = samples[chap] * 1000 / SAMPLE_RATE
+            else:
+                duration = get_duration(file_name)
             file.write("[CHAPTER]\n")
             file.write("TIMEBASE=1/1000\n")
-            file.write(f"START={start_time}\n")
-            file.write(f"END={start_time + duration}\n")
+            file.write(f"START={round(start_time)}\n")
+            file.write(f"END={round(start_time + duration)}\n")
             file.write(f"title={chapter_titles[chap]}\n")
             chap += 1
             start_time += duration
 
 def get_duration(file_path):
+    from pydub import AudioSegment
     audio = AudioSegment.from_file(file_path)
     duration_milliseconds = len(audio)
     return duration_milliseconds
 
+def encode_chapter(partname):
+    """
+    Encode one part file to AAC next to it, returning the .m4a path.
+
+    Runs in its own ffmpeg process, so several chapters encode in parallel
+    while synthesis carries on.
+    """
+    outputm4a = os.path.splitext(partname)[0] + ".m4a"
+    if os.path.isfile(outputm4a) and os.path.getmtime(outputm4a) >= os.path.getmtime(partname):
+        return outputm4a
+    tmp = outputm4a + ".tmp"
+    ffmpeg_command = [
+        "ffmpeg",
+        "-y",
+        "-loglevel",
+        "error",
+        "-i",
+        partname,
+        "-codec:a",
+        "aac",
+        "-f",
+        "mp4",
+        tmp,
+    ]
+    subprocess.run(ffmpeg_command, check=True)
+    os.replace(tmp, outputm4a)
+    return outputm4a
+
 def make_m4b(files, sourcefile, speaker):
+    """
+    Concatenate the AAC-encoded chapters into the m4b without re-encoding
+    and attach the chapter metadata from FFMETADATAFILE.
+    """
     filelist = "filelist.txt"
-    basefile = sourcefile.replace(".txt", "")
-    outputm4a = f"{basefile} ({speaker}).m4a"
+    basefile = os.path.splitext(sourcefile)[0]
     outputm4b = f"{basefile} ({speaker}).m4b"
     with open(filelist, "w") as f:
         for filename in files:
-            filename = filename.replace("'", "'\\''")
+            filename = os.path.abspath(filename).replace("'", "'\\''")
             f.write(f"file '{filename}'\n")
     ffmpeg_command = [
         "ffmpeg",
@@ -477,49 +1561,64 @@ def make_m4b(files, sourcefile, speaker):
         "0",
         "-i",
         filelist,
-        "-codec:a",
-        "flac",
-        "-f",
-        "mp4",
-        "-strict",
-        "-2",
-        outputm4a,
-    ]
-    subprocess.run(ffmpeg_command)
-    ffmpeg_command = [
-        "ffmpeg",
-        "-i",
-        outputm4a,
         "-i",
         "FFMETADATAFILE",
+        "-map",
+        "0:a",
         "-map_metadata",
         "1",
+        "-map_chapters",
+        "1",
         "-codec",
-        "aac",
+        "copy",
         outputm4b,
     ]
     subprocess.run(ffmpeg_command)
     os.remove(filelist)
     os.remove("FFMETADATAFILE")
-    os.remove(outputm4a)
-    for f in files:
-        os.remove(f)
     return outputm4b
 
+def make_audiobook(files, encoded, samples, plan, sourcefile, speaker, cover, metrics=None):
+    """
+    Chapter metadata, the AAC parts (waiting for those still encoding), the
+    m4b and its cover, once every part file of the book is rendered.
+
+    Returns:
+        tuple: (path of the m4b, paths of the AAC parts)
+    """
+    start = time.perf_counter()
+    generate_metadata(files, plan["author"], plan["title"], plan["chapter_titles"], [samples[i] for i in sorted(samples)])
+    if metrics:
+        metrics.record("metadata", start)
+    m4afiles = [encoded[i].result() for i in sorted(encoded)]
+    start = time.perf_counter()
+    m4bfilename = make_m4b(m4afiles, sourcefile, speaker)
+    if cover:
+        add_cover(cover, m4bfilename)
+    if metrics:
+        metrics.record("mux", start)
+    return m4bfilename, m4afiles
+
 def add_cover(cover_img, filename):
+    from mutagen import mp4
     try:
         if os.path.isfile(cover_img):
             m4b = mp4.MP4(filename)
             cover_image = open(cover_img, "rb").read()
-            m4b["covr"] = [mp4.MP4Cover(cover_image)]
+            # Export keeps the EPUB's cover as it is, JPEG or PNG
+            imageformat = mp4.MP4Cover.FORMAT_PNG if image_extension(cover_image) == ".png" else mp4.MP4Cover.FORMAT_JPEG
+            m4b["covr"] = [mp4.MP4Cover(cover_image, imageformat=imageformat)]
             m4b.save()
         else:
             print(f"Cover image {cover_img} not found")
     except:
         print(f"Cover image {cover_img} not found")
 
-def main():
-     # Check for GPU
+@functools.lru_cache(maxsize=None)
+def set_default_device():
+    # Runs once, and only on the synthesis path
+    import torch
+    # Check for GPU
     if torch.cuda.is_available():
         print('Nvidia GPU available. Setting as default device.')
         torch.set_default_device('cuda')
@@ -538,12 +1637,14 @@ def main():
     else:
         print('No GPU available. Using CPU.')
         torch.set_default_device('cpu')
-        
+
+def main():
+    global POSTPROCESS, PACKING
     parser = argparse.ArgumentParser(
         prog="epub2tts-kokoro",
         description="Read a text file to audiobook format",
     )
-    parser.add_argument("sourcefile", type=str, help="The epub or text file to process")
+    parser.add_argument("sourcefile", type=str, nargs="?", help="The epub or text file to process")
     parser.add_argument(
         "--speaker",
         type=str,
@@ -574,26 +1675,316 @@ def main():
         action="store_true",
         help="Do not read chapter titles"
     )
+    parser.add_argument(
+        "--assembly",
+        type=str,
+        choices=["memory", "files"],
+        default="memory",
+        help="How chapters are assembled: 'memory' keeps audio in memory and encodes each chapter once, "
+             "'files' writes and re-reads a FLAC per paragraph (default: memory)"
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of synthesis processes, each with its own model (default: 1, or the calibrated profile)"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="torch threads per synthesis process (default: the calibrated profile, or CPU count divided by "
+             "--workers)"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        help="Number of sentences run through the model together (default: 1, or the calibrated profile)"
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="eager",
+        choices=BACKENDS,
+        help="Inference backend: eager, compile (torch.compile), onnx or onnx-int8 (ONNX Runtime on the CPU) (default: eager)"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        help="Directory for the synthesized sentence cache, can be shared between hosts (default: no cache)"
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=4096,
+        help="Maximum size of the sentence cache in MB, least recently used entries are evicted (default: 4096)"
+    )
+
+    parser.add_argument(
+        "--g2p-workers",
+        type=int,
+        default=1,
+        help="Processes converting text to phonemes ahead of inference, 0 runs it inline (default: 1)"
+    )
+    parser.add_argument(
+        "--serve",
+        type=int,
+        nargs="?",
+        const=8000,
+        metavar="PORT",
+        help="Stream the book from http://127.0.0.1:PORT/ while it is being rendered (default port: 8000)"
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Only write the segmentation plan (chapters, paragraphs and the segments each is read as) "
+             "next to the text file and exit"
+    )
+    parser.add_argument(
+        "--cleanup",
+        action="store_true",
+        help="Remove the work directory once the m4b is done (it is kept by default so re-runs after "
+             "editing the text only re-render changed paragraphs)"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print wall time, characters/sec and audio produced per second for every stage at the end"
+    )
+    parser.add_argument(
+        "--metrics-out",
+        type=str,
+        metavar="FILE",
+        help="Write per-chapter, per-stage timings to FILE as a Chrome trace (chrome://tracing, ui.perfetto.dev) "
+             "with the summary under \"metrics\""
+    )
+    parser.add_argument(
+        "--no-postprocess",
+        action="store_true",
+        help="Keep the model's audio as it is: no silence trimming between sentences and no loudness "
+             "normalization of chapters"
+    )
+    parser.add_argument(
+        "--no-packing",
+        action="store_true",
+        help="Give every sentence segment a model call of its own, instead of packing the segments of a "
+             "paragraph into calls of up to 510 phonemes"
+    )
+    parser.add_argument(
+        "--queue",
+        type=str,
+        metavar="DIR",
+        help="Render on other machines: queue the chapters in DIR, a directory they share, for "
+             "epub2tts-kokoro-worker DIR to pick up, and build the m4b once all are rendered"
+    )
+    parser.add_argument(
+        "--direct",
+        action="store_true",
+        help="Render an epub straight to an m4b in one run, without exporting it to a text file first; "
+             "chapters are extracted while the first ones are already being read"
+    )
+    parser.add_argument(
+        "--save-text",
+        action="store_true",
+        help="With --direct, also write the text export next to the epub"
+    )
+    parser.add_argument(
+        "--batch",
+        type=str,
+        metavar="DIR|LIST",
+        help="Render every book (epub or txt) in DIR, or listed in the LIST file, in one process that loads the "
+             "model once; each book gets its own m4b and a report of per-book throughput is printed at the end"
+    )
+    parser.add_argument(
+        "--calibrate",
+        type=int,
+        nargs="?",
+        const=2000,
+        metavar="CHARS",
+        help="Render CHARS characters of the book (default: 2000) with different threads, workers, batch sizes "
+             "and sentence chunking, save the fastest as this host's profile and exit"
+    )
+    parser.add_argument(
+        "--no-calibration",
+        action="store_true",
+        help="Ignore the calibrated profile saved by --calibrate"
+    )
 
     args = parser.parse_args()
     print(args)
+    POSTPROCESS = not args.no_postprocess
+    PACKING = not args.no_packing
+    # Settings not given on the command line come from the profile saved by --calibrate
+    calibration = None if args.no_calibration or args.calibrate else load_calibration(args.backend, PACKING)
+    if calibration:
+        print(f"Using the calibrated profile from {calibration_path()}: {describe(calibration)}")
+        if args.workers is None and args.assembly == "memory" and not args.batch:
+            args.workers = calibration["workers"]
+        if args.threads is None:
+            args.threads = calibration["threads"]
+        if args.batch_size is None:
+            args.batch_size = calibration["batch_size"]
+        CHUNKING.update(calibration["chunking"])
+    args.workers = args.workers or 1
+    args.batch_size = args.batch_size or 1
+    if args.workers > 1 and args.assembly != "memory":
+        parser.error("--workers needs --assembly memory")
+    if args.serve and args.assembly != "memory":
+        parser.error("--serve needs --assembly memory")
+    if args.queue and args.serve:
+        parser.error("--serve cannot be combined with --queue")
+    if args.batch_size > 1 and args.backend != "eager":
+        parser.error("--batch-size needs --backend eager")
 
-    ensure_punkt()
+    if bool(args.batch) == bool(args.sourcefile):
+        parser.error("give either a sourcefile or --batch")
+    if args.batch:
+        # Per-book options, or ones that need a book of their own
+        single = {
+            "--serve": args.serve,
+            "--queue": args.queue,
+            "--plan": args.plan,
+            "--calibrate": args.calibrate,
+            "--cover": args.cover,
+            "--save-text": args.save_text,
+            "--profile": args.profile,
+            "--metrics-out": args.metrics_out,
+            "--workers": args.workers > 1,
+            "--assembly files": args.assembly != "memory",
+        }
+        others = [flag for flag, given in single.items() if given]
+        if others:
+            parser.error(f"--batch cannot be combined with {', '.join(others)}")
+        results = render_library(library_books(args.batch, args.speaker), args)
+        sys.exit(1 if any("error" in stats for stats in results) else 0)
+    if args.direct and not args.sourcefile.endswith(".epub"):
+        parser.error("--direct needs an epub")
+    if args.save_text and not args.direct:
+        parser.error("--save-text needs --direct")
 
     #If we get an epub, export that to txt file, then exit
-    if args.sourcefile.endswith(".epub"):
-        book = epub.read_epub(args.sourcefile)
-        export(book, args.sourcefile)
+    if args.sourcefile.endswith(".epub") and not args.direct:
+        export(args.sourcefile)
+        exit()
+
+    metrics = Metrics(SAMPLE_RATE) if args.profile or args.metrics_out else None
+    start = time.perf_counter()
+    if args.direct:
+        textfile = args.sourcefile.replace(".epub", ".txt") if args.save_text else None
+        if textfile:
+            check_for_file(textfile)
+        if not args.cover:
+            with EpubReader(args.sourcefile) as book:
+                args.cover = book.save_cover(args.sourcefile.replace(".epub", ""))
+            if args.cover:
+                print(f"Cover image saved to {args.cover}")
+        plan = direct_plan(args.sourcefile, textfile)
+        # These need every chapter before the first one is read
+        if args.plan or args.calibrate or args.serve or args.queue:
+            plan["chapters"] = list(plan["chapters"])
+    else:
+        plan = book_plan(args.sourcefile)
+    if metrics:
+        metrics.record("plan", start)
+    if isinstance(plan["chapters"], list):
+        print(plan_summary(plan))
+    else:
+        print(f"Reading {args.sourcefile} directly, chapters are extracted as synthesis gets to them")
+    if args.plan:
+        exit()
+    if args.calibrate:
+        calibrate_book(plan["chapters"], args.speaker, args.speed, args.calibrate, args.backend)
         exit()
+    book_contents = plan["chapters"]
+    settings = job_settings(args.speaker, args.speed, args.paragraphpause, args.notitles,
+                            backend_version(kokoro_version(), args.backend), POSTPROCESS, PACKING)
+    workdir = job_workdir(args.sourcefile, settings)
+    # Phonemes do not depend on voice or speed, so they live outside the work directory
+    if args.cache_dir:
+        os.makedirs(args.cache_dir, exist_ok=True)
+        phoneme_cache = os.path.join(args.cache_dir, "phonemes.sqlite")
+    else:
+        phoneme_cache = os.path.splitext(args.sourcefile)[0] + ".phonemes.sqlite"
 
-   
+    # Chapters are encoded to AAC as soon as synthesis finishes them
+    encoded = {}
+    samples = {}
+    encoder = ThreadPoolExecutor(max_workers=ENCODE_JOBS)
+    def encode(index, partname, chapter_samples):
+        start = time.perf_counter()
+        m4a = encode_chapter(partname)
+        if metrics:
+            metrics.record("aac_encode", start, index, samples=chapter_samples or 0)
+        return m4a
+    def on_chapter(index, partname, chapter_samples):
+        encoded[index] = encoder.submit(encode, index, partname, chapter_samples)
+        samples[index] = chapter_samples
+        if stream:
+            stream.on_chapter(index, partname)
 
+    stream = None
+    if args.serve:
+        for chapter in book_contents:
+            if chapter["title"] == "":
+                chapter["title"] = "blank"
+        stream = BookStream([(chapter["title"], chapter_texts(chapter, args.notitles)[0]) for chapter in book_contents],
+                            SAMPLE_RATE, POSTPROCESS)
+        server = start_server(stream, args.serve)
+        print(f"Listen while the book is rendered: http://127.0.0.1:{args.serve}/")
 
-    book_contents, book_title, book_author, chapter_titles = get_book(args.sourcefile)
-    files = read_book(book_contents, args.speaker, args.paragraphpause, args.speed, args.notitles)
-    generate_metadata(files, book_author, book_title, chapter_titles)
-    m4bfilename = make_m4b(files, args.sourcefile, args.speaker)
-    add_cover(args.cover, m4bfilename)
+    try:
+        if args.queue:
+            # Workers render with their own --batch-size/--threads, the book's settings travel with it
+            book = dict(settings, backend=args.backend, chapters=book_contents)
+            files = coordinate(args.queue, book, on_chapter)
+        else:
+            files = read_book(
+                book_contents, args.speaker, args.paragraphpause, args.speed, args.notitles,
+                assembly=args.assembly,
+                workers=args.workers,
+                threads=args.threads,
+                batch_size=args.batch_size,
+                backend=args.backend,
+                cache_dir=args.cache_dir,
+                cache_size=args.cache_size,
+                workdir=workdir,
+                on_chapter=on_chapter,
+                g2p_workers=args.g2p_workers,
+                phoneme_cache=phoneme_cache,
+                on_paragraph=stream.on_paragraph if stream else None,
+                metrics=metrics,
+            )
+    except WorkdirLocked as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        if stream:
+            stream.finish()
+    m4bfilename, m4afiles = make_audiobook(files, encoded, samples, plan, args.sourcefile, args.speaker, args.cover,
+                                           metrics)
+    encoder.shutdown()
+    if metrics:
+        if args.profile:
+            print(metrics.report())
+        if args.metrics_out:
+            metrics.write(args.metrics_out)
+            print(f"Stage timings written to {args.metrics_out}")
+    if args.assembly == "files":
+        for f in files + m4afiles:
+            os.remove(f)
+    elif args.queue:
+        if args.cleanup:
+            shutil.rmtree(args.queue, ignore_errors=True)
+    elif args.cleanup:
+        shutil.rmtree(workdir, ignore_errors=True)
+    else:
+        print(f"Kept {workdir} so edits to {args.sourcefile} only re-render what changed (--cleanup removes it)")
+    if args.serve and not args.cleanup:
+        print(f"Rendering done, still serving http://127.0.0.1:{args.serve}/ (Ctrl-C to stop)")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
     
 if __name__ == "__main__":
     main()
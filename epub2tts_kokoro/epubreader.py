@@ -0,0 +1,142 @@
+"""
+Streaming EPUB reader for export.
+
+ebooklib's read_epub decompresses every item of a book up front, images and
+fonts included, and keeps them all in memory. Export only needs the OPF, the
+spine documents and the cover, so this reads container.xml and the OPF once,
+then decompresses one spine document at a time straight from the zip. Other media are never decompressed, except the
+cover, which is copied out as it is stored.
+"""
+import collections
+import posixpath
+import shutil
+import zipfile
+from urllib.parse import unquote
+
+from lxml import etree
+
+namespaces = {
+    "calibre": "http://calibre.kovidgoyal.net/2009/metadata",
+    "dc": "http://purl.org/dc/elements/1.1/",
+    "dcterms": "http://purl.org/dc/terms/",
+    "opf": "http://www.idpf.org/2007/opf",
+    "u": "urn:oasis:names:tc:opendocument:xmlns:container",
+    "xsi": "http://www.w3.org/2001/XMLSchema-instance",
+}
+
+# Cover formats an m4b holds, by their first bytes; anything else is converted to PNG
+COVER_FORMATS = {b"\xff\xd8\xff": ".jpg", b"\x89PNG\r\n\x1a\n": ".png"}
+
+ManifestItem = collections.namedtuple("ManifestItem", "id path media_type properties")
+
+
+def _parse(data):
+    return etree.fromstring(data, etree.XMLParser(resolve_entities=False, huge_tree=True, recover=True))
+
+
+def image_extension(head):
+    # File extension for an image format kept as is, or None
+    for magic, extension in COVER_FORMATS.items():
+        if head.startswith(magic):
+            return extension
+    return None
+
+
+class EpubReader:
+    """
+    An open EPUB. Only container.xml and the OPF are read when it is opened.
+    """
+
+    def __init__(self, path):
+        self.zip = zipfile.ZipFile(path)
+        try:
+            container = _parse(self.zip.read("META-INF/container.xml"))
+            self.opf_path = container.xpath("/u:container/u:rootfiles/u:rootfile",
+                                            namespaces=namespaces)[0].get("full-path")
+            self.opf_dir = posixpath.dirname(self.opf_path)
+            opf = _parse(self.zip.read(self.opf_path))
+        except Exception:
+            self.zip.close()
+            raise
+        self.manifest = {}
+        for item in opf.xpath("opf:manifest/opf:item", namespaces=namespaces):
+            self.manifest[item.get("id")] = ManifestItem(
+                item.get("id"),
+                self._path(item.get("href", "")),
+                item.get("media-type", ""),
+                item.get("properties", "").split(),
+            )
+        self.spine = [(itemref.get("idref"), itemref.get("linear", "yes"))
+                      for itemref in opf.xpath("opf:spine/opf:itemref", namespaces=namespaces)]
+        self.metadata = {}
+        for name in ["title", "creator"]:
+            values = opf.xpath(f"opf:metadata/dc:{name}/text()", namespaces=namespaces)
+            self.metadata[name] = values[0].strip() if values else None
+        self.cover_id = next(iter(opf.xpath("opf:metadata/opf:meta[@name='cover']/@content",
+                                            namespaces=namespaces)), None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.zip.close()
+
+    def _path(self, href):
+        # Zip member name of an href relative to the OPF
+        return posixpath.normpath(posixpath.join(self.opf_dir, unquote(href.split("#")[0])))
+
+    def read(self, item):
+        return self.zip.read(item.path)
+
+    def document_ids(self):
+        # Linear spine items that are XHTML documents, in reading order
+        return [idref for idref, linear in self.spine
+                if linear == "yes" and idref in self.manifest
+                and self.manifest[idref].media_type == "application/xhtml+xml"]
+
+    def documents(self):
+        """
+        Yield (item id, content) for every document of document_ids(),
+        decompressing each one only when it is reached.
+        """
+        for item_id in self.document_ids():
+            try:
+                content = self.read(self.manifest[item_id])
+            except KeyError:
+                print(f"Skipping '{item_id}': {self.manifest[item_id].path} is missing from the EPUB")
+                continue
+            yield item_id, content
+
+    def cover_item(self):
+        # The <meta name="cover"> item (EPUB 2), or the cover-image item (EPUB 3)
+        item = self.manifest.get(self.cover_id)
+        if item is None:
+            item = next((item for item in self.manifest.values() if "cover-image" in item.properties), None)
+        if item is None or item.path not in self.zip.NameToInfo:
+            return None
+        return item
+
+    def save_cover(self, basename):
+        """
+        Copy the cover to basename plus the extension of its format, without
+        decoding it. Covers an m4b cannot hold (GIF, WebP, ...) are converted
+        to PNG. Returns the file written, or None without a cover.
+        """
+        item = self.cover_item()
+        if item is None:
+            return None
+        with self.zip.open(item.path) as source:
+            extension = image_extension(source.read(16))
+        if extension is None:
+            from PIL import Image
+            with self.zip.open(item.path) as source, Image.open(source) as image:
+                path = basename + ".png"
+                image.save(path)
+            return path
+        path = basename + extension
+        with self.zip.open(item.path) as source, open(path, "wb") as target:
+            shutil.copyfileobj(source, target)
+        return path
@@ -0,0 +1,253 @@
+"""
+Grapheme-to-phoneme stage.
+
+KPipeline.__call__ converts text to phonemes inline, on the same thread as
+the model. Here G2P runs ahead of inference in a pool of processes that
+each hold a model-less KPipeline, so the model always has phonemes ready.
+Results go to a persistent phoneme cache keyed by the normalized text and
+lang_code only, so they are reused across voices, speeds and re-renders.
+"""
+import functools
+import hashlib
+import importlib.metadata
+import json
+import multiprocessing
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+if __package__:
+    from .cache import kokoro_version, normalize_text
+else:
+    from cache import kokoro_version, normalize_text
+
+# Segments sent to a G2P worker at a time
+G2P_SHARD = 32
+
+
+# Bump when phonemize changes, so phonemes cached before it are computed again
+PHONEMIZE_VERSION = 2
+# Characters of text KPipeline converts at a time for languages other than English
+CHUNK_CHARS = 400
+
+
+def text_chunks(text):
+    # KPipeline.__call__'s split of non-English text: whole sentences up to CHUNK_CHARS,
+    # or plain CHUNK_CHARS slices of text without sentence punctuation
+    parts = re.split(r'([.!?]+)', text)
+    chunks = []
+    current = ""
+    for i in range(0, len(parts), 2):
+        sentence = parts[i] + (parts[i + 1] if i + 1 < len(parts) else "")
+        if current and len(current) + len(sentence) > CHUNK_CHARS:
+            chunks.append(current.strip())
+            current = sentence
+        else:
+            current += sentence
+    if current:
+        chunks.append(current.strip())
+    if not chunks:
+        chunks = [text[i:i + CHUNK_CHARS] for i in range(0, len(text), CHUNK_CHARS)]
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def phonemize(pipeline, text):
+    # Same G2P and chunking KPipeline.__call__ does before inference
+    if pipeline.lang_code in 'ab':
+        _, tokens = pipeline.g2p(text)
+        return [ps[:510] for gs, ps, tks in pipeline.en_tokenize(tokens) if ps]
+    phonemes = []
+    for chunk in text_chunks(text):
+        ps, _ = pipeline.g2p(chunk)
+        if not ps:
+            continue
+        if len(ps) > 510:
+            print(f"Truncating {len(ps)} phonemes to 510: {chunk[:60]}...")
+        phonemes.append(ps[:510])
+    return phonemes
+
+
+@functools.lru_cache(maxsize=None)
+def g2p_version():
+    try:
+        misaki = importlib.metadata.version("misaki")
+    except importlib.metadata.PackageNotFoundError:
+        misaki = "unknown"
+    return f"kokoro-{kokoro_version()}/misaki-{misaki}/phonemize-{PHONEMIZE_VERSION}"
+
+
+class PhonemeCache:
+    """
+    Phonemes per (text, lang_code) in a SQLite file, safe to share between processes.
+    """
+    def __init__(self, path):
+        self.path = path
+        # created on the main thread, used by the inference thread of render_book
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS phonemes (key TEXT PRIMARY KEY, phonemes TEXT NOT NULL)")
+        self.db.commit()
+
+    def key(self, text, lang_code):
+        fields = [normalize_text(text), lang_code, g2p_version()]
+        return hashlib.sha256("\x1f".join(fields).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        row = self.db.execute("SELECT phonemes FROM phonemes WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_many(self, items):
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO phonemes VALUES (?, ?)",
+                                [(key, json.dumps(phonemes, ensure_ascii=False)) for key, phonemes in items])
+
+    def close(self):
+        self.db.close()
+
+
+# Per-process pipeline for the G2P pool, set up by _init_g2p_worker
+_g2p_pipeline = None
+
+
+def _init_g2p_worker(lang_code):
+    global _g2p_pipeline
+    from kokoro import KPipeline
+    _g2p_pipeline = KPipeline(lang_code=lang_code, model=False)
+
+
+def _g2p_shard(texts):
+    start = time.perf_counter()
+    phonemes = [phonemize(_g2p_pipeline, text) for text in texts]
+    return phonemes, time.perf_counter() - start
+
+
+class PhonemeStage:
+    """
+    Phonemes for the segments the model is about to synthesize.
+
+    prefetch() queues segments on the G2P pool in reading order; get()
+    returns a segment's phonemes from memory or the cache, waits for its
+    shard if it is still in flight, and only falls back to running G2P
+    inline for segments that were never prefetched. With workers=0 all G2P
+    runs inline, as KPipeline.__call__ would. A stage without a pipeline
+    only collects the stats of stages in other processes.
+    """
+    def __init__(self, pipeline, cache_path=None, workers=1):
+        self.pipeline = pipeline
+        self.lang_code = pipeline.lang_code if pipeline else None
+        self.cache = PhonemeCache(cache_path) if cache_path else None
+        self.executor = None
+        if workers > 0:
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_g2p_worker,
+                initargs=(self.lang_code,),
+            )
+        self.workers = workers
+        # text -> phonemes that are ready, text -> (future, shard) computing them
+        self.ready = {}
+        # render_book prefetches chapters from its prep thread while they are still being
+        # extracted (--direct), as inference reads phonemes; guards the dicts and the cache
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.cache_hits = 0
+        self.computed = 0
+        self.worker_seconds = 0
+        self.inline_seconds = 0
+        self.wait_seconds = 0
+        self.started = time.perf_counter()
+
+    def _cached(self, text):
+        if self.cache is None:
+            return None
+        phonemes = self.cache.get(self.cache.key(text, self.lang_code))
+        if phonemes is not None:
+            self.cache_hits += 1
+        return phonemes
+
+    def _store(self, texts, phonemes):
+        self.computed += len(texts)
+        if self.cache is not None:
+            self.cache.put_many([(self.cache.key(t, self.lang_code), ps) for t, ps in zip(texts, phonemes)])
+
+    def prefetch(self, texts):
+        if self.executor is None:
+            return
+        with self.lock:
+            todo = []
+            for text in dict.fromkeys(texts):
+                if text in self.ready or text in self.pending:
+                    continue
+                phonemes = self._cached(text)
+                if phonemes is not None:
+                    self.ready[text] = phonemes
+                else:
+                    todo.append(text)
+            for start in range(0, len(todo), G2P_SHARD):
+                shard = todo[start:start + G2P_SHARD]
+                future = self.executor.submit(_g2p_shard, shard)
+                for text in shard:
+                    self.pending[text] = (future, shard)
+
+    def get(self, text):
+        with self.lock:
+            if text in self.ready:
+                return self.ready[text]
+            pending = self.pending.get(text)
+        if pending:
+            future, shard = pending
+            start = time.perf_counter()
+            phonemes, seconds = future.result()
+            with self.lock:
+                self.wait_seconds += time.perf_counter() - start
+                # another thread waiting on the same shard may have stored it already
+                if text in self.ready:
+                    return self.ready[text]
+                self.worker_seconds += seconds
+                for t in shard:
+                    self.pending.pop(t, None)
+                self._store(shard, phonemes)
+                self.ready.update(zip(shard, phonemes))
+                return self.ready[text]
+        with self.lock:
+            phonemes = self._cached(text)
+        if phonemes is None:
+            start = time.perf_counter()
+            phonemes = phonemize(self.pipeline, text)
+            self.inline_seconds += time.perf_counter() - start
+            with self.lock:
+                self._store([text], [phonemes])
+        return phonemes
+
+    def take_stats(self):
+        # Hand counters over to another process's stage (see merge_stats) and reset them
+        names = ["cache_hits", "computed", "worker_seconds", "inline_seconds", "wait_seconds"]
+        stats = {name: getattr(self, name) for name in names}
+        for name in names:
+            setattr(self, name, 0)
+        return stats
+
+    def merge_stats(self, stats):
+        for name, value in stats.items():
+            setattr(self, name, getattr(self, name) + value)
+
+    def blocked_seconds(self):
+        # Time synthesis spent on G2P, inline or waiting for the pool
+        return self.inline_seconds + self.wait_seconds
+
+    def report(self):
+        wall = time.perf_counter() - self.started
+        blocked = self.blocked_seconds()
+        return (f"G2P: {self.computed} segments converted, {self.cache_hits} from the phoneme cache; "
+                f"synthesis blocked on G2P for {blocked:.1f}s of {wall:.1f}s wall "
+                f"({100 * blocked / max(wall, 1e-9):.0f}%: {self.inline_seconds:.1f}s inline, "
+                f"{self.wait_seconds:.1f}s waiting), "
+                f"{self.worker_seconds:.1f}s in {self.workers} G2P workers ahead of inference")
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+        if self.cache is not None:
+            self.cache.close()
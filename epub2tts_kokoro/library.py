@@ -0,0 +1,247 @@
+"""
+Library batch mode (--batch): many books in one process on a warm pipeline.
+
+Books come from a directory, every .epub and .txt in it (a .txt takes the
+place of the .epub of the same name: it is an export, maybe edited), or
+from a list file with one book per line, optionally followed by the speaker
+to read it with:
+
+    # paths are relative to the list file, quote those with spaces
+    "Moby Dick.epub"
+    persuasion.txt bf_emma
+
+Every book gets the work directory and m4b a run of epub2tts-kokoro on it
+alone would give it; EPUBs are read the --direct way. The model and G2P
+workers are loaded once per lang_code and kept for the whole run. A book's
+m4b is muxed by a thread of its own, so the model is already reading the
+next book meanwhile. A book that fails (a broken EPUB, say) is reported and
+the run goes on with the next one.
+"""
+import datetime
+import os
+import shlex
+import shutil
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+if __package__:
+    from .backends import backend_version
+    from .cache import kokoro_version
+    from .epubreader import EpubReader
+    from .g2p import PhonemeStage
+    from .manifest import job_settings, job_workdir
+else:
+    from backends import backend_version
+    from cache import kokoro_version
+    from epubreader import EpubReader
+    from g2p import PhonemeStage
+    from manifest import job_settings, job_workdir
+
+# Covers looked for next to a .txt book, as export leaves them
+COVER_EXTENSIONS = [".jpg", ".png"]
+
+# Set on first use: epub2tts_kokoro imports this module
+e2t = None
+
+
+def library_books(path, speaker):
+    """
+    (sourcefile, speaker) for every book of a directory or list file, in order.
+    """
+    if os.path.isdir(path):
+        names = sorted(os.listdir(path))
+        texts = {os.path.splitext(name)[0] for name in names if name.endswith(".txt")}
+        return [(os.path.join(path, name), speaker) for name in names
+                if name.endswith(".txt") or (name.endswith(".epub") and os.path.splitext(name)[0] not in texts)]
+    books = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            fields = shlex.split(line, comments=True)
+            if fields:
+                books.append((os.path.join(os.path.dirname(path), fields[0]),
+                              fields[1] if len(fields) > 1 else speaker))
+    return books
+
+
+def book_cover(sourcefile):
+    # The EPUB's own cover, or the one export left next to a .txt
+    if sourcefile.endswith(".epub"):
+        with EpubReader(sourcefile) as book:
+            return book.save_cover(os.path.splitext(sourcefile)[0])
+    for extension in COVER_EXTENSIONS:
+        cover = os.path.splitext(sourcefile)[0] + extension
+        if os.path.isfile(cover):
+            return cover
+    return None
+
+
+def _counted(chapters, stats):
+    # Characters of a book that is still being extracted, as rendering gets to them
+    for chapter in chapters:
+        stats["chars"] += _chapter_chars(chapter)
+        yield chapter
+
+
+def _chapter_chars(chapter):
+    return sum(len(p if isinstance(p, str) else p["text"]) for p in chapter["paragraphs"])
+
+
+class Library:
+    """
+    Pipelines, G2P stages and encoders shared by the books of a --batch run.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.pipelines = {}
+        self.g2p = {}
+        # Chapters encode to AAC while synthesis goes on, books are muxed one at a time
+        self.encoder = ThreadPoolExecutor(max_workers=e2t.ENCODE_JOBS)
+        self.finisher = ThreadPoolExecutor(max_workers=1)
+        # Phonemes do not depend on the book, one cache serves the whole run
+        self.phoneme_cache = os.path.join(args.cache_dir, "phonemes.sqlite") if args.cache_dir else None
+
+    def pipeline(self, lang_code):
+        if lang_code not in self.pipelines:
+            e2t.set_default_device()
+            if self.args.threads:
+                import torch
+                torch.set_num_threads(self.args.threads)
+            start = time.perf_counter()
+            self.pipelines[lang_code] = e2t.load_pipeline(lang_code, backend=self.args.backend)
+            self.g2p[lang_code] = PhonemeStage(self.pipelines[lang_code], self.phoneme_cache, self.args.g2p_workers)
+            print(f"Loaded the {lang_code} pipeline in {time.perf_counter() - start:.1f}s")
+        return self.pipelines[lang_code], self.g2p[lang_code]
+
+    def render(self, sourcefile, speaker):
+        """
+        Synthesize one book, then hand it to the finisher thread for its m4b.
+
+        Returns:
+            dict: the book's stats, with the future of its m4b under "m4b".
+        """
+        args = self.args
+        stats = {"book": sourcefile, "speaker": speaker, "chars": 0, "samples": 0}
+        start = time.perf_counter()
+        if sourcefile.endswith(".epub"):
+            plan = e2t.direct_plan(sourcefile)
+        else:
+            plan = e2t.book_plan(sourcefile)
+        chapters = plan["chapters"]
+        if isinstance(chapters, list):
+            stats["chars"] = sum(_chapter_chars(chapter) for chapter in chapters)
+        else:
+            chapters = _counted(chapters, stats)
+        cover = book_cover(sourcefile)
+        pipeline, g2p = self.pipeline(speaker[0])
+        settings = job_settings(speaker, args.speed, args.paragraphpause, args.notitles,
+                                backend_version(kokoro_version(), args.backend), e2t.POSTPROCESS,
+                                e2t.PACKING)
+        workdir = job_workdir(sourcefile, settings)
+        encoded = {}
+        samples = {}
+
+        def on_chapter(index, partname, chapter_samples):
+            encoded[index] = self.encoder.submit(e2t.encode_chapter, partname)
+            samples[index] = chapter_samples
+
+        files = e2t.read_book(
+            chapters, speaker, args.paragraphpause, args.speed, args.notitles,
+            batch_size=args.batch_size,
+            backend=args.backend,
+            cache_dir=args.cache_dir,
+            cache_size=args.cache_size,
+            workdir=workdir,
+            on_chapter=on_chapter,
+            pipeline=pipeline,
+            g2p=g2p,
+        )
+        stats["synthesis_s"] = time.perf_counter() - start
+        stats["samples"] = sum(samples.values())
+
+        def finish():
+            start = time.perf_counter()
+            m4b, _ = e2t.make_audiobook(files, encoded, samples, plan, sourcefile, speaker, cover)
+            if args.cleanup:
+                shutil.rmtree(workdir, ignore_errors=True)
+            stats["mux_s"] = time.perf_counter() - start
+            return m4b
+
+        stats["m4b"] = self.finisher.submit(finish)
+        return stats
+
+    def close(self):
+        self.finisher.shutdown()
+        self.encoder.shutdown()
+        for g2p in self.g2p.values():
+            g2p.close()
+
+
+def render_library(books, args):
+    """
+    Render every (sourcefile, speaker) of books; see the module docstring.
+
+    Returns:
+        list of dicts: per book stats, with "error" set for books that failed.
+    """
+    global e2t
+    if e2t is None:
+        e2t = _synthesis_module()
+    library = Library(args)
+    results = []
+    start = time.perf_counter()
+    try:
+        for n, (sourcefile, speaker) in enumerate(books, start=1):
+            print(f"\nBook {n} of {len(books)}: {sourcefile}")
+            try:
+                results.append(library.render(sourcefile, speaker))
+            # ensure_punkt and the like exit where a single book would; here only that book fails
+            except (Exception, SystemExit) as e:
+                traceback.print_exc()
+                print(f"Skipping {sourcefile}: {e}")
+                results.append({"book": sourcefile, "speaker": speaker, "error": f"{type(e).__name__}: {e}"})
+        for stats in results:
+            if "m4b" not in stats:
+                continue
+            try:
+                stats["m4b"] = stats["m4b"].result()
+            except (Exception, SystemExit) as e:
+                traceback.print_exc()
+                stats["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        library.close()
+    print(library_report(results, time.perf_counter() - start, e2t.SAMPLE_RATE))
+    return results
+
+
+def library_report(results, wall, sample_rate):
+    failed = [stats for stats in results if "error" in stats]
+    synthesis = sum(stats.get("synthesis_s", 0) for stats in results)
+    lines = [f"\nLibrary: {len(results) - len(failed)} of {len(results)} books rendered in "
+             f"{datetime.timedelta(seconds=round(wall))}, synthesizing for {100 * synthesis / max(wall, 1e-9):.0f}% "
+             f"of it"]
+    for stats in results:
+        name = os.path.basename(stats["book"])
+        if "synthesis_s" not in stats:
+            lines.append(f"  {name}: failed, {stats['error']}")
+            continue
+        audio = stats["samples"] / sample_rate
+        seconds = max(stats["synthesis_s"], 1e-9)
+        line = (f"  {name}: {datetime.timedelta(seconds=round(audio))} of audio in "
+                f"{datetime.timedelta(seconds=round(seconds))}, {audio / seconds:.1f}s of audio per second, "
+                f"{stats['chars'] / seconds:.0f} chars/s")
+        if "error" in stats:
+            line += f"; m4b failed, {stats['error']}"
+        else:
+            line += f"; m4b in {stats['mux_s']:.1f}s -> {stats['m4b']}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def _synthesis_module():
+    if __package__:
+        from . import epub2tts_kokoro
+    else:
+        import epub2tts_kokoro
+    return epub2tts_kokoro
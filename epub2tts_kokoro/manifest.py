@@ -0,0 +1,348 @@
+"""
+Resumable render jobs.
+
+Each job (book + voice + settings) renders into its own work directory.
+Paragraph audio is appended to a raw float32 spool per chapter and every
+step is recorded in an append-only journal with the text hash, sample
+count and PCM hash, so a restarted job can verify exactly which units are
+complete. Finished chapters are encoded to a temp file and renamed into
+place before they are journaled.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+import soundfile
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory locking on Windows
+    fcntl = None
+
+JOURNAL = "journal.jsonl"
+# Samples read from a spool at a time when its chapter is encoded (10s of Kokoro audio)
+SPOOL_BLOCK = 240000
+MANIFEST = "manifest.json"
+LOCKFILE = "lock"
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def atomic_write(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def job_settings(speaker, speed, paragraphpause, notitles, model, postprocess=True, packing=True):
+    return {
+        "speaker": speaker,
+        "speed": speed,
+        "paragraphpause": paragraphpause,
+        "notitles": bool(notitles),
+        "model": model,
+        "postprocess": bool(postprocess),
+        "packing": bool(packing),
+    }
+
+
+def job_workdir(sourcefile, settings):
+    # Settings are part of the name so jobs for the same book never share a directory
+    job_id = text_hash(json.dumps(settings, sort_keys=True))
+    base = os.path.splitext(sourcefile)[0]
+    return f"{base}.{job_id}.work"
+
+
+class WorkdirLocked(RuntimeError):
+    # Another job is rendering into the work directory
+    pass
+
+
+class JobManifest:
+    def __init__(self, workdir, settings):
+        self.workdir = workdir
+        self.settings = settings
+        # chapter -> journaled paragraph records, in order
+        self.paragraphs = {}
+        # chapter -> record of the encoded part file
+        self.chapters = {}
+        # text hash -> where that audio sits in a snapshot of the previous render
+        self.previous_paragraphs = {}
+        self.previous_chapters = {}
+        self.reused_paragraphs = 0
+        self.reused_samples = 0
+        self.rendered_paragraphs = 0
+        self.rendered_samples = 0
+        # the journal is written from both the prep and write stages of render_book
+        self._journal_lock = threading.Lock()
+        os.makedirs(workdir, exist_ok=True)
+        self._lock()
+
+        manifest_path = os.path.join(workdir, MANIFEST)
+        journal_path = os.path.join(workdir, JOURNAL)
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, encoding="utf-8") as f:
+                previous = json.load(f)
+            if previous.get("settings") != settings:
+                print(f"Settings changed, discarding previous work in {workdir}")
+                self._reset()
+        atomic_write(manifest_path, json.dumps({"settings": settings}, indent=1).encode("utf-8"))
+        if os.path.isfile(journal_path):
+            self._replay(journal_path)
+        self.journal = open(journal_path, "a", encoding="utf-8")
+
+    def _lock(self):
+        self._lockfile = open(os.path.join(self.workdir, LOCKFILE), "w")
+        if fcntl is None:
+            return
+        try:
+            fcntl.flock(self._lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lockfile.close()
+            raise WorkdirLocked(f"Another job is already rendering into {self.workdir}")
+
+    def _reset(self):
+        for name in os.listdir(self.workdir):
+            if name != LOCKFILE:
+                os.remove(os.path.join(self.workdir, name))
+
+    def _replay(self, journal_path):
+        with open(journal_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn write from a killed job, everything after it is unverified
+                    break
+                chapter = record["chapter"]
+                if record["type"] == "paragraph":
+                    self.paragraphs.setdefault(chapter, []).append(record)
+                elif record["type"] == "truncate":
+                    self.paragraphs[chapter] = self.paragraphs.get(chapter, [])[:record["paragraphs"]]
+                    self.chapters.pop(chapter, None)
+                elif record["type"] == "chapter":
+                    self.chapters[chapter] = record
+
+    def _record(self, record):
+        with self._journal_lock:
+            self.journal.write(json.dumps(record) + "\n")
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def spool_path(self, chapter):
+        return os.path.join(self.workdir, f"chapter{chapter}.pcm")
+
+    def part_path(self, chapter):
+        return os.path.join(self.workdir, f"part{chapter}.flac")
+
+    def previous_path(self, chapter):
+        return os.path.join(self.workdir, f"previous{chapter}.flac")
+
+    def _verified_part(self, chapter):
+        record = self.chapters.get(chapter)
+        part = self.part_path(chapter)
+        return (record is not None and os.path.isfile(part) and os.path.getsize(part) == record["size"]
+                and file_hash(part) == record["sha256"])
+
+    def index_previous_render(self):
+        """
+        Snapshot every verified part file of the previous render so its audio
+        can be reused by text hash after the text was edited.
+
+        Parts are hard-linked (copied where links are not supported), so
+        re-rendering a chapter never overwrites audio a later chapter still needs.
+        """
+        for chapter in list(self.chapters):
+            if not self._verified_part(chapter):
+                continue
+            previous = self.previous_path(chapter)
+            if os.path.exists(previous):
+                os.remove(previous)
+            try:
+                os.link(self.part_path(chapter), previous)
+            except OSError:
+                shutil.copyfile(self.part_path(chapter), previous)
+            record = self.chapters[chapter]
+            paragraphs = self.paragraphs.get(chapter, [])
+            self.previous_chapters.setdefault(record["text"], (previous, record, paragraphs))
+            for paragraph in paragraphs:
+                self.previous_paragraphs.setdefault(
+                    paragraph["text"], (previous, paragraph["offset"], paragraph["samples"], record.get("gain", 1.0)))
+
+    def completed_chapter(self, chapter, texts):
+        """
+        Return the part file for a chapter if it is journaled as done for this exact text
+        and the file on disk is the one that was written, otherwise None.
+
+        A chapter whose text matches a chapter of the previous render at
+        another position (chapters inserted or removed before it) is taken
+        over from there without decoding.
+        """
+        chapter_hash = text_hash("\n".join(texts))
+        record = self.chapters.get(chapter)
+        if record is not None and record["text"] == chapter_hash and self._verified_part(chapter):
+            part = self.part_path(chapter)
+        elif chapter_hash in self.previous_chapters:
+            previous, record, paragraphs = self.previous_chapters[chapter_hash]
+            part = self.part_path(chapter)
+            shutil.copyfile(previous, part + ".tmp")
+            os.replace(part + ".tmp", part)
+            self._record({"type": "truncate", "chapter": chapter, "paragraphs": 0})
+            self.paragraphs[chapter] = []
+            for paragraph in paragraphs:
+                paragraph = dict(paragraph, chapter=chapter)
+                self._record(paragraph)
+                self.paragraphs[chapter].append(paragraph)
+            record = dict(record, chapter=chapter)
+            self._record(record)
+            self.chapters[chapter] = record
+        else:
+            return None
+        self.reused_paragraphs += len(texts)
+        # Paragraph samples, as resume_chapter and append_paragraph count them; the chapter
+        # record's samples would add the title and chapter pause on top
+        self.reused_samples += sum(paragraph["samples"] for paragraph in self.paragraphs.get(chapter, []))
+        return part
+
+    def can_reuse(self, text):
+        return text_hash(text) in self.previous_paragraphs
+
+    def reuse_paragraph(self, text):
+        """
+        Return the audio (pause included) of a paragraph with exactly this text
+        from the previous render, or None. The gain its chapter was encoded
+        with is undone, so it goes back into the spool as it was synthesized.
+        """
+        previous = self.previous_paragraphs.get(text_hash(text))
+        if previous is None:
+            return None
+        path, offset, samples, gain = previous
+        audio, _ = soundfile.read(path, start=offset, frames=samples, dtype="float32")
+        return audio / np.float32(gain) if gain != 1.0 else audio
+
+    def resume_chapter(self, chapter, texts):
+        """
+        Verify the chapter spool against the journal and cut it back to the last good paragraph.
+
+        Returns:
+            int: number of leading paragraphs of texts that are already rendered.
+        """
+        records = self.paragraphs.get(chapter, [])
+        spool = self.spool_path(chapter)
+        verified = 0
+        offset = 0
+        if os.path.isfile(spool):
+            with open(spool, "rb") as f:
+                for pindex, record in enumerate(records):
+                    if (pindex >= len(texts) or record["index"] != pindex
+                            or record["text"] != text_hash(texts[pindex]) or record["offset"] != offset):
+                        break
+                    data = f.read(record["samples"] * 4)
+                    if len(data) != record["samples"] * 4 or hashlib.sha256(data).hexdigest() != record["pcm"]:
+                        break
+                    offset += record["samples"]
+                    verified += 1
+        with open(spool, "ab") as f:
+            f.truncate(offset * 4)
+        if verified < len(records) or chapter in self.chapters:
+            self._record({"type": "truncate", "chapter": chapter, "paragraphs": verified})
+            self.chapters.pop(chapter, None)
+        self.paragraphs[chapter] = records[:verified]
+        self.reused_paragraphs += verified
+        self.reused_samples += offset
+        return verified
+
+    def append_paragraph(self, chapter, pindex, text, audio, reused=False):
+        data = np.asarray(audio, dtype=np.float32).tobytes()
+        spool = self.spool_path(chapter)
+        offset = os.path.getsize(spool) // 4
+        with open(spool, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        record = {
+            "type": "paragraph",
+            "chapter": chapter,
+            "index": pindex,
+            "text": text_hash(text),
+            "offset": offset,
+            "samples": len(data) // 4,
+            "pcm": hashlib.sha256(data).hexdigest(),
+        }
+        self._record(record)
+        self.paragraphs.setdefault(chapter, []).append(record)
+        if reused:
+            self.reused_paragraphs += 1
+            self.reused_samples += record["samples"]
+        else:
+            self.rendered_paragraphs += 1
+            self.rendered_samples += record["samples"]
+
+    def spool_blocks(self, chapter, block=SPOOL_BLOCK):
+        # Read, not memory-mapped: mapped pages would count towards RSS for the whole chapter
+        with open(self.spool_path(chapter), "rb") as f:
+            while True:
+                audio = np.fromfile(f, dtype=np.float32, count=block)
+                if not len(audio):
+                    return
+                yield audio
+
+    def finish_chapter(self, chapter, texts, blocks, sample_rate, gain=1.0):
+        """
+        Encode a chapter's audio, given as an iterable of sample blocks, to its
+        part file, scaled by gain.
+        """
+        part = self.part_path(chapter)
+        tmp = part + ".tmp"
+        samples = 0
+        with soundfile.SoundFile(tmp, "w", sample_rate, 1, format="FLAC") as f:
+            for audio in blocks:
+                f.write(audio * np.float32(gain) if gain != 1.0 else audio)
+                samples += len(audio)
+        os.replace(tmp, part)
+        record = {
+            "type": "chapter",
+            "chapter": chapter,
+            "text": text_hash("\n".join(texts)),
+            "samples": samples,
+            "gain": gain,
+            "size": os.path.getsize(part),
+            "sha256": file_hash(part),
+        }
+        self._record(record)
+        self.chapters[chapter] = record
+        os.remove(self.spool_path(chapter))
+        return part
+
+    def reuse_report(self, sample_rate):
+        paragraphs = self.reused_paragraphs + self.rendered_paragraphs
+        samples = self.reused_samples + self.rendered_samples
+        if not paragraphs:
+            return "Nothing to render"
+        return (f"Reused {100 * self.reused_samples / max(samples, 1):.0f}% of the audio: "
+                f"{self.reused_paragraphs} of {paragraphs} paragraphs, "
+                f"{self.reused_samples / sample_rate / 60:.1f} of {samples / sample_rate / 60:.1f} minutes")
+
+    def close(self):
+        self.journal.close()
+        for name in os.listdir(self.workdir):
+            if name.startswith("previous") and name.endswith(".flac"):
+                os.remove(os.path.join(self.workdir, name))
+        self._lockfile.close()
@@ -0,0 +1,173 @@
+"""
+Per-chapter, per-stage timings of a render (--profile / --metrics-out).
+
+Every stage records spans of wall time with the characters it handled and
+the audio it produced, so the report shows where the time goes and how
+many seconds of audio each second of work yields. --metrics-out writes the
+spans as a Chrome trace (load it in chrome://tracing or ui.perfetto.dev)
+that also carries the summary under "metrics".
+"""
+import datetime
+import json
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # No getrusage on Windows, peak RSS is reported as 0 there
+    resource = None
+
+
+def peak_rss_mb(who=None):
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_SELF if who is None else who)
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    return usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def _totals():
+    return {"wall_s": 0, "spans": 0, "chars": 0, "audio_s": 0, "peak_rss_mb": 0}
+
+
+def _rates(totals):
+    wall = max(totals["wall_s"], 1e-9)
+    totals["chars_per_s"] = round(totals["chars"] / wall, 1)
+    totals["audio_s_per_wall_s"] = round(totals["audio_s"] / wall, 2)
+    for key in ("wall_s", "audio_s", "peak_rss_mb"):
+        totals[key] = round(totals[key], 3)
+    return totals
+
+
+class Metrics:
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def record(self, stage, start, chapter=None, chars=0, samples=0, end=None):
+        """
+        Record a span of stage that started at start (a time.perf_counter()
+        value) and ends now, or at end. chapter is None for whole-book stages.
+        """
+        end = time.perf_counter() if end is None else end
+        span = {
+            "stage": stage,
+            "chapter": chapter,
+            "start": start - self.origin,
+            "end": end - self.origin,
+            "chars": chars,
+            "audio_s": samples / self.sample_rate,
+            "thread": threading.current_thread().name,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        with self.lock:
+            self.spans.append(span)
+
+    def summary(self):
+        with self.lock:
+            spans = list(self.spans)
+        stages = {}
+        chapters = {}
+        for span in spans:
+            chapter = "book" if span["chapter"] is None else str(span["chapter"])
+            for totals in (stages.setdefault(span["stage"], _totals()),
+                           chapters.setdefault(chapter, {}).setdefault(span["stage"], _totals())):
+                totals["wall_s"] += span["end"] - span["start"]
+                totals["spans"] += 1
+                totals["chars"] += span["chars"]
+                totals["audio_s"] += span["audio_s"]
+                totals["peak_rss_mb"] = max(totals["peak_rss_mb"], span["peak_rss_mb"])
+        wall = time.perf_counter() - self.origin
+        # inference is the only stage that produces audio, the others pass it on
+        audio = stages["inference"]["audio_s"] if "inference" in stages else 0
+        return {
+            "wall_s": round(wall, 3),
+            "audio_s": round(audio, 3),
+            "audio_s_per_wall_s": round(audio / max(wall, 1e-9), 2),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "peak_child_rss_mb": round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1) if resource else 0,
+            "stages": {name: _rates(totals) for name, totals in stages.items()},
+            "chapters": {chapter: {name: _rates(totals) for name, totals in table.items()}
+                         for chapter, table in chapters.items()},
+        }
+
+    def report(self):
+        summary = self.summary()
+        lines = [f"Profile: {summary['audio_s']:.0f}s of audio in {summary['wall_s']:.1f}s "
+                 f"({summary['audio_s_per_wall_s']:.1f}x real time), peak RSS {summary['peak_rss_mb']:.0f}MB"]
+        for name, totals in summary["stages"].items():
+            line = f"  {name:>12}: {totals['wall_s']:8.1f}s in {totals['spans']} spans"
+            if totals["chars"]:
+                line += f", {totals['chars_per_s']:.0f} chars/s"
+            if totals["audio_s"]:
+                line += f", {totals['audio_s_per_wall_s']:.1f}s of audio per second"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def trace(self):
+        # Chrome trace event format: complete events per span, counters for RSS
+        with self.lock:
+            spans = list(self.spans)
+        threads = {}
+        events = []
+        for span in spans:
+            tid = threads.setdefault(span["thread"], len(threads) + 1)
+            events.append({
+                "name": span["stage"],
+                "cat": "book" if span["chapter"] is None else f"chapter {span['chapter']}",
+                "ph": "X",
+                "pid": 1,
+                "tid": tid,
+                "ts": round(span["start"] * 1e6, 1),
+                "dur": round((span["end"] - span["start"]) * 1e6, 1),
+                "args": {"chapter": span["chapter"], "chars": span["chars"], "audio_s": round(span["audio_s"], 3)},
+            })
+            events.append({"name": "peak RSS (MB)", "ph": "C", "pid": 1, "ts": round(span["end"] * 1e6, 1),
+                           "args": {"rss": round(span["peak_rss_mb"], 1)}})
+        for name, tid in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": name}})
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "metrics": dict(self.summary(),
+                            created=datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")),
+        }
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.trace(), f)
+
+
+class CharacterETA:
+    """
+    Time left for the whole book, weighted by characters rather than
+    paragraphs: synthesis time follows text length, and paragraphs range
+    from a few words to whole pages.
+    """
+    def __init__(self, total_chars):
+        self.total = total_chars
+        self.done = 0
+        self.synthesized = 0
+        self.start = time.perf_counter()
+
+    def update(self, chars, synthesized=True):
+        # Reused and resumed paragraphs count as done but say nothing about the synthesis rate
+        self.done += chars
+        if synthesized:
+            self.synthesized += chars
+
+    def seconds_left(self):
+        elapsed = time.perf_counter() - self.start
+        if not self.synthesized or not elapsed:
+            return None
+        return (self.total - self.done) / (self.synthesized / elapsed)
+
+    def __str__(self):
+        left = self.seconds_left()
+        if left is None:
+            return "ETA unknown"
+        return f"ETA {datetime.timedelta(seconds=round(left))}"
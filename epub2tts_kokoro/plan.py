@@ -0,0 +1,54 @@
+"""
+Segmentation plans.
+
+A plan is a book as it will be read: chapters, their paragraphs and the
+synthesis-ready segments of every paragraph. It is built once per source
+text and saved next to it as JSON, one segment per line, so later runs skip
+sentence tokenization and the chunking of a book can be inspected or diffed
+before any audio is rendered.
+"""
+import json
+import os
+
+if __package__:
+    from .manifest import atomic_write, file_hash
+else:
+    from manifest import atomic_write, file_hash
+
+# Bump whenever the segmentation rules change, so old plans are rebuilt
+PLAN_VERSION = 1
+
+
+def plan_path(sourcefile):
+    # Keep the extension, mybook.epub (--direct) and mybook.txt get plans of their own
+    return sourcefile + ".plan.json"
+
+
+def load_plan(sourcefile, segmenter):
+    """
+    Return the saved plan for sourcefile, or None if there is none or it was
+    built from other text or by another segmenter.
+    """
+    try:
+        with open(plan_path(sourcefile), encoding="utf-8") as f:
+            plan = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if (plan.get("version") != PLAN_VERSION or plan.get("segmenter") != segmenter
+            or plan.get("source") != file_hash(sourcefile)):
+        return None
+    return plan
+
+
+def save_plan(sourcefile, segmenter, plan):
+    plan = {"version": PLAN_VERSION, "segmenter": segmenter, "source": file_hash(sourcefile), **plan}
+    atomic_write(plan_path(sourcefile), json.dumps(plan, indent=1, ensure_ascii=False).encode("utf-8"))
+    return plan
+
+
+def plan_summary(plan):
+    chapters = plan["chapters"]
+    paragraphs = [p for chapter in chapters for p in chapter["paragraphs"]]
+    segments = [s for p in paragraphs for s in p["segments"]]
+    return (f"{len(chapters)} chapters, {len(paragraphs)} paragraphs, {len(segments)} segments, "
+            f"{sum(len(s) for s in segments)} characters")
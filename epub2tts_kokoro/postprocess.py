@@ -0,0 +1,111 @@
+"""
+Post-processing of synthesized audio, on the float32 arrays coming out of
+the model before anything is written to disk.
+
+Kokoro starts and ends every segment with a varying stretch of near-silence,
+so the gaps between sentences drift from almost nothing to half a second.
+Segments are trimmed by frame energy and joined with a fixed pause, fading
+the trimmed edges so a cut never clicks. Chapters are normalized to a common
+loudness: the RMS of their voiced frames, with peaks kept below PEAK_DB.
+
+Everything works on whole frames with numpy reductions, a few milliseconds
+per minute of audio.
+"""
+import numpy as np
+
+# Frames quieter than this (dBFS RMS) count as silence
+SILENCE_DB = -50
+# Analysis frame
+FRAME_MS = 10
+# Audio kept around the first and last voiced frame of a segment
+TRIM_PAD_MS = 30
+# Fade in and out at trimmed edges
+FADE_MS = 5
+# Pause between the segments of a paragraph
+SENTENCE_PAUSE_MS = 250
+# Loudness chapters are normalized to (dBFS RMS of voiced frames) and their peak ceiling
+TARGET_DB = -20
+PEAK_DB = -3
+
+
+def _frames(sample_rate, ms):
+    return sample_rate * ms // 1000
+
+
+def frame_energy(audio, frame):
+    # Mean square of every whole frame
+    frames = len(audio) // frame
+    return np.square(audio[:frames * frame], dtype=np.float64).reshape(frames, frame).mean(axis=1)
+
+
+def trim(audio, sample_rate):
+    """
+    audio without its leading and trailing silence, as a view. Segments with
+    no voiced frame at all come back empty.
+    """
+    frame = _frames(sample_rate, FRAME_MS)
+    voiced = np.flatnonzero(frame_energy(audio, frame) > 10 ** (SILENCE_DB / 10))
+    if not len(voiced):
+        return audio[:0] if len(audio) >= frame else audio
+    pad = _frames(sample_rate, TRIM_PAD_MS)
+    return audio[max(voiced[0] * frame - pad, 0):min((voiced[-1] + 1) * frame + pad, len(audio))]
+
+
+def join_segments(pieces, sample_rate, pause_ms=SENTENCE_PAUSE_MS):
+    """
+    Trim every segment and join them with pause_ms of silence in between.
+    """
+    fade = _frames(sample_rate, FADE_MS)
+    ramp = np.square(np.sin(np.linspace(0, np.pi / 2, fade, dtype=np.float32)))
+    pause = np.zeros(_frames(sample_rate, pause_ms), dtype=np.float32)
+    joined = []
+    for piece in pieces:
+        piece = trim(np.asarray(piece, dtype=np.float32), sample_rate)
+        if not len(piece):
+            continue
+        if len(piece) > 2 * fade:
+            piece = piece.copy()
+            piece[:fade] *= ramp
+            piece[-fade:] *= ramp[::-1]
+        if joined:
+            joined.append(pause)
+        joined.append(piece)
+    return np.concatenate(joined) if joined else np.zeros(0, dtype=np.float32)
+
+
+def loudness_stats(audio, sample_rate):
+    """
+    (energy, voiced, peak) of audio: the summed mean square of its voiced
+    frames, their count and its peak. Stats of consecutive whole-frame
+    blocks add up (peaks by max), see stats_gain.
+    """
+    if not len(audio):
+        return 0.0, 0, 0.0
+    frames = frame_energy(audio, _frames(sample_rate, FRAME_MS))
+    frames = frames[frames > 10 ** (SILENCE_DB / 10)]
+    return float(frames.sum()), len(frames), float(np.abs(audio).max())
+
+
+def stats_gain(energy, voiced, peak):
+    # Gain to TARGET_DB without peaks above PEAK_DB, from loudness_stats
+    if not voiced or not peak:
+        return 1.0
+    gain_db = min(TARGET_DB - 10 * np.log10(energy / voiced), PEAK_DB - 20 * np.log10(peak))
+    return float(10 ** (gain_db / 20))
+
+
+def loudness_gain(blocks, sample_rate):
+    """
+    Gain that brings audio, given as an iterable of blocks, to TARGET_DB
+    without peaks above PEAK_DB. Blocks should be whole frames long (the
+    last one aside).
+    """
+    energy = 0.0
+    voiced = 0
+    peak = 0.0
+    for audio in blocks:
+        block_energy, block_voiced, block_peak = loudness_stats(audio, sample_rate)
+        energy += block_energy
+        voiced += block_voiced
+        peak = max(peak, block_peak)
+    return stats_gain(energy, voiced, peak)
@@ -0,0 +1,242 @@
+"""
+Listen to a book while it is still being rendered.
+
+BookStream keeps track of where every rendered paragraph's audio is on disk
+(read_book reports it through on_paragraph/on_chapter), and a local HTTP
+server streams it as 16-bit WAV from any chapter and paragraph onwards,
+waiting for paragraphs that are not rendered yet.
+
+    GET /                            player page with the chapter list
+    GET /chapters                    chapters as JSON, with rendered paragraph counts
+    GET /stream?chapter=N&paragraph=M  chunked audio/wav from there to the end of the book
+"""
+import html
+import json
+import struct
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import soundfile
+
+if __package__:
+    from .postprocess import FRAME_MS, loudness_stats, stats_gain
+else:
+    from postprocess import FRAME_MS, loudness_stats, stats_gain
+
+# Pause streamed between chapters, as finish_chapter appends to every part
+CHAPTER_PAUSE_MS = 2000
+
+
+def wav_header(sample_rate):
+    # Streaming WAV: the sizes are unknown, so they are set to the maximum
+    return (b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVE"
+            + b"fmt " + struct.pack("<IHHIIHH", 16, 1, 1, sample_rate, sample_rate * 2, 2, 16)
+            + b"data" + struct.pack("<I", 0xFFFFFFFF))
+
+
+def pcm16(audio):
+    return (np.clip(audio, -1, 1) * 32767).astype("<i2").tobytes()
+
+
+class BookStream:
+    """
+    Rendered audio of a book so far, by chapter and paragraph.
+
+    chapters is a list of (title, texts) in book order, texts being what
+    read_book reads aloud for the chapter (see chapter_texts).
+
+    With normalize (post-processing on), paragraphs still in the spool are
+    scaled by the loudness gain of their chapter so far, from its start to
+    the end of the paragraph. The level is approximate: the gain settles as
+    the chapter goes on, and the finished part file has the gain of the
+    whole chapter.
+    """
+    def __init__(self, chapters, sample_rate, normalize=True):
+        self.chapters = chapters
+        self.sample_rate = sample_rate
+        self.normalize = normalize
+        self.condition = threading.Condition()
+        # chapter index -> {pindex: (spool, offset, samples)}, chapter index -> part file
+        self.paragraphs = {i: {} for i in range(1, len(chapters) + 1)}
+        self.parts = {}
+        self.finished = False
+        # chapter index -> [spool samples counted, energy, voiced frames, peak] (see loudness_stats)
+        self.loudness = {}
+        self.loudness_lock = threading.Lock()
+
+    def on_paragraph(self, chapter, pindex, spool, offset, samples):
+        with self.condition:
+            self.paragraphs[chapter][pindex] = (spool, offset, samples)
+            self.condition.notify_all()
+
+    def on_chapter(self, chapter, partname, samples=None):
+        with self.condition:
+            self.parts[chapter] = partname
+            self.condition.notify_all()
+
+    def finish(self):
+        # Rendering stopped, paragraphs that are missing now never arrive
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+    def wait(self, chapter, pindex):
+        with self.condition:
+            while pindex not in self.paragraphs[chapter] and not self.finished:
+                self.condition.wait()
+            return self.paragraphs[chapter].get(pindex)
+
+    def read(self, chapter, pindex):
+        """
+        Audio of one paragraph (pause included), waiting for it to be rendered.
+        None if rendering stopped without it.
+        """
+        location = self.wait(chapter, pindex)
+        if location is None:
+            return None
+        spool, offset, samples = location
+        if spool is not None:
+            try:
+                audio = np.fromfile(spool, dtype=np.float32, count=samples, offset=offset * 4)
+                if self.normalize:
+                    audio = audio * np.float32(self.spool_gain(chapter, spool, offset + samples))
+                return audio
+            except FileNotFoundError:
+                # finished and encoded since it was reported, the same offsets hold in the part file
+                pass
+        with self.condition:
+            while chapter not in self.parts and not self.finished:
+                self.condition.wait()
+            part = self.parts.get(chapter)
+        if part is None:
+            return None
+        audio, _ = soundfile.read(part, start=offset, frames=samples, dtype="float32")
+        return audio
+
+    def spool_gain(self, chapter, spool, end):
+        # Running gain over the chapter's spool up to end, adding only what was not counted yet
+        frame = self.sample_rate * FRAME_MS // 1000
+        with self.loudness_lock:
+            stats = self.loudness.setdefault(chapter, [0, 0.0, 0, 0.0])
+            count = end // frame * frame - stats[0]
+            if count > 0:
+                audio = np.fromfile(spool, dtype=np.float32, count=count, offset=stats[0] * 4)
+                energy, voiced, peak = loudness_stats(audio, self.sample_rate)
+                stats[0] += len(audio)
+                stats[1] += energy
+                stats[2] += voiced
+                stats[3] = max(stats[3], peak)
+            return stats_gain(*stats[1:])
+
+    def listing(self):
+        with self.condition:
+            return [{
+                "chapter": i,
+                "title": title,
+                "paragraphs": len(texts),
+                "rendered": len(self.paragraphs[i]),
+            } for i, (title, texts) in enumerate(self.chapters, start=1)]
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # set on the subclass made by start_server
+    stream = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            chapter = int(query.get("chapter", ["1"])[0])
+            paragraph = int(query.get("paragraph", ["0"])[0])
+        except ValueError:
+            return self._send(400, "text/plain", b"chapter and paragraph must be numbers\n")
+        if url.path == "/chapters":
+            return self._send(200, "application/json", json.dumps(self.stream.listing(), indent=1).encode("utf-8"))
+        if not 1 <= chapter <= len(self.stream.chapters):
+            return self._send(404, "text/plain", b"no such chapter\n")
+        if paragraph < 0:
+            return self._send(400, "text/plain", b"paragraph must not be negative\n")
+        # a chapter without paragraphs can still be started at 0
+        if paragraph >= max(len(self.stream.chapters[chapter - 1][1]), 1):
+            return self._send(404, "text/plain", b"no such paragraph\n")
+        if url.path == "/":
+            return self._send(200, "text/html; charset=utf-8", self.page(chapter, paragraph).encode("utf-8"))
+        if url.path == "/stream":
+            return self.stream_audio(chapter, paragraph)
+        self._send(404, "text/plain", b"not found\n")
+
+    def stream_audio(self, chapter, paragraph):
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/wav")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        stream = self.stream
+        try:
+            self._chunk(wav_header(stream.sample_rate))
+            for data in self.book_audio(chapter, paragraph):
+                self._chunk(data)
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # listener went away
+            self.close_connection = True
+
+    def book_audio(self, chapter, paragraph):
+        # PCM of every paragraph from chapter/paragraph on, until the end of the book or of rendering
+        stream = self.stream
+        chapter_pause = pcm16(np.zeros(int(stream.sample_rate * CHAPTER_PAUSE_MS / 1000), dtype=np.float32))
+        for i in range(chapter, len(stream.chapters) + 1):
+            title, texts = stream.chapters[i - 1]
+            for pindex in range(paragraph if i == chapter else 0, len(texts)):
+                audio = stream.read(i, pindex)
+                if audio is None:
+                    return
+                yield pcm16(audio)
+            yield chapter_pause
+
+    def page(self, chapter, paragraph):
+        stream = self.stream
+        title, texts = stream.chapters[chapter - 1]
+        chapters = "".join(
+            f'<li><a href="/?chapter={c["chapter"]}">{html.escape(c["title"])}</a> '
+            f'({c["rendered"]}/{c["paragraphs"]} rendered)</li>'
+            for c in stream.listing())
+        paragraphs = "".join(
+            f'<li><a href="/?chapter={chapter}&paragraph={k}">{html.escape(text[:80])}</a></li>'
+            for k, text in enumerate(texts))
+        return (f"<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>{html.escape(title)}</title></head>"
+                f"<body><h1>{html.escape(title)}</h1>"
+                f"<audio controls autoplay src=\"/stream?chapter={chapter}&paragraph={paragraph}\"></audio>"
+                f"<h2>Paragraphs</h2><ol start=\"0\">{paragraphs}</ol>"
+                f"<h2>Chapters</h2><ol>{chapters}</ol></body></html>")
+
+
+def start_server(stream, port=8000, host="127.0.0.1"):
+    """
+    Serve stream on host:port from a background thread.
+
+    Returns:
+        ThreadingHTTPServer: call shutdown() on it to stop serving.
+    """
+    handler = type("BookStreamHandler", (StreamHandler,), {"stream": stream})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="serve", daemon=True).start()
+    return server
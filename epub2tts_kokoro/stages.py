@@ -0,0 +1,141 @@
+"""
+Threaded stage pipeline.
+
+Every stage runs in its own thread and hands items to the next stage over a
+bounded queue, so a slow stage holds the ones before it back instead of
+letting audio pile up in memory. Each stage keeps track of the time it
+spends working, waiting for input and waiting for room in the next queue.
+"""
+import queue
+import threading
+import time
+
+# Sentinel passed down the queues once the source is exhausted
+_END = object()
+
+
+class Stage:
+    def __init__(self, name, fn):
+        # fn(item) returns an iterable of items for the next stage (or None)
+        self.name = name
+        self.fn = fn
+        self.items = 0
+        self.busy = 0
+        self.starved = 0
+        self.blocked = 0
+
+
+class StagePipeline:
+    """
+    Run the items of a source iterable through stages, each in its own thread.
+
+    source is a (name, iterable) pair and stages a list of (name, fn) pairs.
+    Items keep their order, and an exception in any stage stops the others
+    and is re-raised by run().
+    """
+    def __init__(self, source, stages, queue_size=8):
+        name, self.source = source
+        self.stages = [Stage(name, None)] + [Stage(name, fn) for name, fn in stages]
+        self.queue_size = queue_size
+        self.stop = threading.Event()
+        self.error = None
+        self.wall = 0
+
+    def _put(self, q, item):
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _END
+
+    def _emit(self, stage, results, output):
+        # Time spent producing results is work, time spent handing them on is backpressure
+        if results is None:
+            return True
+        results = iter(results)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(results)
+            except StopIteration:
+                stage.busy += time.perf_counter() - start
+                return True
+            stage.busy += time.perf_counter() - start
+            if output is None:
+                continue
+            start = time.perf_counter()
+            delivered = self._put(output, item)
+            stage.blocked += time.perf_counter() - start
+            if not delivered:
+                return False
+
+    def _count(self, stage, items):
+        for item in items:
+            stage.items += 1
+            yield item
+
+    def _run(self, stage, inputs, output):
+        try:
+            if inputs is None:
+                self._emit(stage, self._count(stage, self.source), output)
+            else:
+                while True:
+                    start = time.perf_counter()
+                    item = self._get(inputs)
+                    stage.starved += time.perf_counter() - start
+                    if item is _END:
+                        break
+                    stage.items += 1
+                    start = time.perf_counter()
+                    results = stage.fn(item)
+                    stage.busy += time.perf_counter() - start
+                    if not self._emit(stage, results, output):
+                        break
+        except BaseException as e:
+            if self.error is None:
+                self.error = e
+            self.stop.set()
+        finally:
+            if output is not None:
+                self._put(output, _END)
+
+    def run(self):
+        start = time.perf_counter()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages[1:]] + [None]
+        threads = []
+        for k, stage in enumerate(self.stages):
+            inputs = queues[k - 1] if k else None
+            thread = threading.Thread(target=self._run, args=(stage, inputs, queues[k]), name=stage.name,
+                                      daemon=True)
+            thread.start()
+            threads.append(thread)
+        try:
+            for thread in threads:
+                # join with a timeout so Ctrl-C still reaches the main thread
+                while thread.is_alive():
+                    thread.join(0.5)
+        except BaseException:
+            self.stop.set()
+            raise
+        self.wall = time.perf_counter() - start
+        if self.error is not None:
+            raise self.error
+
+    def report(self):
+        wall = max(self.wall, 1e-9)
+        lines = [f"Pipeline stages over {self.wall:.1f}s:"]
+        for stage in self.stages:
+            lines.append(f"  {stage.name:>10}: {stage.items} items, busy {100 * stage.busy / wall:3.0f}%, "
+                         f"waiting for input {100 * stage.starved / wall:3.0f}%, "
+                         f"waiting on the next stage {100 * stage.blocked / wall:3.0f}%")
+        return "\n".join(lines)
@@ -0,0 +1,425 @@
+"""
+Render a book's chapters on several machines through a shared directory.
+
+The coordinator (epub2tts-kokoro mybook.txt --queue DIR) writes the book's
+segmentation plan and settings to DIR, waits for every chapter's part file
+and then builds the m4b as usual. Workers on any host that mounts DIR
+claim chapters one at a time, render them like a local run would and
+publish the part file with its sample count:
+
+    epub2tts-kokoro-worker DIR [--workdir LOCAL] [--batch-size N] ...
+    python -m epub2tts_kokoro.workqueue DIR ...
+
+Each worker loads the model and its G2P pool once, for its first chapter,
+and keeps them for every chapter after it.
+
+A claimed chapter is held by a lease file that its worker touches every
+few seconds. A lease not touched for --lease seconds is taken to belong to
+a dead worker and the chapter goes back to the queue. Everything relies on
+atomic renames and O_EXCL creates only, which network filesystems (NFS,
+SMB) provide; lease expiry compares file times with the local clock, so
+hosts need roughly synchronized clocks.
+
+A worker whose lease expired while it was rendering (a slow or suspended
+one) does not publish its chapter. Should two workers still complete the
+same chapter, that is harmless: parts are published under the worker's
+name and the done record that wins the last rename says which one counts.
+
+    DIR/book.json               plan and settings, written by the coordinator
+    DIR/leases/chapterN.json    who renders chapter N, touched while it does
+    DIR/done/chapterN.json      chapter N is rendered: part file and samples
+    DIR/parts/partN.WORKER.flac
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import sys
+import threading
+import time
+
+if __package__:
+    from .backends import cache_dir
+    from .calibrate import load_calibration
+    from .g2p import PhonemeStage
+    from .manifest import atomic_write, text_hash
+else:
+    from backends import cache_dir
+    from calibrate import load_calibration
+    from g2p import PhonemeStage
+    from manifest import atomic_write, text_hash
+
+# Seconds without a heartbeat after which a lease is considered dead
+LEASE_SECONDS = 120
+# Seconds between polls of the queue directory
+POLL_SECONDS = 2
+
+
+class WorkQueue:
+    def __init__(self, directory, lease_seconds=LEASE_SECONDS):
+        self.directory = directory
+        self.lease_seconds = lease_seconds
+        self.book_path = os.path.join(directory, "book.json")
+
+    def _dir(self, name):
+        return os.path.join(self.directory, name)
+
+    def lease_path(self, chapter):
+        return os.path.join(self._dir("leases"), f"chapter{chapter}.json")
+
+    def done_path(self, chapter):
+        return os.path.join(self._dir("done"), f"chapter{chapter}.json")
+
+    def publish(self, book):
+        """
+        Put a book on the queue, or pick up where an earlier coordinator of the
+        same book left off. A directory holding another book is refused.
+        """
+        for name in ("leases", "done", "parts"):
+            os.makedirs(self._dir(name), exist_ok=True)
+        book = dict(book, id=text_hash(json.dumps(book, sort_keys=True)))
+        current = self.book()
+        if current is not None and current["id"] != book["id"]:
+            raise RuntimeError(f"{self.directory} holds another book or other settings, use an empty directory")
+        if current is None:
+            atomic_write(self.book_path, json.dumps(book, ensure_ascii=False).encode("utf-8"))
+        return book
+
+    def book(self):
+        try:
+            with open(self.book_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def done(self, chapter):
+        try:
+            with open(self.done_path(chapter), encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _lease(self, chapter):
+        # (holder, seconds since the last heartbeat, claim time), None if nobody holds it
+        path = self.lease_path(chapter)
+        try:
+            age = time.time() - os.path.getmtime(path)
+            holder, claimed = _lease_record(path)
+        except FileNotFoundError:
+            return None
+        return holder, age, claimed
+
+    def _acquire(self, chapter, worker):
+        path = self.lease_path(chapter)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            lease = self._lease(chapter)
+            if lease is None or lease[1] < self.lease_seconds:
+                return False
+            # Only one of the workers seeing it expired wins the rename
+            stale = f"{path}.{worker}.expired"
+            try:
+                os.rename(path, stale)
+            except FileNotFoundError:
+                return False
+            if _lease_record(stale) != (lease[0], lease[2]):
+                # another worker expired it first and what was moved is its fresh lease: put it back
+                self._restore(stale, path)
+                return False
+            os.remove(stale)
+            print(f"Lease of {lease[0]} on chapter {chapter} expired after {lease[1]:.0f}s, re-queued")
+            return self._acquire(chapter, worker)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"worker": worker, "claimed": time.time()}, f)
+        return True
+
+    def _restore(self, stale, path):
+        try:
+            # a link keeps the file its worker may still be writing the lease into
+            os.link(stale, path)
+        except FileExistsError:
+            # yet another lease took its place, the worker of the moved one finds out on its next heartbeat
+            pass
+        except OSError:
+            # no hard links on this filesystem
+            with open(stale, "rb") as f:
+                data = f.read()
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                pass
+            else:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+        os.remove(stale)
+
+    def claim(self, chapters, worker):
+        """
+        Lease the first chapter (of chapters, in order) that is neither done
+        nor held by a live worker. Returns its index or None.
+        """
+        for chapter in chapters:
+            if self.done(chapter) is None and self._acquire(chapter, worker):
+                # it may have been finished between the check and the lease
+                if self.done(chapter) is None:
+                    return chapter
+                self.release(chapter, worker)
+        return None
+
+    def holds(self, chapter, worker):
+        lease = self._lease(chapter)
+        return lease is not None and lease[0] == worker
+
+    def renew(self, chapter, worker):
+        # False once the lease expired and another worker took the chapter
+        if not self.holds(chapter, worker):
+            return False
+        try:
+            os.utime(self.lease_path(chapter))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def release(self, chapter, worker):
+        if self.holds(chapter, worker):
+            try:
+                os.remove(self.lease_path(chapter))
+            except FileNotFoundError:
+                pass
+
+    def complete(self, chapter, worker, partname, samples):
+        """
+        Publish a rendered chapter: copy its part file into the queue, then
+        record it as done.
+        """
+        part = os.path.join(self._dir("parts"), f"part{chapter}.{worker}.flac")
+        shutil.copyfile(partname, part + ".tmp")
+        os.replace(part + ".tmp", part)
+        record = {"chapter": chapter, "worker": worker, "part": os.path.basename(part), "samples": samples}
+        # a temp file of its own, a worker whose lease expired may be publishing the same chapter
+        tmp = f"{self.done_path(chapter)}.{worker}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(record, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.done_path(chapter))
+        self.release(chapter, worker)
+
+    def part_path(self, record):
+        return os.path.join(self._dir("parts"), record["part"])
+
+    def status(self, chapters):
+        done = sum(1 for chapter in chapters if self.done(chapter) is not None)
+        leased = sum(1 for chapter in chapters if self.done(chapter) is None and self._lease(chapter) is not None)
+        return done, leased
+
+
+def _lease_record(path):
+    # (holder, claim time) written in a lease file
+    with open(path, encoding="utf-8") as f:
+        try:
+            record = json.load(f)
+        except ValueError:
+            # being written right now
+            return None, None
+    return record.get("worker"), record.get("claimed")
+
+
+class Heartbeat:
+    """
+    Keep a lease alive from a background thread while its chapter renders.
+    """
+    def __init__(self, queue, chapter, worker):
+        self.queue = queue
+        self.chapter = chapter
+        self.worker = worker
+        self.stop = threading.Event()
+        self.lost = False
+        self.thread = threading.Thread(target=self._run, name="heartbeat", daemon=True)
+
+    def _run(self):
+        while not self.stop.wait(self.queue.lease_seconds / 4):
+            if not self.queue.renew(self.chapter, self.worker):
+                if not self.lost:
+                    print(f"Lost the lease on chapter {self.chapter}, another worker took it over")
+                self.lost = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+
+
+def coordinate(directory, book, on_chapter=None, lease_seconds=LEASE_SECONDS):
+    """
+    Put book (settings and the chapters of its plan) on the queue in
+    directory and wait until workers rendered every chapter.
+
+    on_chapter(index, partname, samples) is called as each chapter comes in.
+
+    Returns:
+        list: paths of the part files, in chapter order.
+    """
+    queue = WorkQueue(directory, lease_seconds)
+    book = queue.publish(book)
+    chapters = list(range(1, len(book["chapters"]) + 1))
+    print(f"Queued {len(chapters)} chapters in {directory}, start workers with: epub2tts-kokoro-worker {directory}")
+    parts = {}
+    last = None
+    while len(parts) < len(chapters):
+        for chapter in chapters:
+            if chapter in parts:
+                continue
+            record = queue.done(chapter)
+            if record is not None:
+                parts[chapter] = queue.part_path(record)
+                if on_chapter:
+                    on_chapter(chapter, parts[chapter], record["samples"])
+        done, leased = queue.status(chapters)
+        if (done, leased) != last:
+            print(f"{done} of {len(chapters)} chapters rendered, {leased} in progress")
+            last = (done, leased)
+        if len(parts) < len(chapters):
+            time.sleep(POLL_SECONDS)
+    return [parts[chapter] for chapter in chapters]
+
+
+def worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def load_worker_pipeline(book, args):
+    # The model and G2P pool a worker keeps for every chapter it renders
+    e2t.set_default_device()
+    if args.threads:
+        import torch
+        torch.set_num_threads(args.threads)
+    pipeline = e2t.load_pipeline(book["speaker"][0], backend=book["backend"])
+    phoneme_cache = os.path.join(args.cache_dir, "phonemes.sqlite") if args.cache_dir else None
+    if args.cache_dir:
+        os.makedirs(args.cache_dir, exist_ok=True)
+    return pipeline, PhonemeStage(pipeline, phoneme_cache, args.g2p_workers)
+
+
+def render_chapter(book, chapter, workdir, args, pipeline, g2p):
+    # One chapter as a one-chapter book, in a local work directory of its own so a restart resumes it
+    e2t.POSTPROCESS = book["postprocess"]
+    e2t.PACKING = book["packing"]
+    rendered = {}
+    parts = e2t.read_book(
+        [book["chapters"][chapter - 1]], book["speaker"], book["paragraphpause"], book["speed"], book["notitles"],
+        # batched inference bypasses other backends (see backends.py)
+        batch_size=args.batch_size if book["backend"] == "eager" else 1,
+        threads=args.threads,
+        backend=book["backend"],
+        cache_dir=args.cache_dir,
+        workdir=os.path.join(workdir, f"chapter{chapter}"),
+        on_chapter=lambda index, partname, samples: rendered.update(samples=samples),
+        pipeline=pipeline,
+        g2p=g2p,
+    )
+    return parts[0], rendered["samples"]
+
+
+def run_worker(directory, args, worker=None):
+    """
+    Render chapters from the queue in directory until none are left.
+    """
+    global e2t
+    if e2t is None:
+        e2t = _synthesis_module()
+    worker = worker or worker_id()
+    queue = WorkQueue(directory, args.lease)
+    book = queue.book()
+    while book is None:
+        print(f"Waiting for a book in {directory}")
+        time.sleep(POLL_SECONDS)
+        book = queue.book()
+    # This host's --calibrate profile fills in what is not given on the command line
+    calibration = None if args.no_calibration else load_calibration(book["backend"], book["packing"])
+    if calibration:
+        args.threads = args.threads or calibration["threads"]
+        args.batch_size = args.batch_size or calibration["batch_size"]
+    args.batch_size = args.batch_size or 1
+    chapters = list(range(1, len(book["chapters"]) + 1))
+    workdir = os.path.join(args.workdir or os.path.join(cache_dir(), "worker"), book["id"])
+    rendered = 0
+    # Loaded on the first claimed chapter, then kept for the rest
+    pipeline = g2p = None
+    try:
+        while True:
+            chapter = queue.claim(chapters, worker)
+            if chapter is None:
+                done, leased = queue.status(chapters)
+                if done == len(chapters):
+                    break
+                # the rest is leased, wait in case one of them expires
+                time.sleep(POLL_SECONDS)
+                continue
+            print(f"{worker}: rendering chapter {chapter}")
+            try:
+                with Heartbeat(queue, chapter, worker) as heartbeat:
+                    if pipeline is None:
+                        pipeline, g2p = load_worker_pipeline(book, args)
+                    partname, samples = render_chapter(book, chapter, workdir, args, pipeline, g2p)
+            except BaseException:
+                # hand the chapter straight back instead of waiting for the lease to expire
+                queue.release(chapter, worker)
+                raise
+            if heartbeat.lost or not queue.holds(chapter, worker):
+                # the worker that took the chapter over publishes it
+                print(f"{worker}: not publishing chapter {chapter}, its lease was taken over")
+                continue
+            queue.complete(chapter, worker, partname, samples)
+            rendered += 1
+    finally:
+        if g2p is not None:
+            g2p.close()
+    print(f"{worker}: every chapter is rendered, {rendered} of them here")
+    return rendered
+
+
+def _synthesis_module():
+    if __package__:
+        from . import epub2tts_kokoro
+    else:
+        import epub2tts_kokoro
+    return epub2tts_kokoro
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="epub2tts-kokoro-worker",
+        description="Render chapters queued by epub2tts-kokoro --queue DIR",
+    )
+    parser.add_argument("queue", type=str, help="Queue directory shared with the coordinator")
+    parser.add_argument("--workdir", type=str,
+                        help="Local directory for work in progress (default: ~/.cache/epub2tts-kokoro/worker)")
+    parser.add_argument("--lease", type=int, default=LEASE_SECONDS,
+                        help=f"Seconds without a heartbeat before a chapter is re-queued (default: {LEASE_SECONDS})")
+    parser.add_argument("--threads", type=int, help="torch threads (default: the calibrated profile, or all cores)")
+    parser.add_argument("--batch-size", type=int,
+                        help="Number of sentences run through the model together (default: 1, or the calibrated "
+                             "profile)")
+    parser.add_argument("--cache-dir", type=str, help="Directory for the synthesized sentence cache")
+    parser.add_argument("--g2p-workers", type=int, default=1,
+                        help="Processes converting text to phonemes ahead of inference (default: 1)")
+    parser.add_argument("--no-calibration", action="store_true",
+                        help="Ignore the profile saved by epub2tts-kokoro --calibrate")
+    args = parser.parse_args()
+    if not os.path.isdir(args.queue):
+        print(f"{args.queue} is not a directory")
+        sys.exit(1)
+    run_worker(args.queue, args)
+
+
+# epub2tts_kokoro module, imported by run_worker()
+e2t = None
+
+if __name__ == "__main__":
+    main()
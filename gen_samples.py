@@ -1,15 +1,27 @@
 import os
-import torch
 import soundfile
 import numpy as np
-from kokoro import KPipeline
 from pydub import AudioSegment
+from epub2tts_kokoro.daemon import DaemonClient
 
 speakers = ["af_heart", "af_alloy", "af_aoede", "af_bella", "af_jessica", "af_kore", "af_nicole", "af_nova", "af_river", "af_sarah", "af_sky", "am_adam", "am_echo", "am_eric", "am_fenrir", "am_liam", "am_michael", "am_onyx", "am_puck", "am_santa", "bf_alice", "bf_emma", "bf_isabella", "bf_lily", "bm_daniel", "bm_fable", "bm_george", "bm_lewis",]
 
-if torch.cuda.is_available():
-    print('CUDA GPU available')
-    torch.set_default_device('cuda')
+# One daemon connection or pipeline per lang_code, shared by all of its speakers
+pipelines = {}
+
+def get_pipeline(lang_code):
+    if lang_code not in pipelines:
+        pipelines[lang_code] = DaemonClient.connect(lang_code)
+        if pipelines[lang_code]:
+            print(f"Using the synthesis daemon at {pipelines[lang_code].path}")
+        else:
+            import torch
+            from kokoro import KPipeline
+            if torch.cuda.is_available():
+                print('CUDA GPU available')
+                torch.set_default_device('cuda')
+            pipelines[lang_code] = KPipeline(lang_code=lang_code)
+    return pipelines[lang_code]
 
 for speaker in speakers:
     file = speaker + "_sample.wav"
@@ -18,10 +30,13 @@ for speaker in speakers:
         continue
     else:
         print(f"Creating {speaker}")
-    pipeline = KPipeline(lang_code=speaker[0])
+    pipeline = get_pipeline(speaker[0])
     sentence = f"Hello, this voice is {speaker[3:]}. The quick brown fox jumped over the lazy dog. The fish twisted and turned on the bent hook.  Press the pants and sew a button on the vest.  The swan dive was far short of perfect."
-    audio_segments = []
-    for gs, ps, audio in pipeline(sentence, voice=speaker, speed=1, split_pattern=r'\n\n\n'):
-        audio_segments.append(audio)
-    final_audio = np.concatenate(audio_segments)
+    if isinstance(pipeline, DaemonClient):
+        final_audio = pipeline.synthesize_text(sentence, speaker, speed=1, split_pattern=r'\n\n\n')
+    else:
+        audio_segments = []
+        for gs, ps, audio in pipeline(sentence, voice=speaker, speed=1, split_pattern=r'\n\n\n'):
+            audio_segments.append(audio)
+        final_audio = np.concatenate(audio_segments)
     soundfile.write(file, final_audio, 24000)
@@ -1,9 +1,8 @@
 import os
 import sys
-import torch
 import soundfile
 import numpy as np
-from kokoro import KPipeline
+from epub2tts_kokoro.daemon import DaemonClient
 
 if len(sys.argv) != 3:
     print("Usage: python read.py <text_file> <speaker_name>")
@@ -25,23 +24,34 @@ with open(text_file, 'r', encoding='utf-8') as f:
 # Generate output filename (replace .txt extension with .wav)
 output_file = os.path.splitext(text_file)[0] + '.wav'
 
-# Check for CUDA GPU
-if torch.cuda.is_available():
-    print('CUDA GPU available')
-    torch.set_default_device('cuda')
-
 print(f"Generating audio for speaker '{speaker}' from '{text_file}'...")
 
-# Create pipeline with language code (first character of speaker name)
-pipeline = KPipeline(lang_code=speaker[0])
-
-# Generate audio segments
-audio_segments = []
-for gs, ps, audio in pipeline(text, voice=speaker, speed=1, split_pattern=r'\n\n\n'):
-    audio_segments.append(audio)
-
-# Concatenate all audio segments
-final_audio = np.concatenate(audio_segments)
+# Use the synthesis daemon if one is running (python -m epub2tts_kokoro.daemon),
+# it has the model and voices loaded already
+client = DaemonClient.connect(speaker[0])
+if client:
+    print(f"Using the synthesis daemon at {client.path}")
+    final_audio = client.synthesize_text(text, speaker, speed=1, split_pattern=r'\n\n\n')
+    client.close()
+else:
+    import torch
+    from kokoro import KPipeline
+
+    # Check for CUDA GPU
+    if torch.cuda.is_available():
+        print('CUDA GPU available')
+        torch.set_default_device('cuda')
+
+    # Create pipeline with language code (first character of speaker name)
+    pipeline = KPipeline(lang_code=speaker[0])
+
+    # Generate audio segments
+    audio_segments = []
+    for gs, ps, audio in pipeline(text, voice=speaker, speed=1, split_pattern=r'\n\n\n'):
+        audio_segments.append(audio)
+
+    # Concatenate all audio segments
+    final_audio = np.concatenate(audio_segments)
 
 # Write to wav file
 soundfile.write(output_file, final_audio, 24000)
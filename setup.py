@@ -15,7 +15,9 @@ setup(
     install_requires=requirements,
     entry_points={
         'console_scripts': [
-            'epub2tts-kokoro = epub2tts_kokoro:main'
+            'epub2tts-kokoro = epub2tts_kokoro:main',
+            'epub2tts-kokoro-daemon = epub2tts_kokoro.daemon:main',
+            'epub2tts-kokoro-worker = epub2tts_kokoro.workqueue:main'
         ]
     },
 )